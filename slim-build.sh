@@ -46,9 +46,24 @@ slim --report=off build --target ${BASE_IMAGE} \
   --include-path=/start.sh \
   --include-path=/restore_snapshot.sh \
   --include-path=/rp_handler.py \
+  --include-path=/comfy_client.py \
+  --include-path=/comfy_pool.py \
+  --include-path=/result_cache.py \
+  --include-path=/workflow_validator.py \
+  --include-path=/startup_timeline.py \
+  --include-path=/job_metrics.py \
+  --include-path=/runtime_estimator.py \
+  --include-path=/input_cache.py \
+  --include-path=/file_lifecycle.py \
+  --include-path=/model_memory.py \
+  --include-path=/model_prefetch.py \
+  --include-path=/workflow_templates.py \
+  --include-path=/image_transcoder.py \
   --include-path=/test_input.json \
   --include-path=/extra_model_paths.yaml \
   --include-path=/models \
+  --include-bin=/usr/bin/nproc \
+  --include-bin=/usr/bin/taskset \
   --include-shell \
   --include-zoneinfo \
   --remove-file-artifacts \
@@ -0,0 +1,285 @@
+import threading
+import time
+
+import requests
+import websocket
+from requests.adapters import HTTPAdapter
+
+# Status codes that are worth retrying, ComfyUI returns them while it is (re)starting
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+class ComfyClient:
+    """
+    Client for the HTTP and WebSocket API of a single ComfyUI server.
+
+    All requests go through one pooled keep-alive session, so consecutive calls reuse
+    the same TCP connection instead of opening a new one for every request.
+
+    Args:
+        host (str): The "host:port" of the ComfyUI server
+        timeout (float): Default timeout in seconds for connecting and for reading a response
+        retries (int): Default number of retries for idempotent requests
+        backoff (float): Delay in seconds before the first retry, doubled for every further retry
+        pool_size (int): Maximum number of connections kept open to the server
+    """
+
+    def __init__(self, host, timeout=30, retries=3, backoff=0.1, pool_size=8):
+        self.host = host
+        self.base_url = f"http://{host}"
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", self._adapter)
+
+        self._lock = threading.Lock()
+        self._metrics = {
+            "requests": 0,
+            "failures": 0,
+            "retries": 0,
+            "request_time_s": 0.0,
+        }
+
+    def _record(self, elapsed, failed=False, retried=False):
+        with self._lock:
+            self._metrics["requests"] += 1
+            self._metrics["request_time_s"] += elapsed
+            if failed:
+                self._metrics["failures"] += 1
+            if retried:
+                self._metrics["retries"] += 1
+
+    def request(self, method, path, timeout=None, retries=None, **kwargs):
+        """
+        Send a request to ComfyUI, retrying connection errors and temporary server errors.
+
+        Args:
+            method (str): The HTTP method
+            path (str): The path on the server, e.g. "/prompt"
+            timeout (float, optional): Timeout for this call instead of the default timeout
+            retries (int, optional): Number of retries for this call. Defaults to the client's
+                                     retries for GET and to 0 for other methods, which are not
+                                     safe to send twice in general.
+            **kwargs: Passed on to `requests.Session.request`
+
+        Returns:
+            requests.Response: The response of the last attempt
+
+        Raises:
+            requests.RequestException: If the last attempt failed to get a response
+        """
+        if retries is None:
+            retries = self.retries if method == "GET" else 0
+        timeout = self.timeout if timeout is None else timeout
+        url = f"{self.base_url}{path}"
+
+        for attempt in range(retries + 1):
+            retry = attempt < retries
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(time.monotonic() - start, failed=True, retried=retry)
+                if not retry:
+                    raise
+            else:
+                if retry and response.status_code in RETRY_STATUS_CODES:
+                    self._record(time.monotonic() - start, failed=True, retried=True)
+                else:
+                    self._record(time.monotonic() - start)
+                    return response
+
+            time.sleep(self.backoff * 2**attempt)
+
+    def is_reachable(self, timeout=1):
+        """
+        Check once whether the server answers, without retrying.
+
+        Args:
+            timeout (float): Timeout in seconds for the check
+
+        Returns:
+            bool: True if the server responded with status 200
+        """
+        try:
+            return self.request("GET", "/", timeout=timeout, retries=0).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def upload_image(self, name, blob, timeout=None):
+        """
+        Upload an image into the input directory of ComfyUI, replacing an existing file.
+
+        Args:
+            name (str): The file name of the image
+            blob (bytes): The content of the image
+            timeout (float, optional): Timeout for this call
+
+        Returns:
+            requests.Response: The response of ComfyUI
+        """
+        # The content is passed as bytes and not as a file object, which a retry would find exhausted
+        files = {
+            "image": (name, blob, "image/png"),
+            "overwrite": (None, "true"),
+        }
+        # Overwriting the same file again is harmless, so uploads can be retried
+        return self.request("POST", "/upload/image", timeout=timeout, retries=self.retries, files=files)
+
+    def queue_prompt(self, workflow, client_id=None, timeout=None):
+        """
+        Queue a workflow to be processed by ComfyUI.
+
+        Args:
+            workflow (dict): The workflow in API format
+            client_id (str, optional): The client id of the WebSocket that should receive the execution events
+            timeout (float, optional): Timeout for this call
+
+        Returns:
+            dict: The JSON response of ComfyUI, containing the prompt_id
+
+        Raises:
+            requests.HTTPError: If ComfyUI rejected the workflow
+        """
+        # The top level element "prompt" is required by ComfyUI
+        payload = {"prompt": workflow}
+        if client_id:
+            payload["client_id"] = client_id
+
+        response = self.request("POST", "/prompt", timeout=timeout, json=payload)
+        if response.status_code != 200:
+            raise requests.HTTPError(
+                f"{response.status_code} {response.text}", response=response
+            )
+        return response.json()
+
+    def get_history(self, prompt_id, timeout=None):
+        """
+        Retrieve the history of a prompt.
+
+        Args:
+            prompt_id (str): The ID of the prompt
+            timeout (float, optional): Timeout for this call
+
+        Returns:
+            dict: The history, keyed by prompt ID. Empty while the prompt has not finished.
+        """
+        response = self.request("GET", f"/history/{prompt_id}", timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_queue(self, timeout=None):
+        """
+        Retrieve the prompts that are running and waiting in the queue.
+
+        Args:
+            timeout (float, optional): Timeout for this call
+
+        Returns:
+            dict: "queue_running" and "queue_pending", lists of entries whose second item is the prompt ID
+        """
+        response = self.request("GET", "/queue", timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def delete_from_queue(self, prompt_ids, timeout=None):
+        """
+        Remove prompts that have not started yet from the queue.
+
+        Args:
+            prompt_ids (list): The IDs of the prompts
+            timeout (float, optional): Timeout for this call
+        """
+        response = self.request("POST", "/queue", timeout=timeout, json={"delete": list(prompt_ids)})
+        response.raise_for_status()
+
+    def interrupt(self, prompt_id=None, timeout=None):
+        """
+        Stop the execution of the running prompt.
+
+        Args:
+            prompt_id (str, optional): Stop only this prompt, if it is the one running
+            timeout (float, optional): Timeout for this call
+        """
+        payload = {"prompt_id": prompt_id} if prompt_id else {}
+        response = self.request("POST", "/interrupt", timeout=timeout, json=payload)
+        response.raise_for_status()
+
+    def free_memory(self, unload_models=True, free_memory=False, timeout=None):
+        """
+        Ask ComfyUI to free memory before it executes the next prompt.
+
+        Args:
+            unload_models (bool): Unload all models from VRAM and RAM
+            free_memory (bool): Also drop the cached outputs of the previous prompts
+            timeout (float, optional): Timeout for this call
+        """
+        payload = {"unload_models": unload_models, "free_memory": free_memory}
+        response = self.request("POST", "/free", timeout=timeout, json=payload)
+        response.raise_for_status()
+
+    def get_object_info(self, timeout=None):
+        """
+        Retrieve the schema of all node classes, their inputs and outputs.
+
+        Args:
+            timeout (float, optional): Timeout for this call
+
+        Returns:
+            dict: The schema, keyed by node class
+        """
+        response = self.request("GET", "/object_info", timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_system_stats(self, timeout=None):
+        """
+        Retrieve the versions of ComfyUI and its environment and the state of the devices.
+
+        Args:
+            timeout (float, optional): Timeout for this call
+
+        Returns:
+            dict: The "system" information and the list of "devices"
+        """
+        response = self.request("GET", "/system_stats", timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def open_websocket(self, client_id, timeout=None):
+        """
+        Open a WebSocket that receives the execution events of `client_id`.
+
+        Args:
+            client_id (str): The client id that is also used when queueing the workflow
+            timeout (float, optional): Timeout in seconds for opening the connection
+
+        Returns:
+            websocket.WebSocket: The open connection
+        """
+        return websocket.create_connection(
+            f"ws://{self.host}/ws?clientId={client_id}",
+            timeout=self.timeout if timeout is None else timeout,
+        )
+
+    def get_metrics(self):
+        """
+        Return counters about the requests sent by this client.
+
+        Returns:
+            dict: The number of requests, failures and retries, the total time spent in
+                  requests and the number of connections that were opened
+        """
+        pools = self._adapter.poolmanager.pools
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics["request_time_s"] = round(metrics["request_time_s"], 4)
+        metrics["connections_opened"] = sum(pools[key].num_connections for key in pools.keys())
+        return metrics
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
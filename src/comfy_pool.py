@@ -0,0 +1,119 @@
+import threading
+import time
+
+
+class ComfyBackend:
+    """
+    One ComfyUI server of the worker.
+
+    Args:
+        client (ComfyClient): The client for the server
+        output_subdirectory (str, optional): The directory below COMFY_OUTPUT_PATH the server
+                                             saves its outputs to, when several servers share it
+        model_memory (ModelMemoryPolicy, optional): The models the server has loaded
+    """
+
+    def __init__(self, client, output_subdirectory=None, model_memory=None):
+        self.client = client
+        self.output_subdirectory = output_subdirectory
+        self.model_memory = model_memory
+        self.healthy = True
+        self.checked_at = None
+        # Jobs of this worker that run on the server, its queue as far as the worker is concerned
+        self.active_jobs = 0
+
+    @property
+    def host(self):
+        return self.client.host
+
+    def has_loaded(self, models):
+        """Whether the server has the resident models of a job loaded, see `ModelMemoryPolicy.has_loaded`."""
+        return self.model_memory is not None and self.model_memory.has_loaded(models)
+
+
+class ComfyPool:
+    """
+    Dispatches the jobs of a worker to several ComfyUI servers.
+
+    Each job goes to the healthy server with the fewest jobs of this worker, which is the
+    shortest queue, as the worker is the only one queueing prompts on them. Among servers
+    with equally short queues, one that already has the models of the job loaded is
+    preferred, so that it does not need to load them again.
+
+    The health of a server is checked before it gets a job if the last check is older
+    than `health_check_interval`. If no server is healthy, the least busy one gets the job
+    anyway, which then fails when the server cannot be reached.
+
+    Args:
+        backends (list): The servers, see `ComfyBackend`
+        health_check_interval (float): Seconds after which the health of a server is checked again
+        health_check_timeout (float): Timeout of a health check in seconds
+    """
+
+    def __init__(self, backends, health_check_interval=10, health_check_timeout=1):
+        self.backends = list(backends)
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self._lock = threading.Lock()
+
+    def check_health(self, backend, force=False):
+        """
+        Check whether a server answers, unless it was checked within `health_check_interval`.
+
+        Args:
+            backend (ComfyBackend): The server
+            force (bool): Check even if the last check is recent
+
+        Returns:
+            bool: Whether the server is healthy
+        """
+        now = time.monotonic()
+        if not force and backend.checked_at is not None and now - backend.checked_at < self.health_check_interval:
+            return backend.healthy
+
+        healthy = backend.client.is_reachable(timeout=self.health_check_timeout)
+        if healthy != backend.healthy:
+            state = "healthy again" if healthy else "not reachable"
+            print(f"runpod-worker-comfy - ComfyUI at {backend.host} is {state}")
+        backend.healthy = healthy
+        backend.checked_at = now
+        return healthy
+
+    def acquire(self, models=frozenset()):
+        """
+        Choose the server for a job and count the job on it until `release`.
+
+        Args:
+            models (frozenset): The models of the job, see `workflow_models`
+
+        Returns:
+            ComfyBackend: The server
+        """
+        candidates = [backend for backend in self.backends if self.check_health(backend)] or self.backends
+        with self._lock:
+            backend = min(
+                candidates,
+                key=lambda backend: (
+                    backend.active_jobs,
+                    not backend.has_loaded(models),
+                    self.backends.index(backend),
+                ),
+            )
+            backend.active_jobs += 1
+        return backend
+
+    def release(self, backend):
+        """Stop counting a job on the server it was given by `acquire`."""
+        with self._lock:
+            backend.active_jobs = max(0, backend.active_jobs - 1)
+
+    def get_stats(self):
+        """
+        Returns:
+            list: The "host", "healthy" and "active_jobs" of each server
+        """
+        with self._lock:
+            return [
+                {"host": backend.host, "healthy": backend.healthy, "active_jobs": backend.active_jobs}
+                for backend in self.backends
+            ]
@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+
+
+class FileLifecycle:
+    """
+    Removes the files a long running worker no longer needs.
+
+    Output images are removed once they were delivered. Input images are kept while
+    they may be used again, up to a quota: once the input images the worker has put
+    into the input directory grow beyond `input_quota` bytes, the least recently used
+    ones are removed. The bytes that were reclaimed are counted by directory.
+
+    Args:
+        input_quota (int): The maximum size of the input images in bytes, 0 for no limit
+        min_age (float): Seconds after its last use during which an input image is not
+                         removed, as a job that is still running may need it
+    """
+
+    def __init__(self, input_quota, min_age=300):
+        self.input_quota = input_quota
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        self._reclaimed = {}
+
+    def _count(self, directory, files, size):
+        with self._lock:
+            total_files, total_bytes = self._reclaimed.get(directory, (0, 0))
+            self._reclaimed[directory] = (total_files + files, total_bytes + size)
+
+    def remove(self, paths, directory="output"):
+        """
+        Remove files, ignoring the ones that do not exist anymore.
+
+        Args:
+            paths (iterable): The paths of the files
+            directory (str): The kind of directory the files are counted for
+
+        Returns:
+            int: The number of bytes that were reclaimed
+        """
+        files = size = 0
+        for path in paths:
+            try:
+                file_size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            files += 1
+            size += file_size
+        if files:
+            self._count(directory, files, size)
+        return size
+
+    def touch(self, path):
+        """Mark an input image as recently used."""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def enforce_input_quota(self, directory, names, on_remove=None):
+        """
+        Remove the least recently used input images until they fit into the quota.
+
+        Args:
+            directory (str): The input directory
+            names (iterable): The file names of the input images the worker has put into
+                              the input directory. Other files are never removed.
+            on_remove (callable, optional): Called with the name of every removed image
+
+        Returns:
+            int: The number of bytes that were reclaimed
+        """
+        if not self.input_quota:
+            return 0
+
+        entries = []
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name, path))
+
+        total = sum(size for _, size, _, _ in entries)
+        reclaimed = files = 0
+        now = time.time()
+        for modified, size, name, path in sorted(entries):
+            if total <= self.input_quota or now - modified < self.min_age:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if on_remove is not None:
+                on_remove(name)
+            total -= size
+            reclaimed += size
+            files += 1
+
+        if files:
+            self._count("input", files, reclaimed)
+        return reclaimed
+
+    def take_reclaimed(self):
+        """
+        Returns the files and bytes reclaimed since the last call, and starts counting anew.
+
+        Returns:
+            dict: A tuple (files, bytes) for each kind of directory
+        """
+        with self._lock:
+            reclaimed, self._reclaimed = self._reclaimed, {}
+            return reclaimed
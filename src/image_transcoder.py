@@ -0,0 +1,29 @@
+from PIL import Image
+
+
+def transcode_image(src_path, dst_path, image_format, quality):
+    """
+    Re-encode an image into another format. Runs in the transcoding process pool.
+
+    This module only depends on Pillow, so that the processes of the pool do not have to
+    import the handler to run it.
+
+    Args:
+        src_path (str): The path to the original image
+        dst_path (str): The path to write the re-encoded image to
+        image_format (str): One of "webp", "avif", "jpeg" or "png"
+        quality (int): The quality from 1 to 100, for the lossy formats
+
+    Returns:
+        str: The path to the re-encoded image
+    """
+    with Image.open(src_path) as image:
+        if image_format == "jpeg":
+            # JPEG has no alpha channel
+            image = image.convert("RGB")
+            image.save(dst_path, "JPEG", quality=quality, optimize=True)
+        elif image_format == "png":
+            image.save(dst_path, "PNG", optimize=True)
+        else:
+            image.save(dst_path, image_format.upper(), quality=quality)
+    return dst_path
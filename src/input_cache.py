@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, unquote, urlencode, urlparse
+
+# Number of bytes that are read from the network and written to disk at once
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Suffix of the file next to each cached download that describes it
+METADATA_SUFFIX = ".json"
+# Query parameters that carry the signature of a presigned S3 or GCS URL or of an Azure SAS
+# URL. They change with every URL that is handed out for the same object.
+SIGNATURE_PARAMS = {
+    "x-amz-algorithm", "x-amz-credential", "x-amz-date", "x-amz-expires", "x-amz-signedheaders",
+    "x-amz-signature", "x-amz-security-token", "awsaccesskeyid", "signature", "expires",
+    "x-goog-algorithm", "x-goog-credential", "x-goog-date", "x-goog-expires", "x-goog-signedheaders",
+    "x-goog-signature",
+    "sv", "ss", "srt", "sp", "st", "se", "spr", "sip", "sr", "si", "sig", "skoid", "sktid", "skt",
+    "ske", "sks", "skv", "sdd",
+}
+# Parameters that show that a URL is signed, the others above are only removed from signed URLs
+SIGNED_MARKERS = {"x-amz-signature", "signature", "x-goog-signature", "sig"}
+
+
+class DownloadError(Exception):
+    """Raised when an input image could not be downloaded."""
+
+
+def cache_url(url):
+    """
+    Returns the URL that identifies an input image in the cache.
+
+    The signature of a presigned S3 or GCS URL, or of an Azure SAS URL, is removed, so that
+    every URL that is handed out for the same object finds the same cached copy. The copy is
+    revalidated with the ETag of the object (see `InputCache`), which the signature does not
+    change. URLs without a signature are used as they are.
+
+    Args:
+        url (str): The URL of the image
+
+    Returns:
+        str: The URL without its signature
+    """
+    parsed = urlparse(url)
+    params = parse_qsl(parsed.query, keep_blank_values=True)
+    if not any(name.lower() in SIGNED_MARKERS for name, _ in params):
+        return url
+    kept = [(name, value) for name, value in params if name.lower() not in SIGNATURE_PARAMS]
+    return parsed._replace(query=urlencode(kept)).geturl()
+
+
+def split_bucket_url(url):
+    """
+    Split a URL of the form "scheme://bucket/path/to/key" into the bucket and the key.
+
+    Args:
+        url (str): The URL, e.g. "s3://images/reference.png"
+
+    Returns:
+        tuple: The bucket (or container) and the key (or blob name)
+
+    Raises:
+        DownloadError: If the URL has no bucket or no key
+    """
+    parsed = urlparse(url)
+    key = unquote(parsed.path.lstrip("/"))
+    if not parsed.netloc or not key:
+        raise DownloadError(f"{url} does not name a bucket and a key")
+    return parsed.netloc, key
+
+
+def http_fetch(session, url, etag, timeout):
+    """
+    Start the download of an HTTP(S) URL, unless it still has the given ETag.
+
+    Args:
+        session (requests.Session): The session to send the request with
+        url (str): The URL of the image
+        etag (str): The ETag of the cached copy, or None
+        timeout (float): Timeout in seconds for connecting and for each read
+
+    Returns:
+        tuple: (etag, size, chunks) with the new ETag, the announced size (or None) and an
+               iterator over the content, or None if the cached copy is still current
+    """
+    headers = {"If-None-Match": etag} if etag else {}
+    response = session.get(url, headers=headers, stream=True, timeout=timeout)
+    if response.status_code == 304:
+        response.close()
+        return None
+    if response.status_code != 200:
+        response.close()
+        # The signature of the URL is not logged
+        raise DownloadError(f"{cache_url(url)} returned {response.status_code}")
+    size = response.headers.get("Content-Length")
+    return response.headers.get("ETag"), int(size) if size else None, response.iter_content(DOWNLOAD_CHUNK_SIZE)
+
+
+def s3_fetch(client, url, etag):
+    """
+    Start the download of an "s3://bucket/key" URL, unless the object still has the given ETag.
+
+    Args:
+        client (botocore.client.S3): The S3 client
+        url (str): The URL of the image
+        etag (str): The ETag of the cached copy, or None
+
+    Returns:
+        tuple: (etag, size, chunks) like `http_fetch`, or None if the cached copy is still current
+    """
+    bucket, key = split_bucket_url(url)
+    head = client.head_object(Bucket=bucket, Key=key)
+    if etag and head["ETag"] == etag:
+        return None
+    body = client.get_object(Bucket=bucket, Key=key, IfMatch=head["ETag"])["Body"]
+    return head["ETag"], head["ContentLength"], body.iter_chunks(DOWNLOAD_CHUNK_SIZE)
+
+
+def azure_fetch(service_client, url, etag):
+    """
+    Start the download of an "azure://container/blob" URL, unless the blob still has the given ETag.
+
+    Args:
+        service_client (BlobServiceClient): The client of the storage account
+        url (str): The URL of the image
+        etag (str): The ETag of the cached copy, or None
+
+    Returns:
+        tuple: (etag, size, chunks) like `http_fetch`, or None if the cached copy is still current
+    """
+    container, blob = split_bucket_url(url)
+    blob_client = service_client.get_blob_client(container, blob)
+    properties = blob_client.get_blob_properties()
+    if etag and properties.etag == etag:
+        return None
+    return properties.etag, properties.size, blob_client.download_blob().chunks()
+
+
+class InputCache:
+    """
+    On-disk LRU cache of downloaded input images.
+
+    Every download is a file named after the SHA-256 of its URL without a signature (see
+    `cache_url`), next to a JSON file with that URL, its ETag and the SHA-256 of the content. A download that was checked less than
+    `ttl` seconds ago is used without any request. After that it is revalidated with its
+    ETag, and downloaded again only if it changed. The least recently used downloads are
+    removed once the cache grows beyond `max_bytes`.
+
+    Args:
+        directory (str): The directory that holds the downloads
+        max_bytes (int): The maximum size of all downloads
+        ttl (float): Seconds a download is used without checking whether it changed
+    """
+
+    def __init__(self, directory, max_bytes, ttl=300):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # A lock and the number of lookups that hold or wait for it, for each URL that is looked up
+        self._url_locks = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def _url_lock(self, key):
+        """Hold the lock of a URL. It is dropped once no lookup holds or waits for it."""
+        with self._lock:
+            entry = self._url_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._url_locks[key]
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        path = os.path.join(self.directory, key)
+        return path, path + METADATA_SUFFIX
+
+    def _read_metadata(self, url):
+        path, metadata_path = self._paths(url)
+        try:
+            with open(metadata_path) as metadata_file:
+                metadata = json.load(metadata_file)
+        except (OSError, ValueError):
+            return None
+        if metadata.get("url") != url or not os.path.exists(path):
+            return None
+        return metadata
+
+    def _write_metadata(self, url, metadata):
+        _, metadata_path = self._paths(url)
+        staging_path = f"{metadata_path}.{uuid.uuid4().hex}"
+        with open(staging_path, "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(staging_path, metadata_path)
+
+    def get(self, url, fetch, max_bytes):
+        """
+        Return the local copy of an input image, downloading it if needed.
+
+        Args:
+            url (str): The URL of the image, it may be signed
+            fetch (callable): Called with the URL and the ETag of the cached copy (or None),
+                              returns None if the copy is current and otherwise a tuple
+                              (etag, size, chunks), see `http_fetch`
+            max_bytes (int): The maximum size of the image
+
+        Returns:
+            tuple: The path of the local copy and the SHA-256 of its content
+
+        Raises:
+            DownloadError: If the image is too large or could not be downloaded
+        """
+        key = cache_url(url)
+
+        # Download each URL only once, also when several jobs ask for it at the same time
+        with self._url_lock(key):
+            path, _ = self._paths(key)
+            metadata = self._read_metadata(key)
+
+            if metadata is not None and time.time() - metadata["checked"] < self.ttl:
+                self._touch(path)
+                with self._lock:
+                    self.hits += 1
+                return path, metadata["sha256"]
+
+            result = fetch(url, metadata["etag"] if metadata else None)
+            if result is None and metadata is not None:
+                metadata["checked"] = time.time()
+                self._write_metadata(key, metadata)
+                self._touch(path)
+                with self._lock:
+                    self.revalidated += 1
+                return path, metadata["sha256"]
+            if result is None:
+                raise DownloadError(f"{key} was not modified, but it is not cached")
+
+            etag, size, chunks = result
+            if size is not None and size > max_bytes:
+                raise DownloadError(f"{key} has {size} bytes, more than the limit of {max_bytes}")
+            digest = self._download(path, chunks, max_bytes, key)
+            self._write_metadata(key, {"url": key, "etag": etag, "sha256": digest, "checked": time.time()})
+            with self._lock:
+                self.misses += 1
+
+        self._evict()
+        return path, digest
+
+    def _download(self, path, chunks, max_bytes, url):
+        """Write the chunks to `path` at once, returns the SHA-256 of the content."""
+        staging_path = f"{path}.{uuid.uuid4().hex}"
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(staging_path, "wb") as staging_file:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise DownloadError(f"{url} is larger than the limit of {max_bytes} bytes")
+                    digest.update(chunk)
+                    staging_file.write(chunk)
+            os.replace(staging_path, path)
+        except BaseException:
+            try:
+                os.remove(staging_path)
+            except OSError:
+                pass
+            raise
+        return digest.hexdigest()
+
+    def _touch(self, path):
+        # Mark the download as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith(METADATA_SUFFIX) or "." in name or not os.path.isfile(path):
+                    continue
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for stale_path in (path, path + METADATA_SUFFIX):
+                    try:
+                        os.remove(stale_path)
+                    except OSError:
+                        pass
+                total -= size
+
+    def stats(self):
+        """
+        Returns the number of hits, revalidations and downloads since the worker started.
+
+        Returns:
+            dict: The "hits", "revalidated" and "misses"
+        """
+        with self._lock:
+            return {"hits": self.hits, "revalidated": self.revalidated, "misses": self.misses}
@@ -0,0 +1,269 @@
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the histogram buckets, from fast HTTP calls to long executions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, math.inf)
+# Prefix of all exported metrics
+METRIC_PREFIX = "runpod_worker_comfy"
+
+
+class JobTimings:
+    """
+    Collects how long each phase of one job took, measured with a monotonic clock.
+
+    Phases are measured with `measure` and add up if a phase runs more than once.
+    Points in time, such as the moment ComfyUI started the execution, are recorded
+    with `mark` and turned into the "queue_wait" and "execution" phases.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._marks = {}
+        self.phases = {}
+        self.images = []
+
+    @contextmanager
+    def measure(self, phase):
+        """Measure the time spent in the body of the `with` statement as `phase`."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - start)
+
+    def add(self, phase, seconds):
+        """Add `seconds` to the time of `phase`."""
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def mark(self, name):
+        """Record the current time under `name`, keeping the first time if it was marked before."""
+        with self._lock:
+            self._marks.setdefault(name, time.monotonic())
+
+    def add_image(self, node_id, filename, image_type, seconds):
+        """Record the delivery of one output image."""
+        with self._lock:
+            self.images.append(
+                {"node_id": node_id, "filename": filename, "imageType": image_type, "seconds": round(seconds, 4)}
+            )
+
+    def derived_phases(self):
+        """
+        Returns the phases between the marks "queued", "execution_start" and "execution_end".
+
+        Returns:
+            dict: "queue_wait" and "execution", for the marks that were recorded
+        """
+        with self._lock:
+            marks = dict(self._marks)
+        phases = {}
+        if "queued" in marks and "execution_start" in marks:
+            phases["queue_wait"] = marks["execution_start"] - marks["queued"]
+        if "execution_start" in marks and "execution_end" in marks:
+            phases["execution"] = marks["execution_end"] - marks["execution_start"]
+        return phases
+
+    def total(self):
+        """Seconds since the job started."""
+        return time.monotonic() - self._start
+
+    def as_dict(self):
+        """
+        Returns the timings of the job.
+
+        Returns:
+            dict: The seconds of each phase ("phases"), of each delivered image ("images")
+                  and of the whole job ("total")
+        """
+        with self._lock:
+            phases = dict(self.phases)
+            images = list(self.images)
+        phases.update(self.derived_phases())
+        return {
+            "phases": {phase: round(seconds, 4) for phase, seconds in phases.items()},
+            "images": images,
+            "total": round(self.total(), 4),
+        }
+
+
+class Histogram:
+    """A cumulative histogram in the sense of Prometheus."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == math.inf else repr(float(bound))
+
+
+class JobMetrics:
+    """
+    Aggregates the timings of all jobs of this worker and renders them in the
+    Prometheus text exposition format.
+
+    Args:
+        buckets (tuple): The upper bounds of the histogram buckets in seconds
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._images = {}
+        self._jobs = {}
+        self._reclaimed = {}
+        self._clients = []
+
+    def add_client(self, client):
+        """
+        Export the request counters of a ComfyUI client with the job metrics.
+
+        Args:
+            client (ComfyClient): The client, its counters are read on every `render`
+        """
+        with self._lock:
+            self._clients.append(client)
+
+    def observe_job(self, timings, status):
+        """
+        Add the timings of a finished job.
+
+        Args:
+            timings (JobTimings): The timings of the job
+            status (str): The outcome of the job, e.g. "success" or "error"
+        """
+        result = timings.as_dict()
+        with self._lock:
+            self._jobs[status] = self._jobs.get(status, 0) + 1
+            for phase, seconds in list(result["phases"].items()) + [("total", result["total"])]:
+                self._phases.setdefault(phase, Histogram(self.buckets)).observe(seconds)
+            for image in result["images"]:
+                self._images.setdefault(image["imageType"], Histogram(self.buckets)).observe(image["seconds"])
+
+    def observe_reclaimed(self, directory, files, size):
+        """
+        Add the files that were removed to free disk space.
+
+        Args:
+            directory (str): The kind of directory, e.g. "output" or "input"
+            files (int): The number of removed files
+            size (int): Their size in bytes
+        """
+        with self._lock:
+            total_files, total_bytes = self._reclaimed.get(directory, (0, 0))
+            self._reclaimed[directory] = (total_files + files, total_bytes + size)
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics
+        """
+        lines = []
+        with self._lock:
+            lines.append(f"# HELP {METRIC_PREFIX}_jobs_total Number of finished jobs by status.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_jobs_total counter")
+            for status, count in sorted(self._jobs.items()):
+                lines.append(f'{METRIC_PREFIX}_jobs_total{{status="{status}"}} {count}')
+
+            for name, position, description in (
+                ("reclaimed_files_total", 0, "Number of files removed to free disk space."),
+                ("reclaimed_bytes_total", 1, "Bytes freed by removing files."),
+            ):
+                metric = f"{METRIC_PREFIX}_{name}"
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} counter")
+                for directory, counts in sorted(self._reclaimed.items()):
+                    lines.append(f'{metric}{{directory="{directory}"}} {counts[position]}')
+
+            clients = [(client.host, client.get_metrics()) for client in self._clients]
+            for name, key, description in (
+                ("comfy_requests_total", "requests", "Number of HTTP requests sent to ComfyUI."),
+                ("comfy_request_failures_total", "failures", "Number of HTTP requests to ComfyUI that failed."),
+                ("comfy_request_retries_total", "retries", "Number of HTTP requests to ComfyUI that were retried."),
+                ("comfy_request_seconds_total", "request_time_s", "Time spent in HTTP requests to ComfyUI."),
+                ("comfy_connections_opened_total", "connections_opened", "Number of connections opened to ComfyUI."),
+            ):
+                metric = f"{METRIC_PREFIX}_{name}"
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} counter")
+                for host, client_metrics in clients:
+                    lines.append(f'{metric}{{host="{host}"}} {client_metrics[key]}')
+
+            for name, label, histograms, description in (
+                ("job_phase_seconds", "phase", self._phases, "Time spent in each phase of a job."),
+                ("image_delivery_seconds", "image_type", self._images, "Time to deliver one output image."),
+            ):
+                metric = f"{METRIC_PREFIX}_{name}"
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} histogram")
+                for value, histogram in sorted(histograms.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{metric}_bucket{{{label}="{value}",le="{_format_bound(bound)}"}} {count}')
+                    lines.append(f'{metric}_sum{{{label}="{value}"}} {round(histogram.sum, 6)}')
+                    lines.append(f'{metric}_count{{{label}="{value}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to a file, e.g. for the textfile collector of the node exporter."""
+        staging_path = f"{path}.{uuid.uuid4().hex}"
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(staging_path, "w") as metrics_file:
+                metrics_file.write(self.render())
+            os.replace(staging_path, path)
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not write metrics to {path}: {str(e)}")
+
+
+def serve_metrics(metrics, port, host="0.0.0.0"):
+    """
+    Serve the metrics at GET /metrics on a background thread.
+
+    Args:
+        metrics (JobMetrics): The metrics to serve
+        port (int): The port to listen on
+        host (str): The address to listen on
+
+    Returns:
+        ThreadingHTTPServer: The running server
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
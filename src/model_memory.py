@@ -0,0 +1,143 @@
+import threading
+
+# Inputs of the loader nodes that name a model file, and the kind of model they load
+MODEL_INPUTS = {
+    "ckpt_name": "checkpoints",
+    "unet_name": "diffusion_models",
+    "clip_name": "text_encoders",
+    "clip_name1": "text_encoders",
+    "clip_name2": "text_encoders",
+    "clip_name3": "text_encoders",
+    "vae_name": "vae",
+    "lora_name": "loras",
+    "control_net_name": "controlnet",
+}
+# The models that stay in memory between jobs. A job that needs others makes ComfyUI load
+# them next to the ones that are already there. LoRAs, ControlNets and the like are
+# small next to them and not worth unloading for.
+RESIDENT_KINDS = ("checkpoints", "diffusion_models", "text_encoders", "vae")
+# Extensions of model files, to find the models of loaders that are not in MODEL_INPUTS
+MODEL_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".gguf", ".sft")
+
+
+def workflow_models(workflow):
+    """
+    Find the model files a workflow loads.
+
+    The inputs of known loader nodes (e.g. "ckpt_name" of CheckpointLoaderSimple) are
+    used, and any other "..._name" input whose value is a model file.
+
+    Args:
+        workflow (dict): The workflow in API format
+
+    Returns:
+        frozenset: Tuples (kind, file name), e.g. ("checkpoints", "sd_xl_base_1.0.safetensors")
+    """
+    models = set()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        for name, value in (node.get("inputs") or {}).items():
+            if not isinstance(value, str):
+                continue
+            if name in MODEL_INPUTS:
+                models.add((MODEL_INPUTS[name], value))
+            elif name.endswith("_name") and value.lower().endswith(MODEL_EXTENSIONS):
+                models.add(("other", value))
+    return frozenset(models)
+
+
+def memory_usage(system_stats):
+    """
+    Returns the fraction of memory in use, from the /system_stats of ComfyUI.
+
+    Args:
+        system_stats (dict): The response of /system_stats
+
+    Returns:
+        float: The highest usage of the VRAM of any device and of the RAM, or None if
+               ComfyUI did not report any
+    """
+    usages = []
+    for device in system_stats.get("devices") or []:
+        if device.get("type") != "cpu" and device.get("vram_total"):
+            usages.append(1 - device.get("vram_free", 0) / device["vram_total"])
+    system = system_stats.get("system") or {}
+    if system.get("ram_total"):
+        usages.append(1 - system.get("ram_free", 0) / system["ram_total"])
+    return max(usages) if usages else None
+
+
+class ModelMemoryPolicy:
+    """
+    Decides between jobs whether ComfyUI should free its memory.
+
+    The models stay loaded as long as the next job only needs models that are already
+    in memory. Models are unloaded when a job needs other resident models than the jobs
+    before it (e.g. when switching from SDXL to another model family), and all memory is
+    freed when the usage reported by ComfyUI reaches `threshold`. The usage includes the
+    models ComfyUI keeps loaded, so the threshold should be well above what they take.
+
+    Args:
+        unload_on_change (bool): Unload the models when a job needs other resident models
+        threshold (float): Free all memory at this fraction of VRAM or RAM in use, 0 to never
+    """
+
+    def __init__(self, unload_on_change=True, threshold=0):
+        self.unload_on_change = unload_on_change
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        # The models that were used since the memory was freed the last time
+        self._loaded = frozenset()
+
+    @property
+    def loaded(self):
+        with self._lock:
+            return self._loaded
+
+    def decide(self, models, usage=None):
+        """
+        Decide what to free before the next job.
+
+        Args:
+            models (frozenset): The models of the next job, see `workflow_models`
+            usage (float, optional): The fraction of memory in use, see `memory_usage`
+
+        Returns:
+            tuple: (unload_models, free_memory, reason), or None to keep everything in memory
+        """
+        if self.threshold and usage is not None and usage >= self.threshold:
+            return True, True, f"{usage:.0%} of the memory is in use"
+
+        needed = {model for model in models if model[0] in RESIDENT_KINDS}
+        with self._lock:
+            loaded = {model for model in self._loaded if model[0] in RESIDENT_KINDS}
+        if self.unload_on_change and loaded and not needed <= loaded:
+            new_models = ", ".join(sorted(name for _, name in needed - loaded))
+            return True, False, f"the job needs other models ({new_models})"
+        return None
+
+    def has_loaded(self, models):
+        """
+        Whether the resident models of a job are among the ones that are loaded.
+
+        Args:
+            models (frozenset): The models of the job, see `workflow_models`
+
+        Returns:
+            bool: False if the job has no resident models
+        """
+        needed = {model for model in models if model[0] in RESIDENT_KINDS}
+        with self._lock:
+            return bool(needed) and needed <= self._loaded
+
+    def record(self, models, freed=False):
+        """
+        Remember the models of a job that was queued.
+
+        Args:
+            models (frozenset): The models of the job
+            freed (bool): Whether the memory was freed before the job
+        """
+        with self._lock:
+            self._loaded = frozenset(models) if freed else self._loaded | models
@@ -0,0 +1,263 @@
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Folders of each kind of model below the models directory of the network volume, in
+# the order ComfyUI searches them (see extra_model_paths.yaml). start.sh lets ComfyUI search the
+# same folders below the local cache directory.
+MODEL_FOLDERS = {
+    "checkpoints": ("checkpoints",),
+    "diffusion_models": ("unet", "diffusion_models"),
+    "text_encoders": ("clip", "text_encoders"),
+    "vae": ("vae",),
+    "loras": ("loras",),
+    "controlnet": ("controlnet",),
+    "other": ("upscale_models", "clip_vision"),
+}
+# Kinds of models in the order they are prefetched, the large ones that every job loads first
+DEFAULT_ORDER = ("checkpoints", "diffusion_models", "text_encoders", "vae", "controlnet", "loras", "other")
+# Prefix of the files a copy is written to before it is renamed into place
+PARTIAL_PREFIX = ".partial-"
+
+
+def readahead(path):
+    """
+    Ask the kernel to read a file into the page cache in the background.
+
+    Args:
+        path (str): The file
+
+    Returns:
+        bool: True if the request was made, False if the platform or file does not support it
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+class ModelPrefetcher:
+    """
+    Keeps local copies of the models on the network volume that jobs use.
+
+    ComfyUI searches `cache_dir` before the network volume (see start.sh), so once a
+    model was copied it is loaded from local disk. The models of a job are read into the
+    page cache in the background as soon as the job arrives, and the ones without a local
+    copy are copied in the background, one at a time, in the order of their kind. The
+    reads have their own thread, so that they do not wait for the copies of earlier jobs.
+    The least recently used copies are removed to stay within `max_bytes`.
+
+    Args:
+        source_dir (str): The models directory on the network volume
+        cache_dir (str): The local directory the models are copied to
+        max_bytes (int): Maximum size of all copies, 0 to only read the models into the page cache
+        min_free_bytes (int): Space on the local disk that copies never take
+        order (tuple): Kinds of models, see `MODEL_FOLDERS`, in the order they are copied.
+                       Kinds that are not listed are not copied.
+    """
+
+    def __init__(self, source_dir, cache_dir, max_bytes, min_free_bytes=0, order=DEFAULT_ORDER):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.order = tuple(order)
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-prefetch")
+        self._readahead_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-readahead")
+        # Relative paths of the models that are waiting to be copied or being copied
+        self._pending = {}
+        self._stats = {"hits": 0, "copies": 0, "copied_bytes": 0, "evictions": 0, "failures": 0}
+        self._remove_partial_files()
+
+    def _remove_partial_files(self):
+        """Remove the copies an earlier worker did not finish."""
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.startswith(PARTIAL_PREFIX):
+                    try:
+                        os.remove(os.path.join(root, name))
+                    except OSError:
+                        pass
+
+    def locate(self, kind, name):
+        """
+        Find a model on the network volume.
+
+        Args:
+            kind (str): The kind of model, e.g. "checkpoints"
+            name (str): The file name as it is given in the workflow, may contain subfolders
+
+        Returns:
+            str: The path relative to `source_dir`, or None if the model is not on the volume
+        """
+        parts = name.replace("\\", "/").split("/")
+        if os.path.isabs(name) or ".." in parts:
+            return None
+        for folder in MODEL_FOLDERS.get(kind, ()):
+            relative_path = os.path.join(folder, *parts)
+            if os.path.isfile(os.path.join(self.source_dir, relative_path)):
+                return relative_path
+        return None
+
+    def prefetch(self, models):
+        """
+        Prepare the models of a job: read them into the page cache and copy the ones
+        without a local copy in the background.
+
+        Args:
+            models (iterable): Tuples (kind, file name), see `workflow_models`
+
+        Returns:
+            list: The relative paths of the models that are copied
+        """
+        rank = {kind: index for index, kind in enumerate(self.order)}
+        scheduled = []
+        for kind, name in sorted(models, key=lambda model: (rank.get(model[0], len(rank)), model[1])):
+            relative_path = self.locate(kind, name)
+            if relative_path is None:
+                continue
+            source_path = os.path.join(self.source_dir, relative_path)
+            local_path = os.path.join(self.cache_dir, relative_path)
+
+            if self._is_copy_of(local_path, source_path):
+                # Mark the copy as used, the least recently used ones are removed first
+                os.utime(local_path)
+                self._readahead_executor.submit(readahead, local_path)
+                with self._lock:
+                    self._stats["hits"] += 1
+                continue
+
+            self._readahead_executor.submit(readahead, source_path)
+            if not self.max_bytes or kind not in rank:
+                continue
+            with self._lock:
+                if relative_path in self._pending:
+                    continue
+                self._pending[relative_path] = self._executor.submit(self._copy, relative_path)
+            scheduled.append(relative_path)
+        return scheduled
+
+    def _is_copy_of(self, local_path, source_path):
+        try:
+            return os.path.getsize(local_path) == os.path.getsize(source_path)
+        except OSError:
+            return False
+
+    def _copy(self, relative_path):
+        source_path = os.path.join(self.source_dir, relative_path)
+        local_path = os.path.join(self.cache_dir, relative_path)
+        partial_path = None
+        try:
+            size = os.path.getsize(source_path)
+            if not self._make_room(size, exclude=local_path):
+                print(f"runpod-worker-comfy - no room to copy {relative_path} ({size} bytes) to local disk")
+                return False
+
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            partial_path = os.path.join(
+                os.path.dirname(local_path), f"{PARTIAL_PREFIX}{uuid.uuid4().hex}-{os.path.basename(local_path)}"
+            )
+            shutil.copyfile(source_path, partial_path)
+            # ComfyUI finds the copy only once it is complete
+            os.replace(partial_path, local_path)
+            partial_path = None
+            with self._lock:
+                self._stats["copies"] += 1
+                self._stats["copied_bytes"] += size
+            print(f"runpod-worker-comfy - copied {relative_path} ({size} bytes) to local disk")
+            return True
+        except OSError as e:
+            with self._lock:
+                self._stats["failures"] += 1
+            print(f"runpod-worker-comfy - could not copy {relative_path} to local disk: {str(e)}")
+            return False
+        finally:
+            if partial_path is not None:
+                try:
+                    os.remove(partial_path)
+                except OSError:
+                    pass
+            with self._lock:
+                self._pending.pop(relative_path, None)
+
+    def _cached_files(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.startswith(PARTIAL_PREFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _make_room(self, size, exclude=None):
+        """
+        Remove the least recently used copies until a model of `size` bytes fits.
+
+        Returns:
+            bool: True if the model fits
+        """
+        if size > self.max_bytes:
+            return False
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = sorted(self._cached_files())
+        total = sum(file_size for _, file_size, path in files if path != exclude)
+
+        def fits():
+            free = shutil.disk_usage(self.cache_dir).free
+            return total + size <= self.max_bytes and free - size >= self.min_free_bytes
+
+        for _, file_size, path in files:
+            if fits():
+                return True
+            if path == exclude:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= file_size
+            with self._lock:
+                self._stats["evictions"] += 1
+            print(f"runpod-worker-comfy - removed the local copy of {os.path.relpath(path, self.cache_dir)}")
+        return fits()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the reads and copies that were scheduled so far are done.
+
+        Args:
+            timeout (float, optional): Maximum time to wait for the reads and for each copy
+        """
+        # The reads run one after the other, so they are done when an empty task after them is
+        self._readahead_executor.submit(lambda: None).result(timeout=timeout)
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            future.result(timeout=timeout)
+
+    def get_stats(self):
+        """
+        Returns:
+            dict: The number of "hits" on a local copy, "copies" made and their "copied_bytes",
+                  copies removed to make room ("evictions") and "failures"
+        """
+        with self._lock:
+            return dict(self._stats)
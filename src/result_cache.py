@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# Name of the file in each cache entry that describes the cached outputs
+MANIFEST_NAME = "manifest.json"
+# Inputs that hold the seed of a node, a negative seed asks some nodes for a random one
+SEED_INPUTS = ("seed", "noise_seed")
+# Node classes that produce a different value on every run, whatever their inputs: random
+# numbers, counters and random lines of text (WAS Node Suite), and seeds that are chosen
+# by the node (rgthree, Impact Pack)
+DEFAULT_BYPASS_NODE_TYPES = (
+    "Random Number",
+    "Number Counter",
+    "Text Random Line",
+    "Text Random Prompt",
+    "Load Image Batch",
+    "Seed (rgthree)",
+    "ImpactWildcardProcessor",
+)
+
+
+def compute_cache_key(workflow, images=None):
+    """
+    Compute a key that identifies the result of a workflow.
+
+    The key is the SHA-256 of the canonical JSON of the workflow and of the name and
+    content of every input image, so the order of keys and images does not matter.
+
+    Args:
+        workflow (dict): The workflow in API format
+        images (list, optional): The input images, dictionaries with 'name' and 'image'
+
+    Returns:
+        str: The hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(workflow, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    for image in sorted(images or [], key=lambda image: image["name"]):
+        digest.update(b"\0" + image["name"].encode("utf-8") + b"\0")
+        digest.update(hashlib.sha256(image["image"].encode("utf-8")).digest())
+    return digest.hexdigest()
+
+
+def find_nondeterminism(workflow, bypass_node_types=()):
+    """
+    Find a reason why a workflow could produce a different result when it runs again.
+
+    Args:
+        workflow (dict): The workflow in API format
+        bypass_node_types (iterable): Node classes that are known to be nondeterministic, in
+                                      addition to DEFAULT_BYPASS_NODE_TYPES
+
+    Returns:
+        str: A description of the first nondeterministic node, or None if the workflow is deterministic
+    """
+    bypass_node_types = set(DEFAULT_BYPASS_NODE_TYPES) | set(bypass_node_types)
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            continue
+        class_type = node.get("class_type")
+        if class_type in bypass_node_types:
+            return f"node {node_id} ({class_type}) is nondeterministic"
+        for name in SEED_INPUTS:
+            seed = (node.get("inputs") or {}).get(name)
+            if isinstance(seed, (int, float)) and seed < 0:
+                return f"node {node_id} ({class_type}) uses a random {name}"
+            # The seed is computed by another node, which may choose a new one on every run
+            if isinstance(seed, list):
+                return f"node {node_id} ({class_type}) takes its {name} from another node"
+    return None
+
+
+def _link_or_copy(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class ResultCache:
+    """
+    On-disk LRU cache of the output images of finished workflows.
+
+    Every entry is a directory named after the cache key, holding the output files and a
+    manifest with the "outputs" of the history. The least recently used entries are removed
+    once the cache grows beyond `max_bytes`.
+
+    Args:
+        directory (str): The directory that holds the entries
+        max_bytes (int): The maximum size of all entries
+        remote (object, optional): A second tier with `get(key, entry_path)` and `put(key, entry_path)`,
+                                   e.g. `AzureResultCache`
+    """
+
+    def __init__(self, directory, max_bytes, remote=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.remote = remote
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Look up the outputs of a workflow.
+
+        Args:
+            key (str): The key from `compute_cache_key`
+
+        Returns:
+            tuple: A tuple (outputs, path) with the "outputs" of the history and the directory
+                   that contains the files, or None on a miss
+        """
+        entry_path = self._entry_path(key)
+        manifest_path = os.path.join(entry_path, MANIFEST_NAME)
+
+        if not os.path.exists(manifest_path) and self.remote is not None:
+            try:
+                if self.remote.get(key, entry_path):
+                    self._evict()
+            except Exception as e:
+                print(f"runpod-worker-comfy - remote result cache lookup failed: {str(e)}")
+
+        try:
+            with open(manifest_path) as manifest_file:
+                outputs = json.load(manifest_file)["outputs"]
+            # Mark the entry as recently used
+            os.utime(entry_path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return outputs, entry_path
+
+    def put(self, key, outputs, output_path):
+        """
+        Store the output images of a finished workflow.
+
+        Args:
+            key (str): The key from `compute_cache_key`
+            outputs (dict): The "outputs" of the history
+            output_path (str): The directory ComfyUI wrote the images to
+        """
+        entry_path = self._entry_path(key)
+        if os.path.exists(entry_path):
+            return
+
+        # Build the entry next to its final place and move it there at once
+        staging_path = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex}")
+        try:
+            for node_output in outputs.values():
+                for image in node_output.get("images", []):
+                    relative_path = os.path.join(image.get("subfolder", ""), image["filename"])
+                    source = os.path.join(output_path, relative_path)
+                    if os.path.exists(source):
+                        _link_or_copy(source, os.path.join(staging_path, relative_path))
+
+            os.makedirs(staging_path, exist_ok=True)
+            with open(os.path.join(staging_path, MANIFEST_NAME), "w") as manifest_file:
+                json.dump({"outputs": outputs, "created": time.time()}, manifest_file)
+            os.rename(staging_path, entry_path)
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not store result in cache: {str(e)}")
+            shutil.rmtree(staging_path, ignore_errors=True)
+            return
+
+        self._evict()
+
+        if self.remote is not None:
+            threading.Thread(target=self._put_remote, args=(key, entry_path), daemon=True).start()
+
+    def _put_remote(self, key, entry_path):
+        try:
+            self.remote.put(key, entry_path)
+        except Exception as e:
+            print(f"runpod-worker-comfy - could not store result in remote cache: {str(e)}")
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.startswith(".") or not os.path.isdir(path):
+                    continue
+                entries.append((os.path.getmtime(path), _directory_size(path), path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    def stats(self):
+        """
+        Returns the number of hits and misses since the worker started.
+
+        Returns:
+            dict: The "hits" and "misses"
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+class AzureResultCache:
+    """
+    Remote tier of the result cache in an Azure Blob Storage container.
+
+    Each entry is stored as blobs below "<prefix>/<key>/", with the same layout as on disk.
+
+    Args:
+        service_client: A BlobServiceClient (or a stand-in with the same interface)
+        container_name (str): The container that holds the entries
+        prefix (str): The prefix of all blobs of the cache
+    """
+
+    def __init__(self, service_client, container_name, prefix="result-cache"):
+        self.container_client = service_client.get_container_client(container_name)
+        self.prefix = prefix
+
+    def get(self, key, entry_path):
+        """
+        Download an entry into `entry_path`.
+
+        Returns:
+            bool: True if the entry exists in the container
+        """
+        blob_prefix = f"{self.prefix}/{key}/"
+        names = [blob.name for blob in self.container_client.list_blobs(name_starts_with=blob_prefix)]
+        if f"{blob_prefix}{MANIFEST_NAME}" not in names:
+            return False
+
+        staging_path = f"{entry_path}.{uuid.uuid4().hex}"
+        # Download the manifest last, an entry without it counts as missing
+        for name in sorted(names, key=lambda name: name.endswith(MANIFEST_NAME)):
+            target = os.path.join(staging_path, name[len(blob_prefix):])
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as target_file:
+                self.container_client.download_blob(name).readinto(target_file)
+        try:
+            os.rename(staging_path, entry_path)
+        except OSError:
+            # Another job downloaded the same entry in the meantime
+            shutil.rmtree(staging_path, ignore_errors=True)
+        return True
+
+    def put(self, key, entry_path):
+        """Upload the entry in `entry_path`, the manifest last."""
+        files = []
+        for root, _, names in os.walk(entry_path):
+            for name in names:
+                files.append(os.path.join(root, name))
+
+        for path in sorted(files, key=lambda path: path.endswith(MANIFEST_NAME)):
+            blob_name = f"{self.prefix}/{key}/{os.path.relpath(path, entry_path)}"
+            with open(path, "rb") as data:
+                self.container_client.upload_blob(blob_name, data, overwrite=True)
@@ -1,30 +1,259 @@
 import runpod
 from runpod.serverless.utils import rp_upload
+import asyncio
 import json
-import urllib.request
-import urllib.parse
 import time
 import os
 import requests
 import base64
+import glob
+import shutil
+import hashlib
+import multiprocessing
+import socket
+import sys
+import threading
 import uuid
-from io import BytesIO
+import websocket
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+from PIL import features
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
 from azure.identity import DefaultAzureCredential
+from comfy_client import ComfyClient
+from comfy_pool import ComfyBackend, ComfyPool
+from file_lifecycle import FileLifecycle
+from image_transcoder import transcode_image
+from input_cache import DownloadError, InputCache, azure_fetch, http_fetch, s3_fetch
+from job_metrics import JobMetrics, JobTimings, serve_metrics
+from model_memory import ModelMemoryPolicy, memory_usage, workflow_models
+from model_prefetch import DEFAULT_ORDER, ModelPrefetcher
+from result_cache import AzureResultCache, ResultCache, compute_cache_key, find_nondeterminism
+from runtime_estimator import RuntimeEstimator, execution_seconds, next_poll_delay, workflow_fingerprint
+from startup_timeline import StartupTimeline
+from workflow_templates import load_templates
+from workflow_validator import WorkflowValidator, load_object_info, schema_fingerprint, store_object_info
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
 # Maximum number of API check attempts
 COMFY_API_AVAILABLE_MAX_RETRIES = 500
-# Time to wait between poll attempts in milliseconds
+# Longest time to wait between poll attempts in milliseconds
 COMFY_POLLING_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 250))
-# Maximum number of poll attempts
-COMFY_POLLING_MAX_RETRIES = int(os.environ.get("COMFY_POLLING_MAX_RETRIES", 500))
-# Host where ComfyUI is running
-COMFY_HOST = "127.0.0.1:8188"
+# Time to wait between poll attempts around the expected finish of a prompt in milliseconds
+COMFY_POLLING_MIN_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_MIN_INTERVAL_MS", 25))
+# Maximum time in seconds a prompt may run. COMFY_POLLING_MAX_RETRIES is still honoured
+# when it is set, as the time the former fixed number of polls took.
+COMFY_EXECUTION_TIMEOUT_S = float(
+    os.environ.get(
+        "COMFY_EXECUTION_TIMEOUT_S",
+        COMFY_POLLING_INTERVAL_MS * int(os.environ["COMFY_POLLING_MAX_RETRIES"]) / 1000
+        if "COMFY_POLLING_MAX_RETRIES" in os.environ
+        else 600,
+    )
+)
+# Default of the "timeout" of a job in seconds, from the moment it was received until its
+# images were generated. 0 leaves only COMFY_EXECUTION_TIMEOUT_S for each prompt.
+COMFY_JOB_TIMEOUT_S = float(os.environ.get("COMFY_JOB_TIMEOUT_S", 0))
+# Weight of the latest runtime in the moving average of the runtime of each workflow
+RUNTIME_ESTIMATE_ALPHA = float(os.environ.get("RUNTIME_ESTIMATE_ALPHA", 0.3))
+# Number of ComfyUI servers start.sh launches, on consecutive ports from COMFY_BASE_PORT.
+# Each job is dispatched to one of them, see `ComfyPool`.
+COMFY_INSTANCES = max(1, int(os.environ.get("COMFY_INSTANCES", 1)))
+COMFY_BASE_PORT = int(os.environ.get("COMFY_BASE_PORT", 8188))
+# Host where ComfyUI is running, the first one if there are several
+COMFY_HOST = f"127.0.0.1:{COMFY_BASE_PORT}"
+# Seconds after which the health of a ComfyUI server is checked again before it gets a job
+COMFY_HEALTH_CHECK_INTERVAL_S = float(os.environ.get("COMFY_HEALTH_CHECK_INTERVAL_S", 10))
+# Time to wait for the WebSocket connection to ComfyUI to open in seconds
+COMFY_WEBSOCKET_CONNECT_TIMEOUT_S = 10
+# Timeout for a single HTTP request to ComfyUI in seconds
+COMFY_REQUEST_TIMEOUT_S = float(os.environ.get("COMFY_REQUEST_TIMEOUT_S", 30))
+# Number of retries for idempotent HTTP requests to ComfyUI, with exponential backoff
+COMFY_REQUEST_RETRIES = int(os.environ.get("COMFY_REQUEST_RETRIES", 3))
 # Enforce a clean state after each job is done
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
+# Number of input images that are uploaded to ComfyUI at the same time
+COMFY_UPLOAD_CONCURRENCY = max(1, int(os.environ.get("COMFY_UPLOAD_CONCURRENCY", 4)))
+# Input directory of ComfyUI. When the worker can write to it, input images are written
+# there directly instead of being sent to /upload/image ("auto"). "upload" always uses
+# /upload/image, e.g. when ComfyUI runs on another machine.
+COMFY_INPUT_PATH = os.environ.get("COMFY_INPUT_PATH", "/comfyui/input")
+COMFY_INPUT_MODE = os.environ.get("COMFY_INPUT_MODE", "auto").lower()
+# Input images given by "url": number of downloads at the same time, their maximum size and timeout
+INPUT_DOWNLOAD_CONCURRENCY = max(1, int(os.environ.get("INPUT_DOWNLOAD_CONCURRENCY", 4)))
+INPUT_DOWNLOAD_MAX_MB = float(os.environ.get("INPUT_DOWNLOAD_MAX_MB", 50))
+INPUT_DOWNLOAD_TIMEOUT_S = float(os.environ.get("INPUT_DOWNLOAD_TIMEOUT_S", 30))
+# On-disk cache of the downloaded input images, used without a request for INPUT_CACHE_TTL_S
+# and revalidated with their ETag after that
+INPUT_CACHE_DIR = os.environ.get("INPUT_CACHE_DIR", "/tmp/runpod-worker-comfy/input-cache")
+INPUT_CACHE_MAX_MB = int(os.environ.get("INPUT_CACHE_MAX_MB", 1024))
+INPUT_CACHE_TTL_S = float(os.environ.get("INPUT_CACHE_TTL_S", 300))
+# Between jobs, unload the models when the next job needs other checkpoints, diffusion
+# models, text encoders or VAEs than the jobs before it
+COMFY_UNLOAD_ON_MODEL_CHANGE = os.environ.get("COMFY_UNLOAD_ON_MODEL_CHANGE", "true").lower() == "true"
+# Between jobs, free all memory when this fraction of VRAM or RAM is in use, 0 to never. The
+# models ComfyUI keeps loaded count as in use, so a low threshold unloads them before every job.
+COMFY_FREE_MEMORY_THRESHOLD = float(os.environ.get("COMFY_FREE_MEMORY_THRESHOLD", 0))
+# Copy the models a job uses from the network volume to MODEL_CACHE_DIR in the background,
+# ComfyUI loads them from there once they are copied (start.sh adds MODEL_CACHE_DIR to its
+# model paths). The models are read into the page cache as soon as a job arrives.
+MODEL_PREFETCH = os.environ.get("MODEL_PREFETCH", "true").lower() == "true"
+MODEL_VOLUME_PATH = os.environ.get("MODEL_VOLUME_PATH", "/runpod-volume/models")
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", "/tmp/runpod-worker-comfy/model-cache")
+# Maximum size of the local copies, the least recently used ones are removed. 0 disables the
+# copies. The copies never leave less than MODEL_CACHE_MIN_FREE_GB free on the local disk.
+MODEL_CACHE_MAX_GB = float(os.environ.get("MODEL_CACHE_MAX_GB", 50))
+MODEL_CACHE_MIN_FREE_GB = float(os.environ.get("MODEL_CACHE_MIN_FREE_GB", 10))
+# Comma separated kinds of models in the order they are copied, kinds that are not listed are not copied
+MODEL_PREFETCH_ORDER = [
+    kind.strip()
+    for kind in os.environ.get("MODEL_PREFETCH_ORDER", ",".join(DEFAULT_ORDER)).split(",")
+    if kind.strip()
+]
+# Keep the output images of a job after they were delivered, they are removed by default
+RETAIN_OUTPUTS = os.environ.get("RETAIN_OUTPUTS", "false").lower() == "true"
+# Maximum size of the input images the worker put into COMFY_INPUT_PATH, the least recently
+# used ones are removed after a job that exceeds it. 0 keeps all of them.
+COMFY_INPUT_QUOTA_MB = float(os.environ.get("COMFY_INPUT_QUOTA_MB", 2048))
+# Input images used within this time are never removed, as a running job may still need them
+COMFY_INPUT_MIN_AGE_S = float(os.environ.get("COMFY_INPUT_MIN_AGE_S", 300))
+# Azure uploads: files larger than the single put size are uploaded in blocks, several at a time
+AZURE_UPLOAD_BLOCK_SIZE_MB = int(os.environ.get("AZURE_UPLOAD_BLOCK_SIZE_MB", 4))
+AZURE_UPLOAD_SINGLE_PUT_SIZE_MB = int(os.environ.get("AZURE_UPLOAD_SINGLE_PUT_SIZE_MB", 8))
+AZURE_UPLOAD_CONCURRENCY = max(1, int(os.environ.get("AZURE_UPLOAD_CONCURRENCY", 4)))
+# Maximum size of all base64 encoded images in one response, larger images are uploaded instead
+BASE64_RESPONSE_BUDGET_MB = float(os.environ.get("BASE64_RESPONSE_BUDGET_MB", 20))
+# Number of bytes that are read and encoded at once when encoding an image in base64
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+# Formats the outputs can be re-encoded to before delivery
+TRANSCODE_FORMATS = ("webp", "avif", "jpeg", "png")
+# Re-encode all outputs to this format unless a job sets "transcode", disabled by default
+TRANSCODE_FORMAT = os.environ.get("TRANSCODE_FORMAT", "").lower()
+# Quality (1-100) of the lossy formats
+TRANSCODE_QUALITY = int(os.environ.get("TRANSCODE_QUALITY", 90))
+# Number of processes that re-encode images
+TRANSCODE_WORKERS = max(1, int(os.environ.get("TRANSCODE_WORKERS", min(4, os.cpu_count() or 1))))
+# Return the outputs of an identical earlier job from an on-disk cache, for deterministic workflows
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "false").lower() == "true"
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/tmp/runpod-worker-comfy/result-cache")
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", 2048))
+# Optional container in Azure Blob Storage that shares the cache between workers
+RESULT_CACHE_AZURE_CONTAINER = os.environ.get("RESULT_CACHE_AZURE_CONTAINER", "")
+# Node classes whose results differ between runs, workflows with them are never cached. They
+# are added to the known ones, see DEFAULT_BYPASS_NODE_TYPES in result_cache.py.
+RESULT_CACHE_BYPASS_NODES = [
+    node_type.strip()
+    for node_type in os.environ.get("RESULT_CACHE_BYPASS_NODES", "").split(",")
+    if node_type.strip()
+]
+# Validate each workflow against the node schema of ComfyUI before uploading and queueing it
+WORKFLOW_VALIDATION = os.environ.get("WORKFLOW_VALIDATION", "true").lower() == "true"
+# Directory of the workflow templates ("<name>.json") that jobs can run by name with "template"
+WORKFLOW_TEMPLATES_DIR = os.environ.get("WORKFLOW_TEMPLATES_DIR", "/workflow_templates")
+# Directory where the node schema (/object_info) is cached between starts of the worker
+OBJECT_INFO_CACHE_DIR = os.environ.get("OBJECT_INFO_CACHE_DIR", "/tmp/runpod-worker-comfy/object-info")
+# Minimum age in seconds of the node schema before a failed validation fetches it again,
+# e.g. because a model was added to the network volume since it was loaded
+OBJECT_INFO_REFRESH_INTERVAL_S = float(os.environ.get("OBJECT_INFO_REFRESH_INTERVAL_S", 60))
+# Snapshot files and the directory of the custom nodes, both change the node schema
+COMFY_SNAPSHOT_GLOB = "/*snapshot*.json"
+COMFY_CUSTOM_NODES_PATH = "/comfyui/custom_nodes"
+# Run a warmup before the worker accepts jobs, so that the first job does not load the models
+WARMUP = os.environ.get("WARMUP", "true").lower() == "true"
+# Workflow (or job input with a "workflow") that is run once during the warmup, empty to skip it
+WARMUP_WORKFLOW = os.environ.get("WARMUP_WORKFLOW", "/test_input.json")
+# Comma separated checkpoints that are loaded into memory during the warmup
+WARMUP_CHECKPOINTS = [
+    checkpoint.strip()
+    for checkpoint in os.environ.get("WARMUP_CHECKPOINTS", "").split(",")
+    if checkpoint.strip()
+]
+# Maximum time in seconds to wait for ComfyUI to start during the warmup
+WARMUP_TIMEOUT_S = float(os.environ.get("WARMUP_TIMEOUT_S", 300))
+# Log of ComfyUI written by start.sh, the import times of the custom nodes are read from it
+COMFY_LOG_PATH = os.environ.get("COMFY_LOG_PATH", "/tmp/comfyui.log")
+# Add the duration of each phase of a job to its result
+RETURN_TIMINGS = os.environ.get("RETURN_TIMINGS", "false").lower() == "true"
+# File the metrics of all jobs are written to in the Prometheus text format, disabled by default
+METRICS_PATH = os.environ.get("METRICS_PATH", "")
+# Port of the /metrics endpoint, served when the API is served locally
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9091))
+# Number of output images that are delivered (uploaded or encoded) at the same time
+COMFY_DELIVERY_CONCURRENCY = max(1, int(os.environ.get("COMFY_DELIVERY_CONCURRENCY", 4)))
+# Stream progress and each output image as soon as it is ready instead of returning one response
+STREAM_OUTPUTS = os.environ.get("STREAM_OUTPUTS", "false").lower() == "true"
+# Number of jobs this worker processes at the same time, one per ComfyUI server by default.
+# Overlapping jobs share COMFY_INPUT_PATH, which is safe because inputs are stored under the
+# hash of their content (see `input_file_name`).
+# A refreshed worker is stopped after each job, so it always runs them one at a time.
+COMFY_JOB_CONCURRENCY = (
+    1 if REFRESH_WORKER else max(1, int(os.environ.get("COMFY_JOB_CONCURRENCY", COMFY_INSTANCES)))
+)
+
+# Phases of the cold start, from start.sh until the first job was queued
+startup_timeline = StartupTimeline()
+startup_timeline.mark("handler_imported")
+_startup_reported = False
+_startup_reported_lock = threading.Lock()
+
+# Timings of all jobs of this worker
+job_metrics = JobMetrics()
+
+# Expected runtime of each workflow fingerprint, to know when to poll for its completion
+runtime_estimates = RuntimeEstimator(alpha=RUNTIME_ESTIMATE_ALPHA)
+
+# The models ComfyUI has loaded, to free its memory between jobs only when needed
+model_memory = ModelMemoryPolicy(COMFY_UNLOAD_ON_MODEL_CHANGE, COMFY_FREE_MEMORY_THRESHOLD)
+
+# Local copies of the models on the network volume
+model_prefetcher = (
+    ModelPrefetcher(
+        MODEL_VOLUME_PATH,
+        MODEL_CACHE_DIR,
+        int(MODEL_CACHE_MAX_GB * 1024**3),
+        min_free_bytes=int(MODEL_CACHE_MIN_FREE_GB * 1024**3),
+        order=MODEL_PREFETCH_ORDER,
+    )
+    if MODEL_PREFETCH
+    else None
+)
+
+# Shared keep-alive client for all requests to ComfyUI
+comfy = ComfyClient(
+    COMFY_HOST,
+    timeout=COMFY_REQUEST_TIMEOUT_S,
+    retries=COMFY_REQUEST_RETRIES,
+    pool_size=max(4, COMFY_JOB_CONCURRENCY * 2),
+)
+job_metrics.add_client(comfy)
+
+# The ComfyUI servers the jobs are dispatched to, if start.sh launches more than one. The
+# first one is `comfy`. Each server saves its outputs below COMFY_OUTPUT_PATH, in a
+# directory named after its port.
+comfy_pool = None
+if COMFY_INSTANCES > 1:
+    comfy_pool = ComfyPool(
+        [ComfyBackend(comfy, str(COMFY_BASE_PORT), model_memory)]
+        + [
+            ComfyBackend(
+                ComfyClient(
+                    f"127.0.0.1:{port}",
+                    timeout=COMFY_REQUEST_TIMEOUT_S,
+                    retries=COMFY_REQUEST_RETRIES,
+                    pool_size=max(4, COMFY_JOB_CONCURRENCY * 2),
+                ),
+                str(port),
+                ModelMemoryPolicy(COMFY_UNLOAD_ON_MODEL_CHANGE, COMFY_FREE_MEMORY_THRESHOLD),
+            )
+            for port in range(COMFY_BASE_PORT + 1, COMFY_BASE_PORT + COMFY_INSTANCES)
+        ],
+        health_check_interval=COMFY_HEALTH_CHECK_INTERVAL_S,
+    )
+    for backend in comfy_pool.backends[1:]:
+        job_metrics.add_client(backend.client)
 
 
 def validate_input(job_input):
@@ -49,96 +278,499 @@ def validate_input(job_input):
         except json.JSONDecodeError:
             return None, "Invalid JSON format in input"
 
-    # Validate 'workflow' in input
+    # Validate 'workflow', 'workflows' or 'template' in input
     workflow = job_input.get("workflow")
-    if workflow is None:
+    workflows = job_input.get("workflows")
+    template_name = job_input.get("template")
+    params = job_input.get("params")
+    if workflow is not None and workflows is not None:
+        return None, "Provide either 'workflow' or 'workflows', not both"
+    if template_name is not None and (workflow is not None or workflows is not None):
+        return None, "Provide either 'template' or a workflow, not both"
+    if params is not None and template_name is None:
+        return None, "'params' can only be given with a 'template'"
+    if template_name is not None:
+        template = get_workflow_templates().get(template_name) if isinstance(template_name, str) else None
+        if template is None:
+            return None, f"Unknown template '{template_name}'"
+        # Only the nodes with a parameter are copied, the rest of the workflow is shared
+        workflow, error_message = template.bind(params)
+        if error_message:
+            return None, error_message
+    elif workflows is not None:
+        if not isinstance(workflows, list) or not workflows or not all(
+            isinstance(item, dict) for item in workflows
+        ):
+            return None, "'workflows' must be a non-empty list of workflows"
+    elif workflow is None:
         return None, "Missing 'workflow' parameter"
+    elif not isinstance(workflow, dict):
+        return None, "'workflow' must be an object with the nodes of the workflow"
 
     # Validate 'images' in input, if provided
     images = job_input.get("images")
     if images is not None:
         if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
+            isinstance(image, dict) and "name" in image and ("image" in image) != ("url" in image)
+            for image in images
         ):
             return (
                 None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
+                "'images' must be a list of objects with 'name' and either 'image' or 'url' keys",
             )
 
+    if workflows is not None:
+        validated_data = {"workflows": workflows, "images": images}
+    else:
+        validated_data = {"workflow": workflow, "images": images}
+    if template_name is not None:
+        validated_data["template"] = template_name
+        validated_data["params"] = params or {}
+
+    # Validate 'transcode' in input, if provided
+    transcode = job_input.get("transcode")
+    if transcode is not None:
+        transcode, error_message = validate_transcode(transcode)
+        if error_message:
+            return None, error_message
+        validated_data["transcode"] = transcode
+
+    # Validate 'cache' in input, if provided
+    cache = job_input.get("cache")
+    if cache is not None:
+        if not isinstance(cache, bool):
+            return None, "'cache' must be true or false"
+        validated_data["cache"] = cache
+
+    # Validate 'timeout' in input, if provided
+    timeout = job_input.get("timeout")
+    if timeout is not None:
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+            return None, "'timeout' must be a positive number of seconds"
+        validated_data["timeout"] = timeout
+
     # Return validated data and no error
-    return {"workflow": workflow, "images": images}, None
+    return validated_data, None
+
+
+def validate_transcode(transcode):
+    """
+    Validates the transcoding settings of a job.
+
+    Args:
+        transcode (str or dict): A format name, or a dictionary with a 'format' and an optional 'quality'
+
+    Returns:
+        tuple: A tuple (settings, error_message), where settings is a dictionary with 'format'
+               and 'quality'. The format "original" disables transcoding.
+    """
+    if isinstance(transcode, str):
+        transcode = {"format": transcode}
+    if not isinstance(transcode, dict):
+        return None, "'transcode' must be a format name or an object with 'format' and 'quality' keys"
+
+    image_format = str(transcode.get("format", "")).lower()
+    if image_format not in TRANSCODE_FORMATS and image_format != "original":
+        return None, f"'transcode.format' must be one of {', '.join(TRANSCODE_FORMATS)} or original"
+    if image_format == "avif" and not features.check("avif"):
+        return None, "'transcode.format' avif is not supported by this worker"
 
+    quality = transcode.get("quality", TRANSCODE_QUALITY)
+    if not isinstance(quality, int) or isinstance(quality, bool) or not 1 <= quality <= 100:
+        return None, "'transcode.quality' must be an integer between 1 and 100"
 
-def check_server(url, retries=500, delay=50):
+    return {"format": image_format, "quality": quality}, None
+
+
+def check_server(retries=500, delay=50, client=None):
     """
-    Check if a server is reachable via HTTP GET request
+    Check if the ComfyUI server is reachable via HTTP GET request
 
     Args:
-    - url (str): The URL to check
     - retries (int, optional): The number of times to attempt connecting to the server. Default is 500
     - delay (int, optional): The time in milliseconds to wait between retries. Default is 50
+    - client (ComfyClient, optional): The server to check, defaults to `comfy`
 
     Returns:
     bool: True if the server is reachable within the given number of retries, otherwise False
     """
+    client = client or comfy
 
     for i in range(retries):
-        try:
-            response = requests.get(url)
-
-            # If the response status code is 200, the server is up and running
-            if response.status_code == 200:
-                print(f"runpod-worker-comfy - API is reachable after {i+1} attempts")
-                return True
-        except requests.RequestException as e:
-            # If an exception occurs, the server may not be ready
-            pass
+        # If the response status code is 200, the server is up and running
+        if client.is_reachable():
+            print(f"runpod-worker-comfy - API is reachable after {i+1} attempts")
+            startup_timeline.mark("comfyui_ready")
+            return True
 
         # Wait for the specified delay before retrying
         time.sleep(delay / 1000)
 
     print(
-        f"runpod-worker-comfy - Failed to connect to server at {url} after {retries} attempts."
+        f"runpod-worker-comfy - Failed to connect to server at {client.base_url} after {retries} attempts."
     )
     return False
 
 
-def upload_images(images):
+class UploadCache:
+    """
+    Remembers which image content already sits in the input directory of ComfyUI.
+
+    Images are tracked by file name and by the SHA-256 of their content, so that an image
+    that was uploaded by a previous job does not have to be uploaded again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._digest_by_name = {}
+        self._name_by_digest = {}
+
+    def lookup(self, name, digest):
+        """
+        Find a file in the input directory that has the given content.
+
+        Args:
+            name (str): The preferred file name
+            digest (str): The SHA-256 of the content
+
+        Returns:
+            str: `name` if it already has this content, another file name with this content, or None
+        """
+        with self._lock:
+            if self._digest_by_name.get(name) == digest:
+                return name
+            return self._name_by_digest.get(digest)
+
+    def add(self, name, digest):
+        """Record that `name` now contains the content with the given SHA-256."""
+        with self._lock:
+            self._forget(name)
+            self._digest_by_name[name] = digest
+            self._name_by_digest.setdefault(digest, name)
+
+    def discard(self, name):
+        """Forget `name`, e.g. because the upload failed or the file was removed."""
+        with self._lock:
+            self._forget(name)
+
+    def names(self):
+        """Returns the names of all files that were uploaded."""
+        with self._lock:
+            return list(self._digest_by_name)
+
+    def _forget(self, name):
+        digest = self._digest_by_name.pop(name, None)
+        if digest is None or self._name_by_digest.get(digest) != name:
+            return
+        del self._name_by_digest[digest]
+        # Keep pointing to another file that has the same content, if there is one
+        for other_name, other_digest in self._digest_by_name.items():
+            if other_digest == digest:
+                self._name_by_digest[digest] = other_name
+                break
+
+
+upload_cache = UploadCache()
+
+# Removes delivered outputs and keeps the input images within COMFY_INPUT_QUOTA_MB
+file_lifecycle = FileLifecycle(int(COMFY_INPUT_QUOTA_MB * 1024 * 1024), COMFY_INPUT_MIN_AGE_S)
+
+_input_cache = None
+_download_clients = {}
+_download_lock = threading.Lock()
+# Shared keep-alive session for the downloads of input images over HTTP(S)
+download_session = requests.Session()
+download_session.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_maxsize=INPUT_DOWNLOAD_CONCURRENCY)
+)
+download_session.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_maxsize=INPUT_DOWNLOAD_CONCURRENCY)
+)
+
+
+def get_input_cache():
+    """
+    Return the cache of downloaded input images, creating it on first use.
+
+    Returns:
+        InputCache: The cache in INPUT_CACHE_DIR
+    """
+    global _input_cache
+    with _download_lock:
+        if _input_cache is None:
+            _input_cache = InputCache(INPUT_CACHE_DIR, INPUT_CACHE_MAX_MB * 1024 * 1024, INPUT_CACHE_TTL_S)
+        return _input_cache
+
+
+def get_fetch(url):
+    """
+    Return the function that downloads a URL, see `InputCache.get`.
+
+    HTTP(S) URLs, including Azure blob URLs with a SAS token, are downloaded directly.
+    "s3://bucket/key" uses the bucket credentials of the S3 delivery (BUCKET_ENDPOINT_URL,
+    BUCKET_ACCESS_KEY_ID, BUCKET_SECRET_ACCESS_KEY) and "azure://container/blob" uses
+    AZURE_STORAGE_CONNECTION_STRING.
+
+    Args:
+        url (str): The URL of an input image
+
+    Returns:
+        callable: The fetch function for the scheme of the URL
+
+    Raises:
+        DownloadError: If the scheme is not supported or its storage is not configured
+    """
+    scheme = urlparse(url).scheme.lower()
+    if scheme in ("http", "https"):
+        return partial(http_fetch, download_session, timeout=INPUT_DOWNLOAD_TIMEOUT_S)
+
+    if scheme == "s3":
+        with _download_lock:
+            if "s3" not in _download_clients:
+                _download_clients["s3"], _ = rp_upload.get_boto_client()
+            client = _download_clients["s3"]
+        if client is None:
+            raise DownloadError(f"{url} needs BUCKET_ENDPOINT_URL, BUCKET_ACCESS_KEY_ID and BUCKET_SECRET_ACCESS_KEY")
+        return partial(s3_fetch, client)
+
+    if scheme == "azure":
+        connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
+        if not connection_string:
+            raise DownloadError(f"{url} needs AZURE_STORAGE_CONNECTION_STRING")
+        with _download_lock:
+            key = ("azure", connection_string)
+            if key not in _download_clients:
+                _download_clients[key] = BlobServiceClient.from_connection_string(connection_string)
+            return partial(azure_fetch, _download_clients[key])
+
+    raise DownloadError(f"{url} has an unsupported scheme, use http(s), s3 or azure")
+
+
+def use_direct_input():
+    """
+    Returns whether input images are written into COMFY_INPUT_PATH instead of being uploaded.
+
+    Returns:
+        bool: True if COMFY_INPUT_MODE allows it and the directory is writable
+    """
+    return (
+        COMFY_INPUT_MODE != "upload"
+        and os.path.isdir(COMFY_INPUT_PATH)
+        and os.access(COMFY_INPUT_PATH, os.W_OK)
+    )
+
+
+def write_input_image(name, blob=None, source_path=None):
+    """
+    Put an input image into COMFY_INPUT_PATH without going through ComfyUI.
+
+    The image is written to a temporary file in the same directory, or hard linked from
+    `source_path`, and then renamed to `name` at once, so that ComfyUI never reads a
+    partial file. A source on another file system is copied instead of linked.
+
+    Args:
+        name (str): The file name of the image, without directories
+        blob (bytes, optional): The content of the image
+        source_path (str, optional): A file with the content of the image, used if `blob` is None
+
+    Raises:
+        OSError: If the image could not be written
+    """
+    if os.path.basename(name) != name or name.startswith("."):
+        raise OSError(f"{name} is not a plain file name")
+
+    staging_path = os.path.join(COMFY_INPUT_PATH, f".{name}.{uuid.uuid4().hex}")
+    try:
+        if blob is not None:
+            with open(staging_path, "wb") as image_file:
+                image_file.write(blob)
+        else:
+            try:
+                os.link(source_path, staging_path)
+            except OSError:
+                shutil.copyfile(source_path, staging_path)
+        os.replace(staging_path, os.path.join(COMFY_INPUT_PATH, name))
+    except OSError:
+        try:
+            os.remove(staging_path)
+        except OSError:
+            pass
+        raise
+
+
+def download_images(images):
+    """
+    Download the input images that are given by 'url', on up to INPUT_DOWNLOAD_CONCURRENCY threads.
+
+    Args:
+        images (list): The input images of the job
+
+    Returns:
+        tuple: A dictionary that maps the names of the downloaded images to the path of
+               their local copy and the SHA-256 of their content, and a list of errors
+    """
+    urls = {image["name"]: image["url"] for image in images if "url" in image}
+    if not urls:
+        return {}, []
+
+    cache = get_input_cache()
+    max_bytes = int(INPUT_DOWNLOAD_MAX_MB * 1024 * 1024)
+
+    def download(name, url):
+        try:
+            return cache.get(url, get_fetch(url), max_bytes), None
+        except (DownloadError, requests.RequestException) as e:
+            return None, f"Error downloading {name}: {str(e)}"
+        except Exception as e:
+            # The S3 and Azure clients raise their own exceptions
+            return None, f"Error downloading {name}: {type(e).__name__}: {str(e)}"
+
+    start = time.monotonic()
+    downloads = {}
+    errors = []
+    workers = min(INPUT_DOWNLOAD_CONCURRENCY, len(urls))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(download, name, url) for name, url in urls.items()}
+        for name, future in futures.items():
+            downloaded, error = future.result()
+            if error:
+                errors.append(error)
+            else:
+                downloads[name] = downloaded
+
+    print(
+        f"runpod-worker-comfy - {len(downloads)} of {len(urls)} image(s) downloaded in "
+        f"{time.monotonic() - start:.2f}s, input cache {cache.stats()}"
+    )
+    return downloads, errors
+
+
+def input_file_name(name, digest):
+    """
+    Returns the name under which an input image is stored in COMFY_INPUT_PATH.
+
+    Args:
+        name (str): The name of the image given in the job input
+        digest (str): The SHA-256 of the content
+
+    Returns:
+        str: The digest with the extension of `name`, ".png" if it has none
+    """
+    extension = os.path.splitext(name)[1].lower()
+    if not extension[1:].isalnum():
+        extension = ".png"
+    return f"{digest}{extension}"
+
+
+def upload_images(images, client=None):
     """
     Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
 
+    Images given by 'url' are downloaded first, see `download_images`. Uploads run in
+    parallel on up to COMFY_UPLOAD_CONCURRENCY threads. Every image is stored under the
+    SHA-256 of its content (see `input_file_name`), so that jobs which run at the same time
+    cannot replace each other's inputs, and its name is returned as an alias of that file.
+    Images whose content already exists in the input directory are not uploaded again.
+
+    If the input directory of ComfyUI is writable (see `use_direct_input`), the images are
+    written into it directly and downloaded images are hard linked from the input cache.
+    /upload/image remains the fallback if that fails.
+
     Args:
-        images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
-        server_address (str): The address of the ComfyUI server.
+        images (list): A list of dictionaries, each containing the 'name' of the image and either
+                       the 'image' as a base64 encoded string or the 'url' to download it from.
+        client (ComfyClient, optional): The server to upload to, defaults to `comfy`. All
+                                        servers of the worker share the input directory.
 
     Returns:
-        list: A list of responses from the server for each image upload.
+        dict: The status, a message, the details for each image and the aliases, a dictionary
+              that maps image names to the stored file names that should be used instead.
     """
     if not images:
-        return {"status": "success", "message": "No images to upload", "details": []}
+        return {"status": "success", "message": "No images to upload", "details": [], "aliases": {}}
 
-    responses = []
+    details = {}
     upload_errors = []
+    aliases = {}
+    pending = {}
+
+    downloads, download_errors = download_images(images)
+    if download_errors:
+        return {
+            "status": "error",
+            "message": "Some images failed to download",
+            "details": download_errors,
+            "aliases": aliases,
+        }
 
     print(f"runpod-worker-comfy - image(s) upload")
 
     for image in images:
         name = image["name"]
-        image_data = image["image"]
-        blob = base64.b64decode(image_data)
+        if name in downloads:
+            # Read from the input cache only if the image has to be uploaded
+            blob = None
+            path, digest = downloads[name]
+        else:
+            blob = base64.b64decode(image["image"])
+            path, digest = None, hashlib.sha256(blob).hexdigest()
+
+        # Jobs that run at the same time share the input directory, so every image is stored
+        # under the hash of its content and the workflow is pointed to that file
+        stored_name = input_file_name(name, digest)
+        aliases[name] = stored_name
+        if upload_cache.lookup(stored_name, digest) == stored_name:
+            # Keep the file from being removed as one of the least recently used inputs
+            file_lifecycle.touch(os.path.join(COMFY_INPUT_PATH, stored_name))
+            details[name] = f"Already uploaded {name}"
+        elif stored_name in pending:
+            # The same content appears twice in this job, upload it only once
+            pending[stored_name][0].append(name)
+        else:
+            pending[stored_name] = ([name], digest, blob, path)
 
-        # Prepare the form data
-        files = {
-            "image": (name, BytesIO(blob), "image/png"),
-            "overwrite": (None, "true"),
-        }
+    direct_input = use_direct_input()
+
+    def upload(stored_name, digest, blob, path):
+        if direct_input:
+            try:
+                write_input_image(stored_name, blob, path)
+                upload_cache.add(stored_name, digest)
+                return None
+            except OSError as e:
+                print(f"runpod-worker-comfy - could not write {stored_name} into {COMFY_INPUT_PATH}, uploading it: {str(e)}")
 
         # POST request to upload the image
-        response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files)
+        try:
+            if blob is None:
+                with open(path, "rb") as image_file:
+                    blob = image_file.read()
+            response = (client or comfy).upload_image(stored_name, blob)
+        except (requests.RequestException, OSError) as e:
+            upload_cache.discard(stored_name)
+            return f"Error uploading {stored_name}: {str(e)}"
+
         if response.status_code != 200:
-            upload_errors.append(f"Error uploading {name}: {response.text}")
-        else:
-            responses.append(f"Successfully uploaded {name}")
+            upload_cache.discard(stored_name)
+            return f"Error uploading {stored_name}: {response.text}"
+
+        upload_cache.add(stored_name, digest)
+        return None
+
+    if pending:
+        workers = min(COMFY_UPLOAD_CONCURRENCY, len(pending))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                stored_name: executor.submit(upload, stored_name, digest, blob, path)
+                for stored_name, (_, digest, blob, path) in pending.items()
+            }
+            for stored_name, future in futures.items():
+                error = future.result()
+                if error:
+                    upload_errors.append(error)
+                else:
+                    for name in pending[stored_name][0]:
+                        details[name] = f"Successfully uploaded {name} as {stored_name}"
 
     if upload_errors:
         print(f"runpod-worker-comfy - image(s) upload with errors")
@@ -146,300 +778,2313 @@ def upload_images(images):
             "status": "error",
             "message": "Some images failed to upload",
             "details": upload_errors,
+            "aliases": aliases,
         }
 
-    print(f"runpod-worker-comfy - image(s) upload complete")
+    print(f"runpod-worker-comfy - image(s) upload complete, {len(pending)} of {len(images)} uploaded")
     return {
         "status": "success",
         "message": "All images uploaded successfully",
-        "details": responses,
+        "details": [details[image["name"]] for image in images if image["name"] in details],
+        "aliases": aliases,
     }
 
 
-def queue_workflow(workflow):
+def apply_image_aliases(workflow, aliases):
     """
-    Queue a workflow to be processed by ComfyUI
+    Point the inputs of a workflow to the stored files of aliased images.
 
     Args:
-        workflow (dict): A dictionary containing the workflow to be processed
+        workflow (dict): The workflow in API format
+        aliases (dict): A mapping from uploaded image names to the file names to use instead
 
     Returns:
-        dict: The JSON response from ComfyUI after processing the workflow
+        dict: The workflow, with every node input that equals an aliased name replaced.
+              Nodes that are not changed are shared with the original workflow.
     """
+    if not aliases or not isinstance(workflow, dict):
+        return workflow
+
+    updated = {}
+    for node_id, node in workflow.items():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        if isinstance(inputs, dict) and any(
+            isinstance(value, str) and value in aliases for value in inputs.values()
+        ):
+            node = {
+                **node,
+                "inputs": {
+                    key: aliases[value] if isinstance(value, str) and value in aliases else value
+                    for key, value in inputs.items()
+                },
+            }
+        updated[node_id] = node
+    return updated
 
-    # The top level element "prompt" is required by ComfyUI
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
 
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+_workflow_validator = None
+_workflow_validator_lock = threading.Lock()
 
 
-def get_history(prompt_id):
+def get_workflow_validator(refresh=False):
     """
-    Retrieve the history of a given prompt using its ID
+    Return the validator for the node schema of ComfyUI, loading the schema on first use.
+
+    The schema is read from OBJECT_INFO_CACHE_DIR if it was cached for the same ComfyUI
+    version and custom nodes, otherwise it is fetched from /object_info and cached.
 
     Args:
-        prompt_id (str): The ID of the prompt whose history is to be retrieved
+        refresh (bool): Fetch the schema from ComfyUI even if it is loaded or cached
 
     Returns:
-        dict: The history of the prompt, containing all the processing steps and results
+        dict: The "validator" and the "loaded_at" time of its schema (None if it came from
+              the cache on disk), or None if the schema is not available
     """
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
-        return json.loads(response.read())
+    global _workflow_validator
+    with _workflow_validator_lock:
+        if not refresh and _workflow_validator and _workflow_validator["host"] == comfy.base_url:
+            return _workflow_validator
+
+        try:
+            system = comfy.get_system_stats().get("system", {})
+            fingerprint = schema_fingerprint(
+                system.get("comfyui_version", "unknown"),
+                glob.glob(COMFY_SNAPSHOT_GLOB),
+                COMFY_CUSTOM_NODES_PATH,
+            )
+            object_info = None if refresh else load_object_info(OBJECT_INFO_CACHE_DIR, fingerprint)
+            loaded_at = None
+            if object_info is None:
+                start = time.monotonic()
+                object_info = comfy.get_object_info()
+                loaded_at = time.monotonic()
+                print(f"runpod-worker-comfy - loaded the schema of {len(object_info)} node classes in {loaded_at - start:.2f}s")
+                store_object_info(OBJECT_INFO_CACHE_DIR, fingerprint, object_info)
+        except (requests.RequestException, ValueError) as e:
+            print(f"runpod-worker-comfy - node schema unavailable, workflows are not validated: {str(e)}")
+            return None
+
+        startup_timeline.mark("node_schema_loaded")
+        _workflow_validator = {
+            "host": comfy.base_url,
+            "validator": WorkflowValidator(object_info),
+            "loaded_at": loaded_at,
+        }
+        return _workflow_validator
 
 
-def base64_encode(img_path):
+_workflow_templates = None
+_workflow_templates_lock = threading.Lock()
+
+
+def get_workflow_templates():
     """
-    Returns base64 encoded image.
+    Return the workflow templates of WORKFLOW_TEMPLATES_DIR, loading them on first use.
+
+    Returns:
+        dict: The templates by name, see `WorkflowTemplate`
+    """
+    global _workflow_templates
+    with _workflow_templates_lock:
+        if _workflow_templates is None:
+            _workflow_templates = load_templates(WORKFLOW_TEMPLATES_DIR)
+            if _workflow_templates:
+                print(f"runpod-worker-comfy - loaded the workflow templates {', '.join(sorted(_workflow_templates))}")
+        return _workflow_templates
+
+
+def validate_workflow_templates():
+    """
+    Validate all workflow templates against the node schema, once, so that jobs that use
+    them only have their parameters checked. Problems are reported and returned to the
+    jobs that use the template.
+    """
+    if not WORKFLOW_VALIDATION:
+        return
+    state = get_workflow_validator()
+    if state is None:
+        return
+    for template in get_workflow_templates().values():
+        for error in template.prepare(state["validator"]):
+            print(f"runpod-worker-comfy - invalid workflow {error}")
+
+
+def load_node_schema():
+    """Wait until ComfyUI is up and load the node schema for the validation of workflows."""
+    if check_server(COMFY_API_AVAILABLE_MAX_RETRIES, COMFY_API_AVAILABLE_INTERVAL_MS):
+        get_workflow_validator()
+        validate_workflow_templates()
+
+
+def validate_workflow(workflow, images=None, template=None):
+    """
+    Validate a workflow against the node schema of ComfyUI, without queueing it.
+
+    A workflow that fails the validation is checked once more against a freshly fetched
+    schema if the loaded one is older than OBJECT_INFO_REFRESH_INTERVAL_S, so that
+    models or nodes that were added in the meantime are not rejected.
 
     Args:
-        img_path (str): The path to the image
+        workflow (dict): The workflow in API format
+        images (list, optional): The input images of the job, their names are valid image choices
+        template (WorkflowTemplate, optional): The template the workflow was bound from. It
+                                               was validated before, only its parameters are checked.
 
     Returns:
-        str: The base64 encoded image
+        list: The problems that were found, empty if the workflow is valid or cannot be checked
     """
-    with open(img_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        return f"{encoded_string}"
+    if not WORKFLOW_VALIDATION:
+        return []
 
+    state = get_workflow_validator()
+    if state is None:
+        return []
 
-def upload_to_azure_blob(job_id, local_image_path):
+    input_files = [image["name"] for image in images or []]
+
+    def validate(validator):
+        if template is not None:
+            return template.validate(validator, workflow, input_files)
+        return validator.validate(workflow, input_files)
+
+    errors = validate(state["validator"])
+    loaded_at = state["loaded_at"]
+    if errors and (loaded_at is None or time.monotonic() - loaded_at > OBJECT_INFO_REFRESH_INTERVAL_S):
+        state = get_workflow_validator(refresh=True)
+        if state is None:
+            return []
+        errors = validate(state["validator"])
+    return errors
+
+
+def queue_workflow(workflow, client_id=None, client=None):
     """
-    Uploads an image to Azure Blob Storage and returns the URL.
+    Queue a workflow to be processed by ComfyUI
 
     Args:
-        job_id (str): The unique identifier for the job.
-        local_image_path (str): The path to the local image file.
+        workflow (dict): A dictionary containing the workflow to be processed
+        client_id (str, optional): The client id of the WebSocket that should receive the execution events
+        client (ComfyClient, optional): The server to queue the workflow on, defaults to `comfy`
 
     Returns:
-        str: URL to the uploaded image in Azure Blob Storage.
+        dict: The JSON response from ComfyUI after processing the workflow
     """
-    try:
-        # Get connection details from environment variables
-        connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
-        container_name = os.environ.get("AZURE_STORAGE_CONTAINER_NAME", "comfyui-images")
-        
-        # Create a unique name for the blob using job_id and file name
-        file_name = os.path.basename(local_image_path)
-        blob_name = f"{job_id}/{file_name}"
-
-        # Create the BlobServiceClient object
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        
-        # Get container client and create container if it doesn't exist
-        container_client = blob_service_client.get_container_client(container_name)
-        if not container_client.exists():
-            container_client.create_container()
-        
-        # Create a blob client
-        blob_client = blob_service_client.get_blob_client(
-            container=container_name, 
-            blob=blob_name
-        )
-        
-        # Upload the file
-        with open(local_image_path, "rb") as data:
-            blob_client.upload_blob(data, overwrite=True)
-        
-        # Return the URL to the blob
-        return blob_client.url
-    
-    except Exception as e:
-        print(f"runpod-worker-comfy - Error uploading to Azure Blob Storage: {str(e)}")
-        # Return None to indicate failure
-        return None
+    return (client or comfy).queue_prompt(workflow, client_id)
+
 
-def process_output_images(outputs, job_id):
+def get_history(prompt_id, client=None):
     """
-    This function takes the "outputs" from image generation and the job ID,
-    then determines the correct way to return the images, either as direct URLs
-    to an AWS S3 bucket, Azure Blob Storage, or as base64 encoded strings, 
-    depending on the environment configuration.
+    Retrieve the history of a given prompt using its ID
 
     Args:
-        outputs (dict): A dictionary containing the outputs from image generation,
-                        typically includes node IDs and their respective output data.
-        job_id (str): The unique identifier for the job.
+        prompt_id (str): The ID of the prompt whose history is to be retrieved
+        client (ComfyClient, optional): The server the prompt was queued on, defaults to `comfy`
 
     Returns:
-        dict: A dictionary with the status ('success' or 'error') and the message,
-              which is a list of dictionaries containing node_id, imageType ('url' or 'base64'),
-              and the image data. In case of error, the message contains an error description.
-
-    The function works as follows:
-    - It first determines the output path for the images from an environment variable,
-      defaulting to "/comfyui/output" if not set.
-    - It then iterates through the outputs to find the filenames of the generated images.
-    - For each image found, it checks if it exists in the output folder.
-    - If the image exists, it checks if cloud storage is configured.
-    - If Azure Blob Storage is preferred and configured, it uploads the image to Azure and adds the URL to the results.
-    - If AWS S3 is configured, it uploads the image to the bucket and adds the URL to the results.
-    - If no cloud storage is configured, it encodes the image in base64 and adds the string to the results.
-    - If any image file does not exist in the output folder, it adds an error for that specific image.
-    - Returns a list of all processed images with their node_id and image data.
+        dict: The history of the prompt, containing all the processing steps and results
     """
+    return (client or comfy).get_history(prompt_id)
 
-    # The path where ComfyUI stores the generated images
-    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
-    
-    # List to collect all image results
-    image_results = []
-    errors = []
 
-    print(f"runpod-worker-comfy - image generation is done")
+class ComfyExecutionError(Exception):
+    """Raised when ComfyUI reports that the execution of a prompt failed or was interrupted."""
 
-    # Process each node and its images
-    for node_id, node_output in outputs.items():
-        if "images" in node_output:
-            for image in node_output["images"]:
-                # Construct the image path
-                image_path = os.path.join(image["subfolder"], image["filename"])
-                local_image_path = f"{COMFY_OUTPUT_PATH}/{image_path}"
-                
-                print(f"runpod-worker-comfy - processing: {local_image_path}")
-                
-                # Check if the image file exists
-                if os.path.exists(local_image_path):
-                    # Get the preferred image return method from environment variable
-                    # Possible values: "azure", "s3", "base64" (default)
-                    image_return_method = os.environ.get("IMAGE_RETURN_METHOD", "base64").lower()
-                    
-                    if image_return_method == "azure" and os.environ.get("AZURE_STORAGE_CONNECTION_STRING"):
-                        # Upload to Azure Blob Storage
-                        image_data = upload_to_azure_blob(job_id, local_image_path)
-                        if image_data:
-                            image_type = "url"
-                            print(f"runpod-worker-comfy - image from node {node_id} uploaded to Azure Blob Storage")
-                        else:
-                            # Fallback if Azure upload fails
-                            if os.environ.get("BUCKET_ENDPOINT_URL", False):
-                                image_data = rp_upload.upload_image(job_id, local_image_path)
-                                image_type = "url"
-                                print(f"runpod-worker-comfy - Azure upload failed, image from node {node_id} falling back to AWS S3")
-                            else:
-                                image_data = base64_encode(local_image_path)
-                                image_type = "base64"
-                                print(f"runpod-worker-comfy - Azure upload failed, image from node {node_id} falling back to base64")
-                    elif image_return_method == "s3" and os.environ.get("BUCKET_ENDPOINT_URL", False):
-                        # Upload to AWS S3
-                        image_data = rp_upload.upload_image(job_id, local_image_path)
-                        image_type = "url"
-                        print(f"runpod-worker-comfy - image from node {node_id} uploaded to AWS S3")
-                    elif image_return_method in ["azure", "s3"]:
-                        # User requested cloud storage but it's not configured, fall back to base64
-                        image_data = base64_encode(local_image_path)
-                        image_type = "base64"
-                        print(f"runpod-worker-comfy - {image_return_method} was requested but not configured, image from node {node_id} falling back to base64")
-                    else:
-                        # Use base64 (default)
-                        image_data = base64_encode(local_image_path)
-                        image_type = "base64"
-                        print(f"runpod-worker-comfy - image from node {node_id} converted to base64")
-                    
-                    # Add this image to our results
-                    image_results.append({
-                        "node_id": node_id,
-                        "imageType": image_type,
-                        "image": image_data
-                    })
-                else:
-                    error_msg = f"Image does not exist in the specified output folder: {local_image_path}"
-                    print(f"runpod-worker-comfy - {error_msg}")
-                    errors.append({
-                        "node_id": node_id,
-                        "error": error_msg
-                    })
 
-    # Return the results
-    if image_results:
-        return {
-            "status": "success",
-            "message": image_results,  # Keep the "message" field for backward compatibility
-            "errors": errors if errors else []
-        }
-    else:
-        return {
-            "status": "error",
-            "message": "No images were successfully generated or found",
-            "errors": errors
-        }
+def execution_error_message(event_type, data):
+    """
+    Describe why the execution of a prompt failed
 
+    Args:
+        event_type (str): "execution_error" or "execution_interrupted"
+        data (dict): The data of the event, or of the message in the history
 
-def handler(job):
+    Returns:
+        str: The error message
     """
-    The main function that handles a job of generating images.
+    if event_type == "execution_interrupted":
+        return "execution was interrupted"
+    return (
+        f"node {data.get('node_id')} ({data.get('node_type')}) failed: "
+        f"{data.get('exception_message', 'unknown error')}"
+    )
 
-    This function validates the input, sends a prompt to ComfyUI for processing,
-    polls ComfyUI for result, and retrieves generated images.
+
+def get_history_error(history_entry):
+    """
+    Returns why a prompt failed according to its history
 
     Args:
-        job (dict): A dictionary containing job details and input parameters.
+        history_entry (dict): The history of the prompt
 
     Returns:
-        dict: A dictionary containing either an error message or a success status with a message field
-              that contains a list of generated images. Each image is represented as a dictionary with 
-              node_id, imageType, and image data (either URL or base64).
+        str: The error message, or None if the prompt did not fail
     """
-    job_input = job["input"]
+    status = history_entry.get("status") or {}
+    if status.get("status_str") != "error":
+        return None
+    for event_type, data in status.get("messages", []):
+        if event_type in ("execution_error", "execution_interrupted"):
+            return execution_error_message(event_type, data)
+    return "execution failed"
 
-    # Make sure that the input is valid
-    validated_data, error_message = validate_input(job_input)
-    if error_message:
-        return {"error": error_message}
 
-    # Extract validated data
-    workflow = validated_data["workflow"]
-    images = validated_data.get("images")
+def cancel_prompts(prompt_ids, client=None):
+    """
+    Remove prompts from the queue of ComfyUI, or interrupt them if they are running
 
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    )
+    The pending prompts are removed first, so that none of them starts when the running
+    one is interrupted. Prompts that already finished are left alone.
 
-    # Upload images if they exist
-    upload_result = upload_images(images)
+    Args:
+        prompt_ids (list): The IDs of the prompts
+        client (ComfyClient, optional): The server the prompts were queued on, defaults to `comfy`
+    """
+    if not prompt_ids:
+        return
+    client = client or comfy
+    ours = set(prompt_ids)
+    try:
+        queue = client.get_queue()
+        pending = [entry[1] for entry in queue.get("queue_pending", []) if entry[1] in ours]
+        running = [entry[1] for entry in queue.get("queue_running", []) if entry[1] in ours]
+        if pending:
+            client.delete_from_queue(pending)
+        for prompt_id in running:
+            client.interrupt(prompt_id)
+    except requests.RequestException as e:
+        print(f"runpod-worker-comfy - could not cancel prompts {prompt_ids}: {str(e)}")
+        return
+    if pending or running:
+        print(f"runpod-worker-comfy - removed {len(pending)} pending prompt(s) and interrupted {len(running)}")
+
+
+class JobDeadline:
+    """
+    The time a job may take, and the prompts it has queued in ComfyUI.
 
-    if upload_result["status"] == "error":
-        return upload_result
+    When the deadline passes or the job is cancelled, its prompts are removed from the
+    queue of ComfyUI and interrupted, so that the next job gets the GPU right away
+    instead of after the work nobody waits for anymore.
 
-    # Queue the workflow
-    try:
-        queued_workflow = queue_workflow(workflow)
-        prompt_id = queued_workflow["prompt_id"]
-        print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
-    except Exception as e:
-        return {"error": f"Error queuing workflow: {str(e)}"}
+    Args:
+        timeout (float, optional): Seconds from now until the deadline, None for no deadline
+    """
 
-    # Poll for completion
-    print(f"runpod-worker-comfy - wait until image generation is complete")
-    retries = 0
-    try:
-        while retries < COMFY_POLLING_MAX_RETRIES:
-            history = get_history(prompt_id)
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.expires_at = float("inf") if timeout is None else time.monotonic() + timeout
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._prompt_ids = []
+        self._ws = None
+        self._client = None
+
+    def limit(self, deadline):
+        """Returns the earlier of `deadline`, a time.monotonic(), and the deadline of the job."""
+        return min(deadline, self.expires_at)
+
+    def expired(self):
+        """Whether the job was cancelled or its deadline passed."""
+        return self.cancelled.is_set() or time.monotonic() >= self.expires_at
+
+    def track(self, prompt_ids, ws=None, client=None):
+        """Remember the prompts of the job, the WebSocket that receives their events and the server they run on."""
+        with self._lock:
+            self._prompt_ids.extend(prompt_id for prompt_id in prompt_ids if prompt_id)
+            self._ws = ws
+            self._client = client
+
+    def error(self):
+        """Returns the error of a job that stopped waiting for its prompts."""
+        if self.cancelled.is_set():
+            return "Job was cancelled"
+        if time.monotonic() >= self.expires_at:
+            return f"Job did not finish within its timeout of {self.timeout:g} seconds"
+        return f"Image generation did not finish within {COMFY_EXECUTION_TIMEOUT_S:g} seconds"
+
+    def abort(self):
+        """Remove the prompts of the job from ComfyUI, e.g. because the deadline passed."""
+        with self._lock:
+            prompt_ids = list(self._prompt_ids)
+            client = self._client
+        cancel_prompts(prompt_ids, client)
+
+    def cancel(self):
+        """Stop waiting for the prompts of the job and remove them from ComfyUI."""
+        self.cancelled.set()
+        with self._lock:
+            ws = self._ws
+        try:
+            # Wake up the thread that waits for an event, closing the socket would not
+            ws.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        self.abort()
 
-            # Exit the loop if we have found the history
-            if prompt_id in history and history[prompt_id].get("outputs"):
-                break
-            else:
-                # Wait before trying again
-                time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
-        else:
-            return {"error": "Max retries reached while waiting for image generation"}
-    except Exception as e:
-        return {"error": f"Error waiting for image generation: {str(e)}"}
 
-    # Get the generated images and return them as URLs in an AWS bucket or as base64
-    images_result = process_output_images(history[prompt_id].get("outputs"), job["id"])
+# Deadlines of the running jobs by job ID, so that a cancelled job can stop its prompts
+_job_deadlines = {}
+_job_deadlines_lock = threading.Lock()
 
-    # Add refresh_worker flag to the result
-    result = {**images_result, "refresh_worker": REFRESH_WORKER}
 
-    return result
+def start_job_deadline(job_id, validated_data):
+    """
+    Start the deadline of a job, its "timeout" or COMFY_JOB_TIMEOUT_S from now
 
+    Args:
+        job_id (str): The ID of the job
+        validated_data (dict): The input of the job, as returned by `validate_input`.
 
-# Start the handler only if this script is run directly
-if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    Returns:
+        JobDeadline: The deadline, which `cancel_job` finds by the ID of the job
+    """
+    deadline = JobDeadline(validated_data.get("timeout") or COMFY_JOB_TIMEOUT_S or None)
+    with _job_deadlines_lock:
+        _job_deadlines[job_id] = deadline
+    return deadline
+
+
+def finish_job(job_id):
+    """Forget the deadline of a job that has returned."""
+    with _job_deadlines_lock:
+        _job_deadlines.pop(job_id, None)
+
+
+def cancel_job(job_id):
+    """
+    Stop a job that nobody waits for anymore, e.g. because RunPod cancelled it
+
+    Args:
+        job_id (str): The ID of the job
+    """
+    with _job_deadlines_lock:
+        deadline = _job_deadlines.pop(job_id, None)
+    if deadline is not None:
+        print(f"runpod-worker-comfy - job {job_id} was cancelled, stopping its prompts")
+        deadline.cancel()
+
+
+def open_websocket(client_id, client=None):
+    """
+    Open a WebSocket connection to ComfyUI that receives the execution events of `client_id`
+
+    Args:
+        client_id (str): The client id that is also used when queueing the workflow
+        client (ComfyClient, optional): The server to connect to, defaults to `comfy`
+
+    Returns:
+        websocket.WebSocket: The open connection, or None if ComfyUI could not be reached
+    """
+    try:
+        return (client or comfy).open_websocket(client_id, timeout=COMFY_WEBSOCKET_CONNECT_TIMEOUT_S)
+    except (websocket.WebSocketException, OSError) as e:
+        print(f"runpod-worker-comfy - websocket not available ({e}), using polling instead")
+        return None
+
+
+def iter_prompt_events(ws, prompt_id, timeout):
+    """
+    Yield the WebSocket events that belong to a prompt until its execution has finished
+
+    Binary messages (live previews) and events of other prompts are skipped.
+
+    Args:
+        ws (websocket.WebSocket): An open connection created by `open_websocket`
+        prompt_id (str): The ID of the prompt to follow
+        timeout (float): The maximum time in seconds to wait for the prompt to finish
+
+    Yields:
+        dict: The decoded event, with a "type" and a "data" key
+
+    Raises:
+        ComfyExecutionError: If ComfyUI reports an error or an interruption for the prompt
+        websocket.WebSocketException: If the connection is lost or nothing arrives before the timeout
+    """
+    deadline = time.monotonic() + timeout
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise websocket.WebSocketTimeoutException(
+                f"prompt {prompt_id} did not finish within {timeout} seconds"
+            )
+        ws.settimeout(remaining)
+
+        message = ws.recv()
+        if not isinstance(message, str):
+            continue
+
+        event = json.loads(message)
+        data = event.get("data") or {}
+        if data.get("prompt_id") != prompt_id:
+            continue
+
+        yield event
+
+        event_type = event.get("type")
+        if event_type in ("execution_error", "execution_interrupted"):
+            raise ComfyExecutionError(execution_error_message(event_type, data))
+        if event_type == "execution_success" or (
+            event_type == "executing" and data.get("node") is None
+        ):
+            return
+
+
+def poll_history(prompt_id, deadline=None, estimate=None, queued_at=None, cancelled=None, client=None):
+    """
+    Poll the history of a prompt until it contains outputs
+
+    The first request is sent right away. After that, the poller sleeps until shortly
+    before the expected finish of the prompt and then polls every COMFY_POLLING_MIN_INTERVAL_MS,
+    backing off to COMFY_POLLING_INTERVAL_MS the longer the prompt runs over.
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        deadline (float, optional): The time.monotonic() after which to give up,
+                                    defaults to COMFY_EXECUTION_TIMEOUT_S from now
+        estimate (float, optional): The expected runtime of the prompt in seconds
+        queued_at (float, optional): The time.monotonic() when the prompt was queued, defaults to now
+        cancelled (threading.Event, optional): Stops the polling when it is set
+        client (ComfyClient, optional): The server the prompt was queued on, defaults to `comfy`
+
+    Returns:
+        dict: The history of the prompt, or None if the deadline passed or the polling was cancelled
+
+    Raises:
+        ComfyExecutionError: If the history shows that the execution failed
+    """
+    now = time.monotonic()
+    queued_at = now if queued_at is None else queued_at
+    deadline = now + COMFY_EXECUTION_TIMEOUT_S if deadline is None else deadline
+    while True:
+        history = get_history(prompt_id, client)
+
+        # Exit the loop if we have found the history
+        if prompt_id in history and history[prompt_id].get("outputs"):
+            return history
+        if prompt_id in history:
+            error = get_history_error(history[prompt_id])
+            if error:
+                raise ComfyExecutionError(error)
+
+        now = time.monotonic()
+        if now >= deadline:
+            return None
+
+        # Wait before trying again
+        delay = next_poll_delay(
+            now - queued_at, estimate, COMFY_POLLING_MIN_INTERVAL_MS / 1000, COMFY_POLLING_INTERVAL_MS / 1000
+        )
+        if cancelled is None:
+            time.sleep(min(delay, deadline - now))
+        elif cancelled.wait(min(delay, deadline - now)):
+            return None
+
+
+def get_runtime_estimate(workflow):
+    """
+    Look up the expected runtime of a workflow
+
+    Args:
+        workflow (dict): The workflow in API format, or None
+
+    Returns:
+        tuple: The fingerprint of the workflow and its expected runtime in seconds,
+               which is None for a workflow that did not run before
+    """
+    if not workflow:
+        return None, None
+    fingerprint = workflow_fingerprint(workflow)
+    estimate = runtime_estimates.estimate(fingerprint)
+    if estimate is not None:
+        print(f"runpod-worker-comfy - expecting the workflow to finish in {estimate:.2f} s")
+    return fingerprint, estimate
+
+
+def record_runtime(fingerprint, prompt_id, history, queued_at):
+    """
+    Add the runtime of a finished prompt to the estimate of its workflow
+
+    The runtime is taken from the timestamps ComfyUI records in the history and
+    otherwise measured from the time the prompt was queued.
+
+    Args:
+        fingerprint (str): The fingerprint of the workflow, or None to record nothing
+        prompt_id (str): The ID of the prompt
+        history (dict): The history of the prompt, or None if it did not finish
+        queued_at (float): The time.monotonic() when the prompt was queued
+    """
+    if fingerprint is None or history is None:
+        return
+    seconds = execution_seconds(history[prompt_id])
+    if seconds is None:
+        seconds = time.monotonic() - queued_at
+    runtime_estimates.observe(fingerprint, seconds)
+
+
+def await_completion_event(ws, prompt_id, deadline, timings=None):
+    """
+    Wait for the event that a prompt has finished on the WebSocket
+
+    Args:
+        ws (websocket.WebSocket): The connection that was opened before queueing the prompt
+        prompt_id (str): The ID of the prompt to wait for
+        deadline (float): The time.monotonic() after which to stop waiting
+        timings (JobTimings, optional): Records when the execution started
+
+    Returns:
+        bool: True if the prompt finished, False if the connection dropped or timed out,
+              the history has to be polled then
+
+    Raises:
+        ComfyExecutionError: If ComfyUI reports that the execution failed
+    """
+    try:
+        for event in iter_prompt_events(ws, prompt_id, deadline - time.monotonic()):
+            if timings is not None and event["type"] == "execution_start":
+                timings.mark("execution_start")
+        return True
+    except (websocket.WebSocketException, OSError) as e:
+        print(f"runpod-worker-comfy - websocket lost ({e}), falling back to polling")
+        return False
+
+
+def wait_for_prompt(prompt_id, ws=None, timings=None, workflow=None, job_deadline=None, client=None):
+    """
+    Wait until ComfyUI has finished a prompt and return its history
+
+    When a WebSocket is given, the completion event is awaited on it. If the connection
+    drops or times out, this falls back to polling the /history endpoint, timed by the
+    expected runtime of the workflow. Either way, the prompt may run for at most
+    COMFY_EXECUTION_TIMEOUT_S, and not beyond the deadline of its job.
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        ws (websocket.WebSocket, optional): The connection that was opened before queueing the prompt
+        timings (JobTimings, optional): Records when the execution started and ended, and the
+                                        time spent fetching the history (which includes the
+                                        wait when there are no WebSocket events)
+        workflow (dict, optional): The workflow of the prompt. Its runtime is estimated from
+                                   earlier runs and recorded for later runs.
+        job_deadline (JobDeadline, optional): The deadline of the job
+        client (ComfyClient, optional): The server the prompt was queued on, defaults to `comfy`
+
+    Returns:
+        dict: The history of the prompt, or None if COMFY_EXECUTION_TIMEOUT_S or the deadline
+              of the job passed, or the job was cancelled
+
+    Raises:
+        ComfyExecutionError: If ComfyUI reports that the execution failed
+    """
+    queued_at = time.monotonic()
+    if job_deadline is None:
+        job_deadline = JobDeadline()
+    deadline = job_deadline.limit(queued_at + COMFY_EXECUTION_TIMEOUT_S)
+    fingerprint, estimate = get_runtime_estimate(workflow)
+
+    if ws is not None:
+        try:
+            if await_completion_event(ws, prompt_id, deadline, timings) and timings is not None:
+                timings.mark("execution_end")
+        finally:
+            ws.close()
+
+    # After a completion event the history is available right away, so this returns on the first request
+    if timings is None:
+        history = poll_history(prompt_id, deadline, estimate, queued_at, job_deadline.cancelled, client)
+    else:
+        with timings.measure("history"):
+            history = poll_history(prompt_id, deadline, estimate, queued_at, job_deadline.cancelled, client)
+    record_runtime(fingerprint, prompt_id, history, queued_at)
+    return history
+
+
+def base64_encode(img_path):
+    """
+    Returns base64 encoded image.
+
+    The file is read and encoded in chunks of BASE64_CHUNK_SIZE bytes, so the raw
+    content of the file is never held in memory next to the encoded string.
+
+    Args:
+        img_path (str): The path to the image
+
+    Returns:
+        str: The base64 encoded image
+    """
+    encoded = bytearray()
+    with open(img_path, "rb") as image_file:
+        while chunk := image_file.read(BASE64_CHUNK_SIZE):
+            encoded += base64.b64encode(chunk)
+    return encoded.decode("ascii")
+
+
+def base64_encoded_size(img_path):
+    """
+    Returns the length of the base64 encoding of a file, without encoding it.
+
+    Args:
+        img_path (str): The path to the image
+
+    Returns:
+        int: The number of base64 characters
+    """
+    return 4 * ((os.path.getsize(img_path) + 2) // 3)
+
+
+class ResponseBudget:
+    """
+    Tracks how many bytes of base64 encoded images the response of a job may still contain.
+
+    Args:
+        limit (int): The maximum number of base64 characters in the response
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        Reserve room for an encoded image.
+
+        Args:
+            size (int): The number of base64 characters of the image
+
+        Returns:
+            bool: True if the image fits into the remaining budget
+        """
+        with self._lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+
+class AzureBlobUploader:
+    """
+    Long-lived uploader for one Azure Blob Storage container.
+
+    The BlobServiceClient (and with it the connection pool) is created once and reused for
+    every image, and the container is checked (and created) only before the first upload.
+    Files larger than `max_single_put_size` are uploaded as blocks of `max_block_size`,
+    `max_concurrency` blocks at a time.
+
+    Args:
+        connection_string (str): The Azure Storage connection string
+        container_name (str): The container that receives the images
+        max_block_size (int): Size in bytes of each block of a chunked upload
+        max_single_put_size (int): Files up to this size in bytes are uploaded with a single request
+        max_concurrency (int): Number of blocks of one file that are uploaded at the same time
+        client_factory (callable, optional): Creates the service client from the connection string
+                                             and the size settings, e.g. to use a local stand-in
+    """
+
+    def __init__(
+        self,
+        connection_string,
+        container_name,
+        max_block_size=4 * 1024 * 1024,
+        max_single_put_size=8 * 1024 * 1024,
+        max_concurrency=4,
+        client_factory=None,
+    ):
+        self.container_name = container_name
+        self.max_concurrency = max_concurrency
+
+        client_factory = client_factory or BlobServiceClient.from_connection_string
+        self.service_client = client_factory(
+            connection_string,
+            max_block_size=max_block_size,
+            max_single_put_size=max_single_put_size,
+        )
+        self._container_ready = False
+        self._lock = threading.Lock()
+
+    def _ensure_container(self):
+        with self._lock:
+            if self._container_ready:
+                return
+            container_client = self.service_client.get_container_client(self.container_name)
+            if not container_client.exists():
+                container_client.create_container()
+            self._container_ready = True
+
+    def upload(self, blob_name, local_path):
+        """
+        Upload a file, replacing an existing blob with the same name.
+
+        Args:
+            blob_name (str): The name of the blob in the container
+            local_path (str): The path to the local file
+
+        Returns:
+            dict: The "url" of the blob, the uploaded "bytes" and the upload time in "seconds"
+        """
+        start = time.monotonic()
+        self._ensure_container()
+
+        blob_client = self.service_client.get_blob_client(
+            container=self.container_name,
+            blob=blob_name
+        )
+        size = os.path.getsize(local_path)
+        with open(local_path, "rb") as data:
+            blob_client.upload_blob(
+                data, overwrite=True, length=size, max_concurrency=self.max_concurrency
+            )
+
+        return {
+            "url": blob_client.url,
+            "bytes": size,
+            "seconds": round(time.monotonic() - start, 4),
+        }
+
+
+_azure_uploaders = {}
+_azure_uploaders_lock = threading.Lock()
+
+
+def get_azure_uploader(connection_string, container_name):
+    """
+    Return the process-wide uploader for a container, creating it on first use.
+
+    Args:
+        connection_string (str): The Azure Storage connection string
+        container_name (str): The container that receives the images
+
+    Returns:
+        AzureBlobUploader: The uploader for this connection string and container
+    """
+    key = (connection_string, container_name)
+    with _azure_uploaders_lock:
+        uploader = _azure_uploaders.get(key)
+        if uploader is None:
+            uploader = AzureBlobUploader(
+                connection_string,
+                container_name,
+                max_block_size=AZURE_UPLOAD_BLOCK_SIZE_MB * 1024 * 1024,
+                max_single_put_size=AZURE_UPLOAD_SINGLE_PUT_SIZE_MB * 1024 * 1024,
+                max_concurrency=AZURE_UPLOAD_CONCURRENCY,
+            )
+            _azure_uploaders[key] = uploader
+        return uploader
+
+
+def upload_to_azure_blob(job_id, local_image_path):
+    """
+    Uploads an image to Azure Blob Storage.
+
+    Args:
+        job_id (str): The unique identifier for the job.
+        local_image_path (str): The path to the local image file.
+
+    Returns:
+        dict: The "url" of the blob, the uploaded "bytes" and the upload time in "seconds",
+              or the "error" and the "seconds" until it failed.
+    """
+    # Get connection details from environment variables
+    connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
+    container_name = os.environ.get("AZURE_STORAGE_CONTAINER_NAME", "comfyui-images")
+
+    # Create a unique name for the blob using job_id and file name
+    file_name = os.path.basename(local_image_path)
+    blob_name = f"{job_id}/{file_name}"
+
+    start = time.monotonic()
+    try:
+        result = get_azure_uploader(connection_string, container_name).upload(blob_name, local_image_path)
+    except Exception as e:
+        seconds = round(time.monotonic() - start, 4)
+        print(f"runpod-worker-comfy - Error uploading {blob_name} to Azure Blob Storage after {seconds}s: {str(e)}")
+        return {"error": f"Error uploading {blob_name} to Azure Blob Storage: {str(e)}", "seconds": seconds}
+
+    print(
+        f"runpod-worker-comfy - uploaded {blob_name} to Azure Blob Storage "
+        f"({result['bytes']} bytes in {result['seconds']}s)"
+    )
+    return result
+
+
+_transcode_pool = None
+_transcode_pool_lock = threading.Lock()
+
+
+def get_transcode_pool():
+    """
+    Return the process pool for transcoding, creating it on first use.
+
+    The processes are started from a fork server instead of being forked from the handler,
+    which runs threads that may hold locks at the time of the fork and leave them locked in
+    the child. The fork server imports `image_transcoder` once for all of them.
+
+    Returns:
+        ProcessPoolExecutor: The pool with TRANSCODE_WORKERS processes
+    """
+    global _transcode_pool
+    with _transcode_pool_lock:
+        if _transcode_pool is None:
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["image_transcoder"])
+            _transcode_pool = ProcessPoolExecutor(max_workers=TRANSCODE_WORKERS, mp_context=context)
+        return _transcode_pool
+
+
+def get_transcoded_path(local_image_path, transcode):
+    """
+    Returns where `transcode_output` puts the re-encoded copy of an image.
+
+    Args:
+        local_image_path (str): The path to the generated image
+        transcode (dict): The settings, with 'format' and 'quality'
+
+    Returns:
+        str: The path next to the original, or None if the image is not re-encoded
+    """
+    image_format = transcode["format"]
+    if image_format == "original":
+        return None
+
+    extension = "jpg" if image_format == "jpeg" else image_format
+    root, original_extension = os.path.splitext(local_image_path)
+    if original_extension.lower().lstrip(".") in (extension, image_format):
+        return None
+    return f"{root}.{extension}"
+
+
+def transcode_output(local_image_path, transcode):
+    """
+    Re-encode a generated image next to the original, using the transcoding process pool.
+
+    The re-encoded copy replaces an existing one at once, so that a reader never sees a
+    partial file.
+
+    Args:
+        local_image_path (str): The path to the generated image
+        transcode (dict): The settings, with 'format' and 'quality'
+
+    Returns:
+        str: The path to the re-encoded image, or the original path if the format is "original",
+             the image already has the requested format or transcoding failed
+    """
+    transcoded_path = get_transcoded_path(local_image_path, transcode)
+    if transcoded_path is None:
+        return local_image_path
+
+    image_format = transcode["format"]
+    # Write a temporary file and rename it at once, as jobs that are answered from the result
+    # cache may transcode the same image at the same time
+    directory, name = os.path.split(transcoded_path)
+    staging_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}")
+    try:
+        get_transcode_pool().submit(
+            transcode_image, local_image_path, staging_path, image_format, transcode["quality"]
+        ).result()
+        os.replace(staging_path, transcoded_path)
+        return transcoded_path
+    except Exception as e:
+        print(f"runpod-worker-comfy - transcoding {local_image_path} to {image_format} failed, using the original: {str(e)}")
+        try:
+            os.remove(staging_path)
+        except OSError:
+            pass
+        return local_image_path
+
+
+def encode_or_offload(node_id, local_image_path, job_id, budget, allow_azure=True, fits=None):
+    """
+    Encode an image in base64, or upload it if it does not fit into the response budget.
+
+    Args:
+        node_id (str): The ID of the node that generated the image
+        local_image_path (str): The path to the image file
+        job_id (str): The unique identifier for the job.
+        budget (ResponseBudget): The remaining base64 budget of the response, None for no limit
+        allow_azure (bool): Whether Azure may be used for offloading, False after an Azure upload failed
+        fits (bool, optional): Whether room for the image was already reserved in `budget`,
+                               None to reserve it now
+
+    Returns:
+        tuple: A tuple (image_type, image_data, offloaded, fallback), see `deliver_image`, or None
+               if the image does not fit into the budget and no storage is configured to offload it to
+    """
+    if fits is None:
+        fits = budget is None or budget.reserve(base64_encoded_size(local_image_path))
+    if fits:
+        return "base64", base64_encode(local_image_path), False, None
+
+    print(f"runpod-worker-comfy - image from node {node_id} exceeds the response size budget, offloading it")
+    image_data = None
+    fallback = None
+    if allow_azure and os.environ.get("AZURE_STORAGE_CONNECTION_STRING"):
+        upload = upload_to_azure_blob(job_id, local_image_path)
+        image_data = upload.get("url")
+        if image_data is None:
+            fallback = {"from": "azure", "error": upload["error"]}
+    if image_data is None and os.environ.get("BUCKET_ENDPOINT_URL", False):
+        image_data = rp_upload.upload_image(job_id, local_image_path)
+    if image_data is None:
+        return None
+    return "url", image_data, True, fallback
+
+
+def uses_response_budget():
+    """
+    Returns whether images are delivered in base64 as long as they fit into the response budget.
+
+    Returns:
+        bool: False if IMAGE_RETURN_METHOD is a storage that is configured
+    """
+    image_return_method = os.environ.get("IMAGE_RETURN_METHOD", "base64").lower()
+    if image_return_method == "azure":
+        return not os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
+    if image_return_method == "s3":
+        return not os.environ.get("BUCKET_ENDPOINT_URL", False)
+    return True
+
+
+def deliver_image(node_id, local_image_path, job_id, budget=None, fits=None):
+    """
+    Deliver a single generated image with the configured return method.
+
+    Args:
+        node_id (str): The ID of the node that generated the image
+        local_image_path (str): The path to the image file
+        job_id (str): The unique identifier for the job.
+        budget (ResponseBudget, optional): The remaining base64 budget of the response
+        fits (bool, optional): Whether room for the image was already reserved in `budget`,
+                               see `encode_or_offload`
+
+    Returns:
+        tuple: A tuple (image_type, image_data, offloaded, fallback), where image_type is 'url' or
+               'base64', offloaded is True if the image was uploaded because it did not fit into the
+               budget and fallback is None, or the storage that failed ("from") and its "error" if
+               the image was delivered in another way. None if the image could neither be encoded
+               nor offloaded.
+    """
+    # Get the preferred image return method from environment variable
+    # Possible values: "azure", "s3", "base64" (default)
+    image_return_method = os.environ.get("IMAGE_RETURN_METHOD", "base64").lower()
+
+    if image_return_method == "azure" and os.environ.get("AZURE_STORAGE_CONNECTION_STRING"):
+        # Upload to Azure Blob Storage
+        upload = upload_to_azure_blob(job_id, local_image_path)
+        if "url" in upload:
+            print(f"runpod-worker-comfy - image from node {node_id} uploaded to Azure Blob Storage")
+            return "url", upload["url"], False, None
+
+        # Fallback if Azure upload fails, the caller sees why
+        fallback = {"from": "azure", "error": upload["error"]}
+        if os.environ.get("BUCKET_ENDPOINT_URL", False):
+            image_data = rp_upload.upload_image(job_id, local_image_path)
+            print(f"runpod-worker-comfy - Azure upload failed, image from node {node_id} falling back to AWS S3")
+            return "url", image_data, False, fallback
+
+        print(f"runpod-worker-comfy - Azure upload failed, image from node {node_id} falling back to base64")
+        delivered = encode_or_offload(node_id, local_image_path, job_id, budget, allow_azure=False)
+        if delivered is None:
+            return None
+        image_type, image_data, offloaded, _ = delivered
+        return image_type, image_data, offloaded, fallback
+
+    if image_return_method == "s3" and os.environ.get("BUCKET_ENDPOINT_URL", False):
+        # Upload to AWS S3
+        image_data = rp_upload.upload_image(job_id, local_image_path)
+        print(f"runpod-worker-comfy - image from node {node_id} uploaded to AWS S3")
+        return "url", image_data, False, None
+
+    if image_return_method in ["azure", "s3"]:
+        # User requested cloud storage but it's not configured, fall back to base64
+        print(f"runpod-worker-comfy - {image_return_method} was requested but not configured, image from node {node_id} falling back to base64")
+    else:
+        # Use base64 (default)
+        print(f"runpod-worker-comfy - image from node {node_id} converted to base64")
+    return encode_or_offload(node_id, local_image_path, job_id, budget, fits=fits)
+
+
+def iter_output_images(outputs, output_path):
+    """
+    Yields the images in the "outputs" of a prompt, in the order of the nodes.
+
+    Args:
+        outputs (dict): The outputs of the prompt, by node ID
+        output_path (str): The directory that contains the images
+
+    Yields:
+        tuple: The node ID and the path of each image
+    """
+    for node_id, node_output in outputs.items():
+        for image in node_output.get("images", []):
+            # Construct the image path
+            image_path = os.path.join(image["subfolder"], image["filename"])
+            yield node_id, f"{output_path}/{image_path}"
+
+
+def remove_output_images(outputs, transcode=None, output_path=None):
+    """
+    Remove the images of a prompt and their transcoded copies from COMFY_OUTPUT_PATH once
+    they were delivered, unless RETAIN_OUTPUTS is set. The result cache keeps its own hard
+    links or copies of the images, so it is not affected.
+
+    Args:
+        outputs (dict): The outputs of the prompt, by node ID
+        transcode (dict, optional): The transcoding settings the images were delivered with
+        output_path (str, optional): The directory that contains the images, instead of COMFY_OUTPUT_PATH
+    """
+    if RETAIN_OUTPUTS or not outputs:
+        return
+    paths = []
+    output_path = output_path or os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    for _, local_image_path in iter_output_images(outputs, output_path):
+        paths.append(local_image_path)
+        transcoded_path = get_transcoded_path(local_image_path, transcode) if transcode else None
+        if transcoded_path:
+            paths.append(transcoded_path)
+    file_lifecycle.remove(paths)
+
+
+def process_output_images(outputs, job_id, budget=None, transcode=None, output_path=None, timings=None):
+    """
+    This function takes the "outputs" from image generation and the job ID,
+    then determines the correct way to return the images, either as direct URLs
+    to an AWS S3 bucket, Azure Blob Storage, or as base64 encoded strings, 
+    depending on the environment configuration.
+
+    Args:
+        outputs (dict): A dictionary containing the outputs from image generation,
+                        typically includes node IDs and their respective output data.
+        job_id (str): The unique identifier for the job.
+        budget (ResponseBudget, optional): The base64 budget of the response. Defaults to a new
+                                           budget of BASE64_RESPONSE_BUDGET_MB.
+        transcode (dict, optional): Re-encode the images with this 'format' and 'quality' before delivery
+        output_path (str, optional): The directory that contains the images, instead of COMFY_OUTPUT_PATH
+        timings (JobTimings, optional): Records the time to transcode and deliver each image
+
+    Returns:
+        dict: A dictionary with the status ('success' or 'error') and the message,
+              which is a list of dictionaries containing node_id, imageType ('url' or 'base64'),
+              and the image data. In case of error, the message contains an error description.
+              "offloaded" lists the images that were uploaded instead of encoded because they
+              did not fit into the response budget. An image that was delivered in another way
+              because its upload failed has a "fallback" with the storage and the error.
+
+    The function works as follows:
+    - It first determines the output path for the images from an environment variable,
+      defaulting to "/comfyui/output" if not set.
+    - It then iterates through the outputs to find the filenames of the generated images.
+    - For each image found, it checks if it exists in the output folder.
+    - If transcoding is requested, the image is re-encoded in the transcoding process pool.
+    - Room in the response budget is reserved for the images in order, so that the same
+      images are offloaded whichever upload or encoding finishes first.
+    - The images are delivered by `deliver_image`, on up to COMFY_DELIVERY_CONCURRENCY
+      threads at the same time:
+      - If Azure Blob Storage is preferred and configured, it uploads the image to Azure and adds the URL to the results.
+      - If AWS S3 is configured, it uploads the image to the bucket and adds the URL to the results.
+      - If no cloud storage is configured, it encodes the image in base64 and adds the string to the results.
+      - If the base64 encoded images would exceed the response budget, the remaining images are
+        uploaded to Azure or S3 instead, or reported as an error if neither is configured.
+    - If any image file does not exist in the output folder, it adds an error for that specific image.
+    - Returns a list of all processed images with their node_id and image data, in the order
+      of the nodes and of the images of each node.
+    """
+
+    # The path where ComfyUI stores the generated images
+    COMFY_OUTPUT_PATH = output_path or os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    
+    # List to collect all image results
+    image_results = []
+    errors = []
+    offloaded = []
+
+    if budget is None:
+        budget = ResponseBudget(int(BASE64_RESPONSE_BUDGET_MB * 1024 * 1024))
+
+    print(f"runpod-worker-comfy - image generation is done")
+
+    # Find the images of each node, in order
+    found_images = list(iter_output_images(outputs, COMFY_OUTPUT_PATH))
+
+    if not found_images:
+        return {
+            "status": "error",
+            "message": "No images were successfully generated or found",
+            "errors": errors
+        }
+
+    def prepare(node_id, local_image_path):
+        print(f"runpod-worker-comfy - processing: {local_image_path}")
+
+        # Check if the image file exists
+        if not os.path.exists(local_image_path):
+            return None, f"Image does not exist in the specified output folder: {local_image_path}"
+
+        start = time.monotonic()
+        if transcode:
+            local_image_path = transcode_output(local_image_path, transcode)
+        return (local_image_path, start), None
+
+    def process(node_id, local_image_path, start, fits):
+        delivered = deliver_image(node_id, local_image_path, job_id, budget, fits)
+        if delivered is None:
+            return None, f"Image exceeds the response size budget and no storage is configured: {local_image_path}"
+        if timings is not None:
+            timings.add_image(node_id, os.path.basename(local_image_path), delivered[0], time.monotonic() - start)
+        return delivered, None
+
+    # Deliver all images at the same time, so that the job waits only for the slowest upload
+    workers = min(COMFY_DELIVERY_CONCURRENCY, len(found_images))
+    reserve = uses_response_budget()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Transcode first, as the budget counts the size of the delivered files
+        prepared = [
+            executor.submit(prepare, node_id, local_image_path)
+            for node_id, local_image_path in found_images
+        ]
+        prepared = [future.result() for future in prepared]
+
+        # The first images that fit are encoded, the ones after them are offloaded
+        futures = []
+        for (node_id, _), (image, error_msg) in zip(found_images, prepared):
+            if image is None:
+                futures.append(None)
+                continue
+            local_image_path, start = image
+            fits = budget.reserve(base64_encoded_size(local_image_path)) if reserve else None
+            futures.append(executor.submit(process, node_id, local_image_path, start, fits))
+
+    for (node_id, local_image_path), (_, prepare_error), future in zip(found_images, prepared, futures):
+        delivered, error_msg = future.result() if future is not None else (None, prepare_error)
+        if delivered is not None:
+            image_type, image_data, was_offloaded, fallback = delivered
+
+            # Add this image to our results
+            image_result = {
+                "node_id": node_id,
+                "imageType": image_type,
+                "image": image_data
+            }
+            if fallback:
+                image_result["fallback"] = fallback
+            image_results.append(image_result)
+            if was_offloaded:
+                offloaded.append({"node_id": node_id, "filename": os.path.basename(local_image_path)})
+        else:
+            print(f"runpod-worker-comfy - {error_msg}")
+            errors.append({
+                "node_id": node_id,
+                "error": error_msg
+            })
+
+    # Return the results
+    if image_results:
+        return {
+            "status": "success",
+            "message": image_results,  # Keep the "message" field for backward compatibility
+            "errors": errors if errors else [],
+            "offloaded": offloaded,
+        }
+    else:
+        return {
+            "status": "error",
+            "message": "No images were successfully generated or found",
+            "errors": errors
+        }
+
+
+def validate_transcode_environment():
+    """
+    Validates TRANSCODE_FORMAT and TRANSCODE_QUALITY, which every job without "transcode" uses.
+
+    Returns:
+        str: An error message, or None if the settings are valid or transcoding is disabled
+    """
+    if not TRANSCODE_FORMAT:
+        return None
+    _, error_message = validate_transcode({"format": TRANSCODE_FORMAT, "quality": TRANSCODE_QUALITY})
+    if error_message:
+        return f"TRANSCODE_FORMAT={TRANSCODE_FORMAT} TRANSCODE_QUALITY={TRANSCODE_QUALITY}: {error_message}"
+    return None
+
+
+def get_transcode_settings(validated_data):
+    """
+    Returns the transcoding settings of a job, falling back to TRANSCODE_FORMAT.
+
+    Args:
+        validated_data (dict): The input of the job, as returned by `validate_input`.
+
+    Returns:
+        dict: The settings with 'format' and 'quality', or None if the outputs are delivered as generated
+    """
+    transcode = validated_data.get("transcode")
+    if transcode is None and TRANSCODE_FORMAT:
+        transcode = {"format": TRANSCODE_FORMAT, "quality": TRANSCODE_QUALITY}
+    if transcode is None or transcode["format"] == "original":
+        return None
+    return transcode
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """
+    Return the result cache of this worker, creating it on first use.
+
+    Returns:
+        ResultCache: The cache in RESULT_CACHE_DIR, with an Azure tier if
+                     RESULT_CACHE_AZURE_CONTAINER is set
+    """
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            remote = None
+            connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
+            if RESULT_CACHE_AZURE_CONTAINER and connection_string:
+                remote = AzureResultCache(
+                    BlobServiceClient.from_connection_string(connection_string),
+                    RESULT_CACHE_AZURE_CONTAINER,
+                )
+            _result_cache = ResultCache(
+                RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB * 1024 * 1024, remote=remote
+            )
+        return _result_cache
+
+
+def get_cache_key(validated_data):
+    """
+    Returns the result cache key of a job.
+
+    Args:
+        validated_data (dict): The input of the job, as returned by `validate_input`.
+
+    Returns:
+        tuple: A tuple (cache_key, bypass_reason). cache_key is None if the cache is disabled
+               or the workflow is not deterministic, bypass_reason then says why.
+    """
+    if not RESULT_CACHE:
+        return None, "disabled"
+    if validated_data.get("cache") is False:
+        return None, "disabled for this job"
+
+    workflow = validated_data["workflow"]
+    reason = find_nondeterminism(workflow, RESULT_CACHE_BYPASS_NODES)
+    if reason:
+        return None, reason
+    # The content behind a URL can change, the key would not notice
+    if any("url" in image for image in validated_data.get("images") or []):
+        return None, "input images given by url"
+    if "template" in validated_data:
+        # The template and the values of its parameters identify the workflow, whatever
+        # parameters the job left at their defaults
+        template = get_workflow_templates()[validated_data["template"]]
+        payload = {"template": template.fingerprint, "params": template.values(validated_data["params"])}
+        return compute_cache_key(payload, validated_data.get("images")), None
+    return compute_cache_key(workflow, validated_data.get("images")), None
+
+
+def result_cache_report(hit, bypass_reason=None):
+    """
+    Returns the "result_cache" field of a result.
+
+    Args:
+        hit (bool): Whether the result came from the result cache
+        bypass_reason (str, optional): Why the result cache was not used, see `get_cache_key`
+
+    Returns:
+        dict: "hit", the statistics of the result cache and "bypassed" if a reason was given
+    """
+    report = {"hit": hit, **get_result_cache().stats()}
+    if bypass_reason:
+        report["bypassed"] = bypass_reason
+    return report
+
+
+def add_startup_report(result):
+    """
+    Add the cold start timeline to the result of the first job of this worker.
+
+    The timeline is also logged as one JSON record.
+
+    Args:
+        result (dict): The result of a job
+
+    Returns:
+        dict: The result, with a "startup" key if it is the first one
+    """
+    global _startup_reported
+    with _startup_reported_lock:
+        if _startup_reported:
+            return result
+        _startup_reported = True
+
+    record = startup_timeline.record(COMFY_LOG_PATH)
+    print(f"runpod-worker-comfy - startup timeline: {json.dumps(record)}")
+    return {**result, "startup": record}
+
+
+def get_backends():
+    """
+    Returns:
+        list: The ComfyUI servers of the worker, see `ComfyBackend`. A worker with a single
+              server always uses `comfy` and `model_memory`.
+    """
+    if comfy_pool is None:
+        return [ComfyBackend(comfy, model_memory=model_memory)]
+    return comfy_pool.backends
+
+
+def acquire_backend(workflows):
+    """
+    Choose the ComfyUI server that runs the workflows of a job, see `ComfyPool`.
+
+    Args:
+        workflows (list): The workflows of the job
+
+    Returns:
+        ComfyBackend: The server, to be passed to `release_backend` when the job is done
+    """
+    if comfy_pool is None:
+        return get_backends()[0]
+    backend = comfy_pool.acquire(frozenset().union(*(workflow_models(workflow) for workflow in workflows)))
+    print(f"runpod-worker-comfy - running the job on ComfyUI at {backend.host}")
+    return backend
+
+
+def release_backend(backend):
+    """Count a job as done on the server it was given by `acquire_backend`."""
+    if comfy_pool is not None:
+        comfy_pool.release(backend)
+
+
+def get_output_path(backend=None):
+    """
+    Returns:
+        str: The directory the outputs of a ComfyUI server are saved to, COMFY_OUTPUT_PATH
+             or the directory of the server below it
+    """
+    output_path = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    if backend is not None and backend.output_subdirectory:
+        return os.path.join(output_path, backend.output_subdirectory)
+    return output_path
+
+
+def prefetch_models(workflows):
+    """
+    Start reading the models of a job from the network volume in the background while its
+    images are uploaded, and copy the ones without a local copy in the background, see `ModelPrefetcher`.
+
+    Args:
+        workflows (list): The workflows of the job
+    """
+    if model_prefetcher is None:
+        return
+
+    models = frozenset().union(*(workflow_models(workflow) for workflow in workflows))
+    try:
+        scheduled = model_prefetcher.prefetch(models)
+    except OSError as e:
+        print(f"runpod-worker-comfy - could not prefetch the models: {str(e)}")
+        return
+    if scheduled:
+        print(f"runpod-worker-comfy - copying to local disk: {', '.join(scheduled)}")
+
+
+def prepare_model_memory(workflows, backend=None):
+    """
+    Free the memory of ComfyUI before a job if it needs other models or the memory is
+    running out, see `ModelMemoryPolicy`. Otherwise the loaded models stay warm.
+
+    Nothing is freed while other prompts are queued or running, as they may still need
+    the loaded models.
+
+    Args:
+        workflows (list): The workflows of the next job
+        backend (ComfyBackend, optional): The server that runs the job, defaults to `comfy`
+    """
+    if not COMFY_UNLOAD_ON_MODEL_CHANGE and not COMFY_FREE_MEMORY_THRESHOLD:
+        return
+
+    backend = backend or get_backends()[0]
+    client = backend.client
+    models = frozenset().union(*(workflow_models(workflow) for workflow in workflows))
+    decision = None
+    try:
+        queue = client.get_queue()
+        if not queue.get("queue_running") and not queue.get("queue_pending"):
+            usage = memory_usage(client.get_system_stats()) if COMFY_FREE_MEMORY_THRESHOLD else None
+            decision = backend.model_memory.decide(models, usage)
+            if decision is not None:
+                unload_models, free_memory, reason = decision
+                client.free_memory(unload_models, free_memory)
+                print(f"runpod-worker-comfy - freed the memory of ComfyUI at {backend.host}, {reason}")
+    except requests.RequestException as e:
+        print(f"runpod-worker-comfy - could not check the memory of ComfyUI: {str(e)}")
+        decision = None
+    backend.model_memory.record(models, freed=decision is not None)
+
+
+def submit_workflows(validated_data, workflows, timings=None, job_deadline=None, backend=None):
+    """
+    Upload the images of a job and queue its workflows in ComfyUI, all of them up front.
+
+    A WebSocket for the execution events is opened before the workflows are queued,
+    so that no event of the prompts is missed. ComfyUI runs the prompts one after
+    another in the order they were queued.
+
+    Args:
+        validated_data (dict): The input of the job, as returned by `validate_input`.
+        workflows (list): The workflows to queue, which share the images of the job
+        timings (JobTimings, optional): Records the time of each step
+        job_deadline (JobDeadline, optional): Tracks the queued prompts. Nothing is queued
+                                              once the job was cancelled or its deadline passed.
+        backend (ComfyBackend, optional): The server that runs the workflows, see `acquire_backend`
+
+    Returns:
+        tuple: A tuple (prompts, ws, error_result). prompts has a tuple (prompt_id, error)
+               for each workflow, where prompt_id is None if it could not be queued. On a
+               failure of the whole job prompts and ws are None and error_result is the
+               dictionary that should be returned for the job.
+    """
+    # Extract validated data
+    images = validated_data.get("images")
+    if timings is None:
+        timings = JobTimings()
+    backend = backend or get_backends()[0]
+
+    # Make sure that the ComfyUI API is available
+    with timings.measure("check_server"):
+        check_server(
+            COMFY_API_AVAILABLE_MAX_RETRIES,
+            COMFY_API_AVAILABLE_INTERVAL_MS,
+            backend.client,
+        )
+
+    # Reject a broken workflow before anything is uploaded or queued
+    template = get_workflow_templates().get(validated_data["template"]) if "template" in validated_data else None
+    validation_errors = []
+    with timings.measure("workflow_validation"):
+        for index, workflow in enumerate(workflows):
+            errors = validate_workflow(workflow, images, template)
+            if len(workflows) > 1:
+                errors = [f"workflow {index}: {error}" for error in errors]
+            validation_errors.extend(errors)
+    if validation_errors:
+        print(f"runpod-worker-comfy - workflow validation failed: {validation_errors}")
+        return None, None, {"error": "Invalid workflow", "details": validation_errors}
+
+    # The models are read from the network volume while the images are uploaded
+    with timings.measure("model_prefetch"):
+        prefetch_models(workflows)
+
+    # Upload images if they exist
+    with timings.measure("upload_images"):
+        upload_result = upload_images(images, backend.client)
+
+    if upload_result["status"] == "error":
+        return None, None, upload_result
+    if job_deadline is not None and job_deadline.expired():
+        return None, None, {"error": job_deadline.error()}
+
+    with timings.measure("model_memory"):
+        prepare_model_memory(workflows, backend)
+
+    # Connect to the WebSocket before queueing, so that no execution event is missed
+    client_id = str(uuid.uuid4())
+    ws = open_websocket(client_id, backend.client)
+
+    # Queue all workflows, so that ComfyUI goes from one prompt to the next without waiting for us
+    prompts = []
+    for workflow in workflows:
+        # Images that were already in the input directory under another name
+        workflow = apply_image_aliases(workflow, upload_result.get("aliases"))
+        try:
+            with timings.measure("queue_workflow"):
+                queued_workflow = queue_workflow(workflow, client_id, backend.client)
+            timings.mark("queued")
+            prompt_id = queued_workflow["prompt_id"]
+            print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
+            startup_timeline.mark("first_job_queued")
+            prompts.append((prompt_id, None))
+        except Exception as e:
+            prompts.append((None, f"Error queuing workflow: {str(e)}"))
+
+    if job_deadline is not None:
+        job_deadline.track([prompt_id for prompt_id, _ in prompts], ws, backend.client)
+    return prompts, ws, None
+
+
+def submit_job(validated_data, timings=None, job_deadline=None, backend=None):
+    """
+    Upload the images of a job and queue its workflow in ComfyUI.
+
+    Args:
+        validated_data (dict): The input of the job, as returned by `validate_input`.
+        timings (JobTimings, optional): Records the time of each step
+        job_deadline (JobDeadline, optional): The deadline of the job, see `submit_workflows`
+        backend (ComfyBackend, optional): The server that runs the workflow, see `acquire_backend`
+
+    Returns:
+        tuple: A tuple (prompt_id, ws, error_result). On failure prompt_id and ws are None
+               and error_result is the dictionary that should be returned for the job.
+    """
+    prompts, ws, error_result = submit_workflows(
+        validated_data, [validated_data["workflow"]], timings, job_deadline, backend
+    )
+    if error_result:
+        return None, None, error_result
+
+    prompt_id, error = prompts[0]
+    if error:
+        if ws is not None:
+            ws.close()
+        return None, None, {"error": error}
+    return prompt_id, ws, None
+
+
+def iter_batch_results(job, validated_data, timings, budget=None, transcode=None, job_deadline=None):
+    """
+    Run the workflows of a batch job and deliver the outputs of each one as soon as it finished.
+
+    Workflows whose result is in the result cache are delivered first. All others are
+    queued up front, so that ComfyUI keeps the GPU busy and consecutive prompts reuse
+    the models that are already loaded, while the outputs of the finished prompts are
+    being delivered.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        validated_data (dict): The input of the job with "workflows", as returned by `validate_input`.
+        timings (JobTimings): The timings of the job
+        budget (ResponseBudget, optional): The base64 budget shared by all workflows of the job
+        transcode (dict, optional): Re-encode the images with this 'format' and 'quality' before delivery
+        job_deadline (JobDeadline, optional): The deadline of the job. When it passes, the
+                                              prompts that did not finish are cancelled.
+
+    Yields:
+        tuple: (index, result) with the index of the workflow and the result of `process_output_images`,
+               with "result_cache" if RESULT_CACHE is set, or an {"error": ...} for this workflow.
+               (None, error_result) if the job failed as a whole.
+    """
+    workflows = validated_data["workflows"]
+    if job_deadline is None:
+        job_deadline = JobDeadline()
+
+    # Deliver the results of identical earlier workflows without running them again
+    pending = []
+    cache_keys = {}
+    bypass_reasons = {}
+    for index, workflow in enumerate(workflows):
+        cache_key, bypass_reasons[index] = get_cache_key({**validated_data, "workflow": workflow})
+        if cache_key:
+            with timings.measure("result_cache"):
+                cached = get_result_cache().get(cache_key)
+            if cached:
+                print(f"runpod-worker-comfy - result cache hit for {cache_key}")
+                outputs, cached_path = cached
+                with timings.measure("delivery"):
+                    result = process_output_images(outputs, job["id"], budget, transcode, cached_path, timings)
+                yield index, {**result, "result_cache": result_cache_report(True)}
+                continue
+            cache_keys[index] = cache_key
+        pending.append(index)
+    if not pending:
+        return
+
+    backend = acquire_backend([workflows[index] for index in pending])
+    output_path = get_output_path(backend)
+    ws = None
+    try:
+        prompts, ws, error_result = submit_workflows(
+            validated_data, [workflows[index] for index in pending], timings, job_deadline, backend
+        )
+        if error_result:
+            yield None, error_result
+            return
+
+        print(f"runpod-worker-comfy - wait until image generation of {len(pending)} workflows is complete")
+        # The prompts run one after another, so each one starts about when the previous one finished
+        started_at = time.monotonic()
+        for position, (index, (prompt_id, error)) in enumerate(zip(pending, prompts)):
+            if error:
+                yield index, {"error": error}
+                continue
+
+            deadline = job_deadline.limit(started_at + COMFY_EXECUTION_TIMEOUT_S)
+            fingerprint, estimate = get_runtime_estimate(workflows[index])
+            try:
+                if ws is not None and not await_completion_event(ws, prompt_id, deadline, timings):
+                    ws.close()
+                    ws = None
+                with timings.measure("history"):
+                    history = poll_history(
+                        prompt_id, deadline, estimate, started_at, job_deadline.cancelled, backend.client
+                    )
+            except Exception as e:
+                yield index, {"error": f"Error waiting for image generation: {str(e)}"}
+                started_at = time.monotonic()
+                continue
+            record_runtime(fingerprint, prompt_id, history, started_at)
+
+            if history is None:
+                # ComfyUI is stuck on this prompt, the ones behind it would not finish either
+                timeout_error = job_deadline.error()
+                job_deadline.abort()
+                not_run_error = f"Not run, {timeout_error[0].lower()}{timeout_error[1:]}"
+                if not job_deadline.expired():
+                    not_run_error += " for an earlier workflow"
+                yield index, {"error": timeout_error}
+                for remaining in pending[position + 1:]:
+                    yield remaining, {"error": not_run_error}
+                return
+            started_at = time.monotonic()
+
+            outputs = history[prompt_id].get("outputs")
+            if index in cache_keys:
+                with timings.measure("result_cache"):
+                    get_result_cache().put(cache_keys[index], outputs, output_path)
+
+            with timings.measure("delivery"):
+                result = process_output_images(outputs, job["id"], budget, transcode, output_path, timings)
+            remove_output_images(outputs, transcode, output_path)
+            if RESULT_CACHE:
+                result = {**result, "result_cache": result_cache_report(False, bypass_reasons[index])}
+            yield index, result
+        timings.mark("execution_end")
+    finally:
+        if ws is not None:
+            ws.close()
+        release_backend(backend)
+
+
+def reclaim_disk_space():
+    """
+    Keep the input images within COMFY_INPUT_QUOTA_MB, and report the disk space that was
+    reclaimed since the previous job in the log and in the metrics.
+
+    Only the input images this worker has put into COMFY_INPUT_PATH are removed, and only
+    if the directory is writable.
+    """
+    if os.path.isdir(COMFY_INPUT_PATH) and os.access(COMFY_INPUT_PATH, os.W_OK):
+        file_lifecycle.enforce_input_quota(COMFY_INPUT_PATH, upload_cache.names(), upload_cache.discard)
+
+    reclaimed = file_lifecycle.take_reclaimed()
+    for directory, (files, size) in sorted(reclaimed.items()):
+        job_metrics.observe_reclaimed(directory, files, size)
+        print(f"runpod-worker-comfy - reclaimed {size} bytes by removing {files} {directory} file(s)")
+
+
+def record_job_metrics(result, timings):
+    """
+    Add the timings of a finished job to the metrics of the worker, and to its result if
+    RETURN_TIMINGS is set. The metrics are written to METRICS_PATH, if it is set.
+
+    Args:
+        result (dict): The result of the job, or the last event of a streamed job
+        timings (JobTimings): The timings of the job
+
+    Returns:
+        dict: The result, with a "timings" key if RETURN_TIMINGS is set
+    """
+    status = "error" if "error" in result else result.get("status", "success")
+    job_metrics.observe_job(timings, status)
+    if METRICS_PATH:
+        job_metrics.write(METRICS_PATH)
+    if RETURN_TIMINGS:
+        return {**result, "timings": timings.as_dict()}
+    return result
+
+
+def handler(job):
+    """
+    The main function that handles a job of generating images.
+
+    This function validates the input, sends a prompt to ComfyUI for processing,
+    waits for the result over ComfyUI's WebSocket (or polls the history as a fallback),
+    and retrieves generated images. The duration of each step is recorded in the metrics.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: A dictionary containing either an error message or a success status with a message field
+              that contains a list of generated images. Each image is represented as a dictionary with 
+              node_id, imageType, and image data (either URL or base64).
+    """
+    timings = JobTimings()
+    try:
+        result = run_job(job, timings)
+    finally:
+        finish_job(job["id"])
+    reclaim_disk_space()
+    return record_job_metrics(result, timings)
+
+
+def run_job(job, timings):
+    """
+    Process a job for `handler`, recording the duration of each step in `timings`.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        timings (JobTimings): The timings of the job
+
+    Returns:
+        dict: The result of the job
+    """
+    startup_timeline.mark("first_job_received")
+
+    # Make sure that the input is valid
+    with timings.measure("validation"):
+        validated_data, error_message = validate_input(job["input"])
+    if error_message:
+        return {"error": error_message}
+    transcode = get_transcode_settings(validated_data)
+    job_deadline = start_job_deadline(job["id"], validated_data)
+
+    if "workflows" in validated_data:
+        return run_batch_job(job, validated_data, timings, transcode, job_deadline)
+
+    # Return the result of an identical earlier job without running the workflow again
+    cache_key, bypass_reason = get_cache_key(validated_data)
+    if cache_key:
+        with timings.measure("result_cache"):
+            cached = get_result_cache().get(cache_key)
+        if cached:
+            outputs, cached_path = cached
+            print(f"runpod-worker-comfy - result cache hit for {cache_key}")
+            with timings.measure("delivery"):
+                images_result = process_output_images(
+                    outputs, job["id"], transcode=transcode, output_path=cached_path, timings=timings
+                )
+            return add_startup_report({
+                **images_result,
+                "result_cache": result_cache_report(True),
+                "refresh_worker": REFRESH_WORKER,
+            })
+
+    backend = acquire_backend([validated_data["workflow"]])
+    output_path = get_output_path(backend)
+    try:
+        prompt_id, ws, error_result = submit_job(validated_data, timings, job_deadline, backend)
+        if error_result:
+            return error_result
+
+        # Wait for completion
+        print(f"runpod-worker-comfy - wait until image generation is complete")
+        try:
+            history = wait_for_prompt(
+                prompt_id, ws, timings, validated_data["workflow"], job_deadline, backend.client
+            )
+            if history is None:
+                # Free the GPU for the next job instead of finishing a prompt nobody waits for
+                error = job_deadline.error()
+                job_deadline.abort()
+                return {"error": error}
+        except Exception as e:
+            return {"error": f"Error waiting for image generation: {str(e)}"}
+
+        outputs = history[prompt_id].get("outputs")
+        if cache_key:
+            with timings.measure("result_cache"):
+                get_result_cache().put(cache_key, outputs, output_path)
+
+        # Get the generated images and return them as URLs in an AWS bucket or as base64
+        with timings.measure("delivery"):
+            images_result = process_output_images(
+                outputs, job["id"], transcode=transcode, output_path=output_path, timings=timings
+            )
+        remove_output_images(outputs, transcode, output_path)
+
+        # Add refresh_worker flag to the result
+        result = {**images_result, "refresh_worker": REFRESH_WORKER}
+        if RESULT_CACHE:
+            result["result_cache"] = result_cache_report(False, bypass_reason)
+
+        return add_startup_report(result)
+    finally:
+        release_backend(backend)
+
+
+def run_batch_job(job, validated_data, timings, transcode=None, job_deadline=None):
+    """
+    Process a job with a list of "workflows" for `handler`.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        validated_data (dict): The input of the job, as returned by `validate_input`.
+        timings (JobTimings): The timings of the job
+        transcode (dict, optional): Re-encode the images with this 'format' and 'quality' before delivery
+        job_deadline (JobDeadline, optional): The deadline of the job
+
+    Returns:
+        dict: The result of the job. "results" has the result of each workflow in the order
+              of the workflows, "status" is "success" if all of them succeeded.
+    """
+    # One budget for all workflows, as their images are returned in one response
+    budget = ResponseBudget(int(BASE64_RESPONSE_BUDGET_MB * 1024 * 1024))
+    results = [None] * len(validated_data["workflows"])
+    for index, result in iter_batch_results(job, validated_data, timings, budget, transcode, job_deadline):
+        if index is None:
+            return result
+        results[index] = result
+
+    succeeded = all(result.get("status") == "success" for result in results)
+    return add_startup_report({
+        "status": "success" if succeeded else "error",
+        "results": results,
+        "refresh_worker": REFRESH_WORKER,
+    })
+
+
+def stream_handler(job):
+    """
+    Generator version of `handler` that streams results while the workflow is running.
+
+    Instead of one response at the end, this yields:
+    - {"type": "progress", "node_id", "value", "max"} for every sampler step
+    - {"type": "image", "node_id", "imageType", "image"} as soon as an output node has finished
+    - {"type": "error", "node_id", "error"} for an output image that could not be found
+    - {"type": "complete", "status", "offloaded"} once all outputs were delivered
+    A job that fails yields a single {"error": ...} and stops.
+
+    A job with a list of "workflows" yields {"type": "result", "workflow_index", ...} with the
+    result of each workflow as soon as it was delivered, instead of progress and image events.
+
+    If the WebSocket is unavailable or drops, the remaining outputs are taken from the
+    history once the prompt has finished.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: The events described above
+    """
+    timings = JobTimings()
+    try:
+        for event in stream_job(job, timings):
+            # The last event of a job is either "complete" or an error without a type
+            if event.get("type", "complete") == "complete":
+                finish_job(job["id"])
+                reclaim_disk_space()
+                event = record_job_metrics(event, timings)
+            yield event
+    except GeneratorExit:
+        # Nobody reads the events anymore
+        cancel_job(job["id"])
+        raise
+    finally:
+        finish_job(job["id"])
+
+
+def stream_job(job, timings):
+    """
+    Process a job for `stream_handler`, recording the duration of each step in `timings`.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        timings (JobTimings): The timings of the job
+
+    Yields:
+        dict: The events of `stream_handler`
+    """
+    startup_timeline.mark("first_job_received")
+
+    # Make sure that the input is valid
+    with timings.measure("validation"):
+        validated_data, error_message = validate_input(job["input"])
+    if error_message:
+        yield {"error": error_message}
+        return
+
+    delivered_nodes = set()
+    delivered_images = 0
+    offloaded = []
+    transcode = get_transcode_settings(validated_data)
+    job_deadline = start_job_deadline(job["id"], validated_data)
+    # One budget for all images of the job, as the aggregated stream is returned as one response
+    budget = ResponseBudget(int(BASE64_RESPONSE_BUDGET_MB * 1024 * 1024))
+
+    if "workflows" in validated_data:
+        succeeded = True
+        for index, result in iter_batch_results(job, validated_data, timings, budget, transcode, job_deadline):
+            if index is None:
+                yield result
+                return
+            succeeded = succeeded and result.get("status") == "success"
+            offloaded.extend({"workflow_index": index, **image} for image in result.get("offloaded", []))
+            yield {"type": "result", "workflow_index": index, **result}
+        yield add_startup_report({
+            "type": "complete",
+            "status": "success" if succeeded else "error",
+            "offloaded": offloaded,
+        })
+        return
+
+    def deliver(outputs, output_path=None):
+        nonlocal delivered_images
+        with timings.measure("delivery"):
+            images_result = process_output_images(outputs, job["id"], budget, transcode, output_path, timings)
+        offloaded.extend(images_result.get("offloaded", []))
+        for error in images_result["errors"]:
+            yield {"type": "error", **error}
+        if images_result["status"] == "success":
+            for image in images_result["message"]:
+                delivered_images += 1
+                yield {"type": "image", **image}
+
+    # Stream the result of an identical earlier job without running the workflow again
+    cache_key, _ = get_cache_key(validated_data)
+    if cache_key:
+        with timings.measure("result_cache"):
+            cached = get_result_cache().get(cache_key)
+        if cached:
+            print(f"runpod-worker-comfy - result cache hit for {cache_key}")
+            yield from deliver(*cached)
+            yield add_startup_report({
+                "type": "complete",
+                "status": "success" if delivered_images else "error",
+                "offloaded": offloaded,
+                "result_cache": result_cache_report(True),
+            })
+            return
+
+    backend = acquire_backend([validated_data["workflow"]])
+    output_path = get_output_path(backend)
+    try:
+        prompt_id, ws, error_result = submit_job(validated_data, timings, job_deadline, backend)
+        if error_result:
+            yield error_result
+            return
+
+        print(f"runpod-worker-comfy - streaming results until image generation is complete")
+        queued_at = time.monotonic()
+        deadline = job_deadline.limit(queued_at + COMFY_EXECUTION_TIMEOUT_S)
+        fingerprint, estimate = get_runtime_estimate(validated_data["workflow"])
+        try:
+            if ws is not None:
+                try:
+                    for event in iter_prompt_events(ws, prompt_id, deadline - time.monotonic()):
+                        data = event["data"]
+                        if event["type"] == "execution_start":
+                            timings.mark("execution_start")
+                        elif event["type"] == "progress":
+                            yield {
+                                "type": "progress",
+                                "node_id": data.get("node"),
+                                "value": data.get("value"),
+                                "max": data.get("max"),
+                            }
+                        elif event["type"] == "executed" and "images" in (data.get("output") or {}):
+                            delivered_nodes.add(data["node"])
+                            yield from deliver({data["node"]: data["output"]}, output_path)
+                    timings.mark("execution_end")
+                except (websocket.WebSocketException, OSError) as e:
+                    print(f"runpod-worker-comfy - websocket lost ({e}), falling back to polling")
+                finally:
+                    ws.close()
+
+            with timings.measure("history"):
+                history = poll_history(
+                    prompt_id, deadline, estimate, queued_at, job_deadline.cancelled, backend.client
+                )
+            record_runtime(fingerprint, prompt_id, history, queued_at)
+            if history is None:
+                error = job_deadline.error()
+                job_deadline.abort()
+                yield {"error": error}
+                return
+        except Exception as e:
+            yield {"error": f"Error waiting for image generation: {str(e)}"}
+            return
+
+        if cache_key:
+            with timings.measure("result_cache"):
+                get_result_cache().put(cache_key, history[prompt_id].get("outputs", {}), output_path)
+
+        # Deliver the outputs of nodes whose "executed" event was not received
+        remaining_outputs = {
+            node_id: node_output
+            for node_id, node_output in history[prompt_id].get("outputs", {}).items()
+            if node_id not in delivered_nodes
+        }
+        if remaining_outputs:
+            yield from deliver(remaining_outputs, output_path)
+        # Only now, as the result cache needs the images that were streamed during execution
+        remove_output_images(history[prompt_id].get("outputs", {}), transcode, output_path)
+
+        yield add_startup_report({
+            "type": "complete",
+            "status": "success" if delivered_images else "error",
+            "offloaded": offloaded,
+        })
+    finally:
+        release_backend(backend)
+
+
+async def async_handler(job):
+    """
+    asyncio entry point that runs `handler` without blocking the event loop.
+
+    All stages of `handler` (upload, queueing, waiting and delivery) are blocking I/O,
+    so running each job on a worker thread lets RunPod overlap up to COMFY_JOB_CONCURRENCY
+    jobs: while ComfyUI executes one prompt, the inputs of the next one are uploaded and
+    the outputs of the previous one are delivered.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: The same result as `handler`
+    """
+    try:
+        return await asyncio.to_thread(handler, job)
+    except asyncio.CancelledError:
+        # The thread keeps running, stop the prompts it waits for so that it returns soon
+        cancel_job(job["id"])
+        raise
+
+
+async def async_stream_handler(job):
+    """
+    asyncio entry point that streams the events of `stream_handler`.
+
+    Each step of the generator runs on a worker thread, so that streaming jobs
+    can overlap just like the jobs of `async_handler`.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: The events of `stream_handler`
+    """
+    events = stream_handler(job)
+    finished = object()
+    try:
+        while True:
+            event = await asyncio.to_thread(next, events, finished)
+            if event is finished:
+                return
+            yield event
+    except (asyncio.CancelledError, GeneratorExit):
+        # Nobody reads the events anymore, stop the prompts the thread waits for
+        cancel_job(job["id"])
+        raise
+
+
+def concurrency_modifier(current_concurrency):
+    """
+    Tell RunPod how many jobs this worker may run at the same time.
+
+    Args:
+        current_concurrency (int): The concurrency RunPod is currently using
+
+    Returns:
+        int: The value of COMFY_JOB_CONCURRENCY
+    """
+    return COMFY_JOB_CONCURRENCY
+
+
+def checkpoint_warmup_workflow(checkpoint):
+    """
+    Build the smallest workflow that loads a checkpoint into memory.
+
+    ComfyUI only executes nodes that lead to an output node, so the checkpoint is used
+    for a single sampling step on a tiny image that is only previewed.
+
+    Args:
+        checkpoint (str): The file name of the checkpoint
+
+    Returns:
+        dict: The workflow in API format
+    """
+    return {
+        "1": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": checkpoint}},
+        "2": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["1", 1]}},
+        "3": {"class_type": "EmptyLatentImage", "inputs": {"width": 64, "height": 64, "batch_size": 1}},
+        "4": {
+            "class_type": "KSampler",
+            "inputs": {
+                "seed": 0,
+                "steps": 1,
+                "cfg": 1,
+                "sampler_name": "euler",
+                "scheduler": "normal",
+                "denoise": 1,
+                "model": ["1", 0],
+                "positive": ["2", 0],
+                "negative": ["2", 0],
+                "latent_image": ["3", 0],
+            },
+        },
+        "5": {"class_type": "VAEDecode", "inputs": {"samples": ["4", 0], "vae": ["1", 2]}},
+        "6": {"class_type": "PreviewImage", "inputs": {"images": ["5", 0]}},
+    }
+
+
+def get_warmup_workflows():
+    """
+    Returns the workflows of the warmup: WARMUP_WORKFLOW and one for each of WARMUP_CHECKPOINTS.
+
+    Returns:
+        list: Tuples (name, workflow)
+    """
+    workflows = []
+    if WARMUP_WORKFLOW:
+        try:
+            with open(WARMUP_WORKFLOW) as workflow_file:
+                data = json.load(workflow_file)
+            # Accept a job input like test_input.json as well as a plain workflow
+            data = data.get("input", data)
+            workflows.append((WARMUP_WORKFLOW, data.get("workflow", data)))
+        except (OSError, ValueError) as e:
+            print(f"runpod-worker-comfy - warmup workflow {WARMUP_WORKFLOW} not loaded: {str(e)}")
+
+    for checkpoint in WARMUP_CHECKPOINTS:
+        workflows.append((checkpoint, checkpoint_warmup_workflow(checkpoint)))
+    return workflows
+
+
+def run_warmup_workflow(workflow, backend=None):
+    """
+    Run a workflow in ComfyUI without delivering its outputs.
+
+    Images are previewed instead of saved, so the warmup leaves no files in the output directory.
+
+    Args:
+        workflow (dict): The workflow in API format
+        backend (ComfyBackend, optional): The server to run it on, defaults to `comfy`
+
+    Returns:
+        str: None if the workflow ran, otherwise why it did not
+    """
+    workflow = {
+        node_id: {**node, "class_type": "PreviewImage"}
+        if isinstance(node, dict) and node.get("class_type") == "SaveImage"
+        else node
+        for node_id, node in workflow.items()
+    }
+
+    validation_errors = validate_workflow(workflow)
+    if validation_errors:
+        return f"invalid workflow: {'; '.join(validation_errors)}"
+
+    backend = backend or get_backends()[0]
+    client_id = str(uuid.uuid4())
+    ws = open_websocket(client_id, backend.client)
+    try:
+        prompt_id = queue_workflow(workflow, client_id, backend.client)["prompt_id"]
+    except Exception as e:
+        if ws is not None:
+            ws.close()
+        return f"could not queue: {str(e)}"
+
+    try:
+        if wait_for_prompt(prompt_id, ws, client=backend.client) is None:
+            return "did not finish"
+    except Exception as e:
+        return str(e)
+    backend.model_memory.record(workflow_models(workflow))
+    return None
+
+
+def warmup():
+    """
+    Prepare ComfyUI for the first job: wait until it is up, load the node schema and
+    run the warmup workflows, which load their models into memory.
+
+    With several ComfyUI servers, each of them runs the warmup workflows, all at the same
+    time. Their results then have the "host" of the server.
+
+    A failed warmup is reported but does not stop the worker, the first job then
+    loads the models instead.
+
+    Returns:
+        dict: The "status", the total "seconds" and the result of each workflow
+    """
+    start = time.monotonic()
+    retries = int(WARMUP_TIMEOUT_S * 1000 / COMFY_API_AVAILABLE_INTERVAL_MS)
+    backends = get_backends()
+    with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+        reachable = list(
+            executor.map(
+                lambda backend: check_server(retries, COMFY_API_AVAILABLE_INTERVAL_MS, backend.client), backends
+            )
+        )
+    ready = [backend for backend, is_reachable in zip(backends, reachable) if is_reachable]
+    if not ready:
+        report = {"status": "error", "seconds": round(time.monotonic() - start, 3), "workflows": []}
+        print(f"runpod-worker-comfy - warmup failed: {json.dumps(report)}")
+        return report
+
+    validate_workflow_templates()
+
+    warmup_workflows = get_warmup_workflows()
+    prefetch_models([workflow for _, workflow in warmup_workflows])
+
+    def run_warmup(backend):
+        results = []
+        for name, workflow in warmup_workflows:
+            workflow_start = time.monotonic()
+            error = run_warmup_workflow(workflow, backend)
+            result = {"name": name, "seconds": round(time.monotonic() - workflow_start, 3)}
+            if len(backends) > 1:
+                result["host"] = backend.host
+            if error:
+                result["error"] = error
+                print(f"runpod-worker-comfy - warmup of {name} on {backend.host} failed: {error}")
+            results.append(result)
+        return results
+
+    with ThreadPoolExecutor(max_workers=len(ready)) as executor:
+        results = [result for backend_results in executor.map(run_warmup, ready) for result in backend_results]
+    # Servers that did not start are reported, the worker still uses the others
+    for backend in backends:
+        if backend not in ready:
+            results.append({"name": "startup", "host": backend.host, "error": "ComfyUI is not reachable"})
+
+    report = {
+        "status": "error" if any("error" in result for result in results) else "success",
+        "seconds": round(time.monotonic() - start, 3),
+        "workflows": results,
+    }
+    print(f"runpod-worker-comfy - warmup finished: {json.dumps(report)}")
+    startup_timeline.mark("warmup_finished")
+    return report
+
+
+# Start the handler only if this script is run directly
+if __name__ == "__main__":
+    # A bad default would fail the transcoding of every job, which falls back to the original files
+    error_message = validate_transcode_environment()
+    if error_message:
+        print(f"runpod-worker-comfy - invalid transcoding settings, {error_message}")
+        sys.exit(1)
+    print(f"runpod-worker-comfy - processing up to {COMFY_JOB_CONCURRENCY} job(s) at the same time")
+    if comfy_pool is not None:
+        print(f"runpod-worker-comfy - dispatching jobs to {COMFY_INSTANCES} ComfyUI servers from port {COMFY_BASE_PORT}")
+    get_workflow_templates()
+    if os.environ.get("SERVE_API_LOCALLY", "false").lower() == "true":
+        serve_metrics(job_metrics, METRICS_PORT)
+        print(f"runpod-worker-comfy - serving metrics at http://0.0.0.0:{METRICS_PORT}/metrics")
+    if WARMUP:
+        # Jobs are only accepted once the warmup is done
+        warmup()
+    elif WORKFLOW_VALIDATION:
+        # Load the node schema while the worker waits for its first job
+        threading.Thread(target=load_node_schema, daemon=True).start()
+    startup_timeline.mark("worker_ready")
+    if STREAM_OUTPUTS:
+        print(f"runpod-worker-comfy - streaming outputs as they are generated")
+        runpod.serverless.start(
+            {
+                "handler": async_stream_handler,
+                "concurrency_modifier": concurrency_modifier,
+                "return_aggregate_stream": True,
+                "refresh_worker": REFRESH_WORKER,
+            }
+        )
+    else:
+        runpod.serverless.start(
+            {"handler": async_handler, "concurrency_modifier": concurrency_modifier}
+        )
\ No newline at end of file
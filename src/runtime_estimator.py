@@ -0,0 +1,144 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+# Inputs that change how long a workflow runs. All other literal inputs, such as seeds and
+# prompts, are left out of the fingerprint, so that they share one estimate.
+RUNTIME_INPUTS = ("steps", "width", "height", "batch_size", "length", "denoise", "scale_by")
+
+
+def workflow_fingerprint(workflow):
+    """
+    Compute a fingerprint of the parts of a workflow that determine its runtime.
+
+    The fingerprint covers the structure of the graph (the links between the nodes), the
+    class of every node and the inputs in RUNTIME_INPUTS, e.g. the steps and the resolution.
+
+    Args:
+        workflow (dict): The workflow in API format
+
+    Returns:
+        str: The hex digest
+    """
+    nodes = []
+    for node_id, node in sorted(workflow.items()):
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs") or {}
+        nodes.append(
+            [
+                node_id,
+                node.get("class_type"),
+                # Links are [node_id, output_index]
+                sorted([name, value] for name, value in inputs.items() if isinstance(value, list)),
+                sorted([name, inputs[name]] for name in RUNTIME_INPUTS if name in inputs and not isinstance(inputs[name], list)),
+            ]
+        )
+    return hashlib.sha256(json.dumps(nodes, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def execution_seconds(history_entry):
+    """
+    Read how long ComfyUI executed a prompt from the status messages of its history.
+
+    Args:
+        history_entry (dict): The history of one prompt
+
+    Returns:
+        float: The seconds between "execution_start" and "execution_success", or None
+               if the history does not contain both
+    """
+    timestamps = {}
+    for message in (history_entry.get("status") or {}).get("messages") or []:
+        if isinstance(message, list) and len(message) == 2 and isinstance(message[1], dict):
+            if "timestamp" in message[1]:
+                timestamps[message[0]] = message[1]["timestamp"]
+    if "execution_start" in timestamps and "execution_success" in timestamps:
+        # ComfyUI records the timestamps in milliseconds
+        return max(0.0, (timestamps["execution_success"] - timestamps["execution_start"]) / 1000)
+    return None
+
+
+def next_poll_delay(elapsed, estimate, min_interval, max_interval):
+    """
+    Compute how long to wait before polling the history of a prompt again.
+
+    Until shortly before the expected finish, the poller sleeps in one go. Around the
+    expected finish it polls every `min_interval`, and the longer the prompt runs over,
+    the longer it waits, up to `max_interval`. Without an estimate, the prompt is
+    expected to finish right away.
+
+    Args:
+        elapsed (float): Seconds since the prompt was queued
+        estimate (float): The expected runtime in seconds, or None
+        min_interval (float): The shortest wait in seconds
+        max_interval (float): The longest wait in seconds after the expected finish
+
+    Returns:
+        float: The seconds to wait
+    """
+    min_interval = min(min_interval, max_interval)
+    estimate = estimate or 0.0
+    # Start polling a little before the expected finish, as the runtime varies between runs
+    poll_from = estimate * 0.9 - min_interval
+    if elapsed < poll_from:
+        return poll_from - elapsed
+    overrun = max(0.0, elapsed - estimate)
+    return min(max_interval, max(min_interval, overrun / 4))
+
+
+class RuntimeEstimator:
+    """
+    Keeps an exponentially weighted moving average of the runtime of each workflow fingerprint.
+
+    Args:
+        alpha (float): The weight of the latest runtime, between 0 and 1
+        max_entries (int): The number of fingerprints that are kept, the least recently
+                           used ones are forgotten first
+    """
+
+    def __init__(self, alpha=0.3, max_entries=1024):
+        self.alpha = alpha
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._estimates = OrderedDict()
+
+    def estimate(self, fingerprint):
+        """
+        Returns the expected runtime of a workflow.
+
+        Args:
+            fingerprint (str): The fingerprint of the workflow
+
+        Returns:
+            float: The expected runtime in seconds, or None if the workflow never ran
+        """
+        with self._lock:
+            if fingerprint not in self._estimates:
+                return None
+            self._estimates.move_to_end(fingerprint)
+            return self._estimates[fingerprint]
+
+    def observe(self, fingerprint, seconds):
+        """
+        Add the runtime of a finished workflow to its estimate.
+
+        Args:
+            fingerprint (str): The fingerprint of the workflow
+            seconds (float): The runtime in seconds
+
+        Returns:
+            float: The new estimate
+        """
+        with self._lock:
+            previous = self._estimates.pop(fingerprint, None)
+            estimate = seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+            self._estimates[fingerprint] = estimate
+            while len(self._estimates) > self.max_entries:
+                self._estimates.popitem(last=False)
+            return estimate
+
+    def __len__(self):
+        with self._lock:
+            return len(self._estimates)
@@ -1,20 +1,98 @@
 #!/usr/bin/env bash
 
+# Timestamps of the cold start, read by rp_handler.py
+export STARTUP_CONTAINER_START="$(date +%s.%N)"
+# The output of ComfyUI is also written here, to read the import times of the custom nodes
+export COMFY_LOG_PATH="${COMFY_LOG_PATH:-/tmp/comfyui.log}"
+# Number of ComfyUI servers, on consecutive ports from COMFY_BASE_PORT, also read by rp_handler.py
+export COMFY_INSTANCES="${COMFY_INSTANCES:-1}"
+export COMFY_BASE_PORT="${COMFY_BASE_PORT:-8188}"
+# How the servers share the machine: "gpu" gives each one a GPU, round robin, "cpu" gives
+# each one an equal share of the CPU cores, "none" leaves them alone
+COMFY_INSTANCE_PINNING="${COMFY_INSTANCE_PINNING:-gpu}"
+# Local copies of the models on the network volume, made by rp_handler.py
+export MODEL_CACHE_DIR="${MODEL_CACHE_DIR:-/tmp/runpod-worker-comfy/model-cache}"
+MODEL_PATHS_CONFIG="/tmp/runpod-worker-comfy/extra_model_paths.yaml"
+MODEL_PATHS_ARGS=()
+
 # Use libtcmalloc for better memory management
 TCMALLOC="$(ldconfig -p | grep -Po "libtcmalloc.so.\d" | head -n 1)"
 export LD_PRELOAD="${TCMALLOC}"
 
+# ComfyUI searches the local copies first, so a model is loaded from local disk once it was
+# copied. The folders are the ones of the network volume in extra_model_paths.yaml.
+MODEL_PREFETCH="${MODEL_PREFETCH:-true}"
+if [ "${MODEL_PREFETCH,,}" == "true" ]; then
+    mkdir -p "$(dirname "$MODEL_PATHS_CONFIG")"
+    cat > "$MODEL_PATHS_CONFIG" <<EOF
+runpod_worker_comfy_local_copies:
+  base_path: ${MODEL_CACHE_DIR}
+  is_default: true
+  checkpoints: checkpoints/
+  clip: clip/
+  clip_vision: clip_vision/
+  controlnet: controlnet/
+  loras: loras/
+  upscale_models: upscale_models/
+  vae: vae/
+  unet: unet/
+  diffusion_models: diffusion_models/
+  text_encoders: text_encoders/
+EOF
+    MODEL_PATHS_ARGS=(--extra-model-paths-config "$MODEL_PATHS_CONFIG")
+fi
+
+# Start ComfyUI server number $1 in the background
+start_comfyui() {
+    local index="$1"
+    local port=$((COMFY_BASE_PORT + index))
+    local args=(--disable-auto-launch --disable-metadata --port "$port" "${MODEL_PATHS_ARGS[@]}")
+    local launcher=()
+    local log_path="$COMFY_LOG_PATH"
+
+    if [ "$SERVE_API_LOCALLY" == "true" ]; then
+        args+=(--listen)
+    fi
+
+    if [ "$COMFY_INSTANCES" -gt 1 ]; then
+        # Each server saves its outputs in its own directory, so their file names do not collide
+        args+=(--output-directory "${COMFY_OUTPUT_PATH:-/comfyui/output}/${port}")
+        # ComfyUI empties its temp directory when it starts and exits, which must not remove
+        # the previews of the other servers
+        args+=(--temp-directory "/comfyui/temp/${port}")
+        # The first server keeps COMFY_LOG_PATH, which the import times are read from
+        if [ "$index" -gt 0 ]; then
+            log_path="${COMFY_LOG_PATH%.log}-${port}.log"
+        fi
+
+        if [ "$COMFY_INSTANCE_PINNING" == "gpu" ]; then
+            local gpus="$(nvidia-smi -L 2>/dev/null | wc -l)"
+            if [ "$gpus" -gt 0 ]; then
+                args+=(--cuda-device $((index % gpus)))
+            fi
+        elif [ "$COMFY_INSTANCE_PINNING" == "cpu" ]; then
+            local cores_per_instance=$(($(nproc) / COMFY_INSTANCES))
+            if [ "$cores_per_instance" -gt 0 ]; then
+                local first_core=$((index * cores_per_instance))
+                launcher=(taskset -c "${first_core}-$((first_core + cores_per_instance - 1))")
+            fi
+        fi
+    fi
+
+    echo "runpod-worker-comfy: Starting ComfyUI on port ${port}"
+    "${launcher[@]}" python3 -u /comfyui/main.py "${args[@]}" 2>&1 | tee "$log_path" &
+}
+
+export STARTUP_COMFYUI_LAUNCH="$(date +%s.%N)"
+for ((index = 0; index < COMFY_INSTANCES; index++)); do
+    start_comfyui "$index"
+done
+
+echo "runpod-worker-comfy: Starting RunPod Handler"
+export STARTUP_HANDLER_LAUNCH="$(date +%s.%N)"
 # Serve the API and don't shutdown the container
 if [ "$SERVE_API_LOCALLY" == "true" ]; then
-    echo "runpod-worker-comfy: Starting ComfyUI"
-    python3 /comfyui/main.py --disable-auto-launch --disable-metadata --listen &
-
-    echo "runpod-worker-comfy: Starting RunPod Handler"
     python3 -u /rp_handler.py --rp_serve_api --rp_api_host=0.0.0.0
 else
-    echo "runpod-worker-comfy: Starting ComfyUI"
-    python3 /comfyui/main.py --disable-auto-launch --disable-metadata &
-
-    echo "runpod-worker-comfy: Starting RunPod Handler"
     python3 -u /rp_handler.py
-fi
\ No newline at end of file
+fi
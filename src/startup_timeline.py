@@ -0,0 +1,135 @@
+import os
+import re
+import threading
+import time
+
+# Phases that start.sh records in environment variables before the handler runs
+ENVIRONMENT_PHASES = (
+    ("container_start", "STARTUP_CONTAINER_START"),
+    ("comfyui_launch", "STARTUP_COMFYUI_LAUNCH"),
+    ("handler_launch", "STARTUP_HANDLER_LAUNCH"),
+)
+# Headers of the reports ComfyUI logs after loading the custom nodes
+IMPORT_REPORTS = {
+    "Prestartup times for custom nodes:": "prestartup",
+    "Import times for custom nodes:": "import",
+}
+IMPORT_TIME_LINE = re.compile(r"^\s*([\d.]+) seconds( \(IMPORT FAILED\))?: (.+?)\s*$")
+
+
+def parse_import_times(log_text):
+    """
+    Parse the prestartup and import time reports of the custom nodes from the log of ComfyUI.
+
+    Args:
+        log_text (str): The output of ComfyUI
+
+    Returns:
+        dict: The "prestartup" and "import" entries, lists of dictionaries with the
+              'path' of the custom node, the 'seconds' it took and whether it 'failed'
+    """
+    reports = {"prestartup": [], "import": []}
+    current = None
+    for line in log_text.splitlines():
+        if line.strip() in IMPORT_REPORTS:
+            current = reports[IMPORT_REPORTS[line.strip()]]
+            continue
+        match = IMPORT_TIME_LINE.match(line) if current is not None else None
+        if match is None:
+            current = None
+            continue
+        current.append(
+            {
+                "path": match.group(3),
+                "seconds": float(match.group(1)),
+                "failed": match.group(2) is not None,
+            }
+        )
+    return reports
+
+
+def summarize_import_times(entries, slowest=5):
+    """Sum up the entries of one report of `parse_import_times`."""
+    return {
+        "count": len(entries),
+        "seconds": round(sum(entry["seconds"] for entry in entries), 3),
+        "slowest": sorted(entries, key=lambda entry: entry["seconds"], reverse=True)[:slowest],
+        "failed": [entry["path"] for entry in entries if entry["failed"]],
+    }
+
+
+class StartupTimeline:
+    """
+    Records when each phase of the cold start was reached, from the start of the
+    container until the first job was queued.
+
+    Phases are wall clock timestamps, so that the ones recorded by start.sh (read from
+    the environment) and by the handler can be put on one timeline. Only the first
+    time a phase is reached counts.
+
+    Args:
+        environ (dict, optional): The environment with the timestamps of start.sh
+    """
+
+    def __init__(self, environ=None):
+        environ = os.environ if environ is None else environ
+        self._lock = threading.Lock()
+        self._phases = {}
+        for name, variable in ENVIRONMENT_PHASES:
+            try:
+                self._phases[name] = float(environ[variable])
+            except (KeyError, ValueError):
+                pass
+
+    def mark(self, name, at=None):
+        """
+        Record that a phase was reached, unless it was reached before.
+
+        Args:
+            name (str): The name of the phase
+            at (float, optional): The wall clock time, defaults to now
+
+        Returns:
+            bool: True if this is the first time the phase was reached
+        """
+        with self._lock:
+            if name in self._phases:
+                return False
+            self._phases[name] = time.time() if at is None else at
+            return True
+
+    def record(self, comfy_log_path=None):
+        """
+        Build the structured record of the timeline.
+
+        Args:
+            comfy_log_path (str, optional): The log of ComfyUI to read the import times of the custom nodes from
+
+        Returns:
+            dict: The "phases" in order, each with the 'name', the 'at_s' seconds since the
+                  first phase and the 'duration_s' since the previous phase, the 'total_s'
+                  and, if the log is available, the import times of the "custom_nodes"
+        """
+        with self._lock:
+            phases = sorted(self._phases.items(), key=lambda phase: phase[1])
+
+        record = {"phases": [], "total_s": 0.0}
+        if phases:
+            origin = previous = phases[0][1]
+            for name, at in phases:
+                record["phases"].append(
+                    {"name": name, "at_s": round(at - origin, 3), "duration_s": round(at - previous, 3)}
+                )
+                previous = at
+            record["total_s"] = round(previous - origin, 3)
+
+        if comfy_log_path:
+            try:
+                with open(comfy_log_path, errors="replace") as log_file:
+                    reports = parse_import_times(log_file.read())
+                record["custom_nodes"] = {
+                    report: summarize_import_times(entries) for report, entries in reports.items()
+                }
+            except OSError:
+                pass
+        return record
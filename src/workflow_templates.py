@@ -0,0 +1,198 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+
+
+def _parse_target(target):
+    """Split a parameter target "<node id>.<input name>" into its parts."""
+    if not isinstance(target, str) or "." not in target:
+        return None
+    node_id, input_name = target.split(".", 1)
+    return (node_id, input_name) if node_id and input_name else None
+
+
+def _same_type(value, default):
+    # Numbers can be given for each other, ComfyUI converts them
+    if isinstance(default, bool) or isinstance(value, bool):
+        return isinstance(value, bool) and isinstance(default, bool)
+    if isinstance(default, (int, float)):
+        return isinstance(value, (int, float))
+    return isinstance(value, type(default))
+
+
+class WorkflowTemplate:
+    """
+    A workflow that is stored on the worker, with parameters that jobs can set.
+
+    Each parameter names the node inputs it sets, as "<node id>.<input name>". The values
+    of these inputs in the workflow are the defaults of the parameter.
+
+    Args:
+        name (str): The name jobs use for the template
+        workflow (dict): The workflow in API format
+        params (dict): The targets of each parameter, a single target or a list of them
+
+    Raises:
+        ValueError: If a parameter does not point to a value input of the workflow
+    """
+
+    def __init__(self, name, workflow, params):
+        if not isinstance(workflow, dict) or not workflow:
+            raise ValueError("'workflow' must be an object with at least one node")
+        if not isinstance(params, dict):
+            raise ValueError("'params' must be an object")
+
+        self.name = name
+        self.workflow = workflow
+        self.params = {}
+        for param, targets in params.items():
+            targets = [targets] if isinstance(targets, str) else targets
+            if not isinstance(targets, list) or not targets:
+                raise ValueError(f"parameter '{param}' must have a target or a list of targets")
+            parsed = []
+            for target in targets:
+                node_id, input_name = _parse_target(target) or (None, None)
+                node = workflow.get(node_id)
+                inputs = node.get("inputs") if isinstance(node, dict) else None
+                if not isinstance(inputs, dict) or input_name not in inputs:
+                    raise ValueError(f"target '{target}' of parameter '{param}' is not an input of the workflow")
+                if isinstance(inputs[input_name], list):
+                    raise ValueError(f"target '{target}' of parameter '{param}' is a link, not a value")
+                parsed.append((node_id, input_name))
+            self.params[param] = parsed
+
+        self.fingerprint = hashlib.sha256(
+            json.dumps([workflow, self.params], sort_keys=True, separators=(",", ":")).encode("utf-8")
+        ).hexdigest()
+        self._lock = threading.Lock()
+        # The validator the workflow was checked with, and the problems it found
+        self._validated = (None, [])
+
+    def defaults(self):
+        """
+        Returns:
+            dict: The default value of each parameter
+        """
+        return {
+            param: self.workflow[targets[0][0]]["inputs"][targets[0][1]]
+            for param, targets in self.params.items()
+        }
+
+    def values(self, params):
+        """
+        Returns:
+            dict: The value of each parameter, the given ones or the defaults
+        """
+        return {**self.defaults(), **(params or {})}
+
+    def bind(self, params):
+        """
+        Set the parameters of a job in the workflow.
+
+        The workflow of the template is not changed. Only the nodes with a parameter are
+        copied, all other nodes are shared with the template.
+
+        Args:
+            params (dict): The values of the parameters, the others keep their defaults
+
+        Returns:
+            tuple: A tuple (workflow, error_message), the workflow is None if a parameter is invalid
+        """
+        if params is None:
+            params = {}
+        if not isinstance(params, dict):
+            return None, "'params' must be an object"
+
+        defaults = self.defaults()
+        workflow = dict(self.workflow)
+        copied = set()
+        for param, value in params.items():
+            if param not in self.params:
+                expected = ", ".join(sorted(self.params)) or "none"
+                return None, f"Unknown parameter '{param}' for template '{self.name}', expected one of: {expected}"
+            if not _same_type(value, defaults[param]):
+                return None, f"Parameter '{param}' must be of type {type(defaults[param]).__name__}"
+            for node_id, input_name in self.params[param]:
+                if node_id not in copied:
+                    node = workflow[node_id]
+                    workflow[node_id] = {**node, "inputs": dict(node["inputs"])}
+                    copied.add(node_id)
+                workflow[node_id]["inputs"][input_name] = value
+        return workflow, None
+
+    def validate(self, validator, workflow, input_files=()):
+        """
+        Validate a workflow that was bound from this template.
+
+        The template is validated once for each validator, without the inputs that are
+        set by parameters. After that only these inputs are checked for each job.
+
+        Args:
+            validator (WorkflowValidator): Validates against the node schema of ComfyUI
+            workflow (dict): The workflow returned by `bind`
+            input_files (iterable): File names that are uploaded to the input directory with the job
+
+        Returns:
+            list: A description of every problem, empty if the workflow is valid
+        """
+        errors = self.prepare(validator)
+        if errors:
+            return errors
+        return validator.validate_values(workflow, self.targets(), input_files)
+
+    def prepare(self, validator):
+        """
+        Validate the template once for a validator, without the inputs that are set by parameters.
+
+        Args:
+            validator (WorkflowValidator): Validates against the node schema of ComfyUI
+
+        Returns:
+            list: A description of every problem, empty if the template is valid
+        """
+        with self._lock:
+            validated_with, errors = self._validated
+            if validated_with is not validator:
+                errors = [
+                    f"template '{self.name}': {error}"
+                    for error in validator.validate(self.workflow, skip=self.targets())
+                ]
+                self._validated = (validator, errors)
+        return errors
+
+    def targets(self):
+        """
+        Returns:
+            list: Tuples (node id, input name) of all inputs that are set by parameters
+        """
+        return [target for targets in self.params.values() for target in targets]
+
+
+def load_templates(directory):
+    """
+    Load the workflow templates of a directory.
+
+    Each "<name>.json" holds a template with a "workflow" in API format and its "params",
+    e.g. {"workflow": {...}, "params": {"prompt": "6.text", "seed": ["3.seed"]}}.
+    Templates that cannot be loaded are reported and skipped.
+
+    Args:
+        directory (str): The directory of the templates, it may not exist
+
+    Returns:
+        dict: The templates by name
+    """
+    templates = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            with open(path) as template_file:
+                content = json.load(template_file)
+            if not isinstance(content, dict):
+                raise ValueError("must be an object with 'workflow' and 'params'")
+            templates[name] = WorkflowTemplate(name, content.get("workflow"), content.get("params", {}))
+        except (OSError, ValueError) as e:
+            print(f"runpod-worker-comfy - could not load the workflow template {path}: {str(e)}")
+    return templates
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import uuid
+
+# Input types that hold a number, values are converted the same way ComfyUI does it
+NUMBER_TYPES = {"INT": int, "FLOAT": float}
+
+
+def schema_fingerprint(comfyui_version, snapshot_paths=(), custom_nodes_dir=None):
+    """
+    Compute a fingerprint of everything that changes the node schema of ComfyUI.
+
+    Args:
+        comfyui_version (str): The version reported by ComfyUI
+        snapshot_paths (iterable): Snapshot files that were used to install custom nodes
+        custom_nodes_dir (str, optional): The directory of the installed custom nodes
+
+    Returns:
+        str: A short hex digest
+    """
+    digest = hashlib.sha256(str(comfyui_version).encode("utf-8"))
+    for path in sorted(snapshot_paths):
+        try:
+            with open(path, "rb") as snapshot_file:
+                digest.update(b"\0" + snapshot_file.read())
+        except OSError:
+            pass
+    if custom_nodes_dir and os.path.isdir(custom_nodes_dir):
+        for name in sorted(os.listdir(custom_nodes_dir)):
+            digest.update(b"\0" + name.encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def load_object_info(directory, fingerprint):
+    """
+    Read a cached /object_info response.
+
+    Returns:
+        dict: The node schema, or None if it is not cached for this fingerprint
+    """
+    try:
+        with open(os.path.join(directory, f"object_info-{fingerprint}.json")) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def store_object_info(directory, fingerprint, object_info):
+    """Write an /object_info response to the cache, replacing an older copy at once."""
+    path = os.path.join(directory, f"object_info-{fingerprint}.json")
+    staging_path = f"{path}.{uuid.uuid4().hex}"
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(staging_path, "w") as cache_file:
+            json.dump(object_info, cache_file)
+        os.replace(staging_path, path)
+    except OSError as e:
+        print(f"runpod-worker-comfy - could not cache the node schema: {str(e)}")
+
+
+def _is_link(value):
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and isinstance(value[0], str)
+        and isinstance(value[1], int)
+    )
+
+
+def _types_match(output_type, input_type):
+    if "*" in (output_type, input_type) or output_type == input_type:
+        return True
+    # Some nodes accept or return several types, separated by commas
+    output_types = set(str(output_type).split(","))
+    input_types = set(str(input_type).split(","))
+    return bool(output_types & input_types)
+
+
+class WorkflowValidator:
+    """
+    Validates workflows in API format against the node schema of ComfyUI (its /object_info).
+
+    This catches the mistakes ComfyUI would reject after the job was queued: unknown node
+    classes, missing inputs, links to nodes or outputs that do not exist, links between
+    incompatible types, numbers out of range and unknown choices such as model file names.
+
+    Args:
+        object_info (dict): The response of GET /object_info
+    """
+
+    def __init__(self, object_info):
+        self.object_info = object_info
+
+    def validate(self, workflow, input_files=(), skip=()):
+        """
+        Validate a workflow.
+
+        Args:
+            workflow (dict): The workflow in API format
+            input_files (iterable): File names that are uploaded to the input directory with the job
+            skip (iterable): Tuples (node id, input name) of inputs whose values are not checked,
+                             see `validate_values`
+
+        Returns:
+            list: A description of every problem, empty if the workflow is valid
+        """
+        if not isinstance(workflow, dict) or not workflow:
+            return ["'workflow' must be an object with at least one node"]
+
+        input_files = set(input_files)
+        skip = set(skip)
+        errors = []
+        for node_id, node in workflow.items():
+            if not isinstance(node, dict) or not isinstance(node.get("inputs", {}), dict):
+                errors.append(f"node {node_id}: must be an object with 'class_type' and 'inputs'")
+                continue
+
+            class_type = node.get("class_type")
+            schema = self.object_info.get(class_type)
+            if schema is None:
+                errors.append(f"node {node_id}: unknown class_type '{class_type}'")
+                continue
+
+            errors.extend(
+                f"node {node_id} ({class_type}): {error}"
+                for error in self._validate_inputs(
+                    workflow, node.get("inputs", {}), schema, input_files,
+                    skip={name for skipped_id, name in skip if skipped_id == node_id},
+                )
+            )
+        return errors
+
+    def validate_values(self, workflow, targets, input_files=()):
+        """
+        Validate only some input values of a workflow, whose other inputs are known to be valid.
+
+        Args:
+            workflow (dict): The workflow in API format
+            targets (iterable): Tuples (node id, input name) of the inputs to check
+            input_files (iterable): File names that are uploaded to the input directory with the job
+
+        Returns:
+            list: A description of every problem, empty if the values are valid
+        """
+        input_files = set(input_files)
+        errors = []
+        for node_id, name in targets:
+            node = workflow.get(node_id) or {}
+            class_type = node.get("class_type")
+            schema = self.object_info.get(class_type, {}).get("input", {})
+            spec = schema.get("required", {}).get(name) or schema.get("optional", {}).get(name)
+            value = node.get("inputs", {}).get(name)
+            if not spec or _is_link(value):
+                continue
+            errors.extend(
+                f"node {node_id} ({class_type}): {error}"
+                for error in self._validate_value(name, value, spec, input_files)
+            )
+        return errors
+
+    def _validate_inputs(self, workflow, inputs, schema, input_files, skip=()):
+        required = schema.get("input", {}).get("required", {})
+        optional = schema.get("input", {}).get("optional", {})
+        unknown = [name for name in inputs if name not in required and name not in optional]
+
+        for name in required:
+            if name not in inputs:
+                hint = f", got unknown input(s) {', '.join(sorted(unknown))}" if unknown else ""
+                yield f"missing required input '{name}'{hint}"
+
+        for name, value in inputs.items():
+            spec = required.get(name) or optional.get(name)
+            if not spec or name in skip:
+                continue
+            if _is_link(value):
+                yield from self._validate_link(workflow, name, value, spec[0])
+            else:
+                yield from self._validate_value(name, value, spec, input_files)
+
+    def _validate_link(self, workflow, name, link, input_type):
+        source_id, output_index = link
+        source = workflow.get(source_id)
+        if not isinstance(source, dict):
+            yield f"input '{name}' links to node {source_id}, which does not exist"
+            return
+
+        source_schema = self.object_info.get(source.get("class_type"))
+        if source_schema is None:
+            # Already reported for the source node itself
+            return
+        outputs = source_schema.get("output", [])
+        if not 0 <= output_index < len(outputs):
+            yield f"input '{name}' links to output {output_index} of node {source_id}, which has {len(outputs)} output(s)"
+            return
+        if isinstance(input_type, str) and not _types_match(outputs[output_index], input_type):
+            yield f"input '{name}' expects {input_type}, but output {output_index} of node {source_id} is {outputs[output_index]}"
+
+    def _validate_value(self, name, value, spec, input_files):
+        input_type = spec[0]
+        options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+
+        # Choices are either listed in place of the type or, in newer versions, as COMBO options
+        choices = input_type if isinstance(input_type, list) else None
+        if input_type == "COMBO":
+            choices = options.get("options")
+        if choices is not None:
+            if value not in choices and value not in input_files:
+                yield f"'{value}' is not a valid choice for input '{name}'"
+            return
+
+        if input_type in NUMBER_TYPES:
+            try:
+                number = NUMBER_TYPES[input_type](value)
+            except (TypeError, ValueError):
+                yield f"input '{name}' must be of type {input_type}, got {value!r}"
+                return
+            if "min" in options and number < options["min"]:
+                yield f"input '{name}' is {number}, below the minimum of {options['min']}"
+            if "max" in options and number > options["max"]:
+                yield f"input '{name}' is {number}, above the maximum of {options['max']}"
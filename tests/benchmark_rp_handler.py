@@ -0,0 +1,252 @@
+"""
+End-to-end benchmarks of the handler against the fake ComfyUI server.
+
+Every scenario runs in a fresh Python process, so that its peak RSS is not inflated
+by the scenarios before it. The fake executes prompts almost instantly, so the numbers are the
+overhead of the worker itself: uploading inputs, queueing, waiting and delivering outputs.
+No GPU is needed.
+
+Usage:
+    python -m tests.benchmark_rp_handler
+    python -m tests.benchmark_rp_handler --scenario huge_images --jobs 5 --concurrency 2 --json
+"""
+
+import argparse
+import base64
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+# Scenarios and their default number of jobs
+SCENARIOS = {
+    "small_images": {
+        "description": "4 outputs of 256x256 per job, returned as base64",
+        "jobs": 50,
+        "output_images": 4,
+        "output_size": (256, 256),
+    },
+    "huge_images": {
+        "description": "2 outputs of 3072x3072 per job, returned as base64",
+        "jobs": 5,
+        "output_images": 2,
+        "output_size": (3072, 3072),
+        "environment": {"BASE64_RESPONSE_BUDGET_MB": "1000"},
+    },
+    "many_uploads": {
+        "description": "16 input images of 256 KB per job",
+        "jobs": 20,
+        "input_images": 16,
+        "input_size": 256 * 1024,
+    },
+    "direct_inputs": {
+        "description": "16 input images of 256 KB per job, written into the input directory of ComfyUI",
+        "jobs": 20,
+        "input_images": 16,
+        "input_size": 256 * 1024,
+        "direct_input": True,
+    },
+    "azure_delivery": {
+        "description": "4 outputs of 1024x1024 per job, uploaded to an in-memory Azure container",
+        "jobs": 20,
+        "output_images": 4,
+        "output_size": (1024, 1024),
+        "environment": {"IMAGE_RETURN_METHOD": "azure", "AZURE_STORAGE_CONNECTION_STRING": "UseDevelopmentStorage=true"},
+    },
+    "webp_transcode": {
+        "description": "4 outputs of 512x512 per job, transcoded to WebP and returned as base64",
+        "jobs": 10,
+        "output_images": 4,
+        "output_size": (512, 512),
+        "transcode": "webp",
+    },
+}
+
+
+def percentile(values, fraction):
+    """Returns the value below which `fraction` of the sorted values fall, by nearest rank."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def import_handler():
+    """Import rp_handler with the RunPod SDK and Azure replaced, like the unit tests do."""
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    sys.path.append(root)
+    sys.path.append(os.path.join(root, "src"))
+    for module in (
+        "runpod",
+        "runpod.serverless",
+        "runpod.serverless.utils",
+        "runpod.serverless.utils.rp_upload",
+        "azure.storage.blob",
+        "azure.identity",
+    ):
+        sys.modules[module] = MagicMock()
+
+    import rp_handler
+    from tests.fake_azure_blob import FakeBlobServiceClient
+
+    rp_handler.BlobServiceClient = FakeBlobServiceClient
+    # Do not spend the warmup or the schema fetch of a real worker on the benchmark
+    rp_handler.WORKFLOW_VALIDATION = False
+    return rp_handler, FakeBlobServiceClient
+
+
+def run_scenario(name, jobs=None, concurrency=1):
+    """
+    Run one scenario in the current process.
+
+    Args:
+        name (str): The name of the scenario in SCENARIOS
+        jobs (int, optional): The number of jobs, instead of the default of the scenario
+        concurrency (int): The number of jobs that run at the same time
+
+    Returns:
+        dict: The latency percentiles, the throughput, the bytes moved and the peak RSS
+    """
+    rp_handler, FakeBlobServiceClient = import_handler()
+    from comfy_client import ComfyClient
+    from tests.fake_comfyui import FakeComfyUI
+
+    scenario = SCENARIOS[name]
+    jobs = jobs or scenario["jobs"]
+    output_dir = tempfile.mkdtemp()
+    input_dir = tempfile.mkdtemp()
+
+    def make_job(number):
+        job_input = {"workflow": {"9": {"class_type": "SaveImage", "inputs": {"seed": number}}}}
+        if scenario.get("input_images"):
+            job_input["images"] = [
+                {"name": f"input_{number}_{index}.png", "image": base64.b64encode(os.urandom(scenario["input_size"])).decode("utf-8")}
+                for index in range(scenario["input_images"])
+            ]
+        if scenario.get("transcode"):
+            job_input["transcode"] = scenario["transcode"]
+        return {"id": f"benchmark-{number}", "input": job_input}
+
+    def run_job(job):
+        start = time.monotonic()
+        result = rp_handler.handler(job)
+        return time.monotonic() - start, result
+
+    environment = {"COMFY_OUTPUT_PATH": output_dir, **scenario.get("environment", {})}
+    fake = FakeComfyUI(
+        execution_time=0.001,
+        output_dir=output_dir,
+        output_images=scenario.get("output_images", 1),
+        output_size=scenario.get("output_size", (64, 64)),
+        input_dir=input_dir,
+    )
+    try:
+        with fake, patch.dict(os.environ, environment):
+            if "BASE64_RESPONSE_BUDGET_MB" in environment:
+                rp_handler.BASE64_RESPONSE_BUDGET_MB = float(environment["BASE64_RESPONSE_BUDGET_MB"])
+            # The fake shares its input directory with the worker only in the scenarios that say so
+            rp_handler.COMFY_INPUT_PATH = input_dir
+            rp_handler.COMFY_INPUT_MODE = "auto" if scenario.get("direct_input") else "upload"
+            rp_handler.comfy = ComfyClient(fake.host, pool_size=max(4, concurrency * 2))
+            job_list = [make_job(number) for number in range(jobs)]
+
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(run_job, job_list))
+            elapsed = time.monotonic() - start
+            bytes_in = sum(os.path.getsize(os.path.join(input_dir, name)) for name in os.listdir(input_dir))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        shutil.rmtree(input_dir, ignore_errors=True)
+
+    latencies = [latency for latency, _ in results]
+    failed = [result for _, result in results if result.get("status") != "success" or result.get("errors")]
+    bytes_out = sum(
+        len(image["image"])
+        for _, result in results
+        if isinstance(result.get("message"), list)
+        for image in result["message"]
+        if image["imageType"] == "base64"
+    )
+    for service in FakeBlobServiceClient.instances:
+        bytes_out += sum(len(content) for blobs in service.containers.values() for content in blobs.values())
+
+    return {
+        "scenario": name,
+        "jobs": jobs,
+        "concurrency": concurrency,
+        "failed": len(failed),
+        "latency_s": {
+            "p50": round(percentile(latencies, 0.5), 4),
+            "p90": round(percentile(latencies, 0.9), 4),
+            "p99": round(percentile(latencies, 0.99), 4),
+            "max": round(max(latencies), 4),
+        },
+        "throughput_jobs_per_s": round(jobs / elapsed, 2),
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_out,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_in_subprocess(name, jobs=None, concurrency=1, verbose=False):
+    """Run one scenario in a new Python process and return its report."""
+    command = [sys.executable, "-m", "tests.benchmark_rp_handler", "--child", name, "--concurrency", str(concurrency)]
+    if jobs:
+        command += ["--jobs", str(jobs)]
+    if verbose:
+        command.append("--verbose")
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    completed = subprocess.run(command, cwd=root, stdout=subprocess.PIPE, text=True)
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        return {"scenario": name, "error": f"exit code {completed.returncode}"}
+    return json.loads(lines[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the handler against a fake ComfyUI server.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run, all by default")
+    parser.add_argument("--jobs", type=int, help="Number of jobs per scenario, instead of the default of each scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of jobs that run at the same time")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per scenario")
+    parser.add_argument("--verbose", action="store_true", help="Show the log of the handler")
+    parser.add_argument("--child", choices=sorted(SCENARIOS), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        # The report is the only output, the log of the handler goes to stderr or nowhere
+        report_stream = sys.stdout
+        sys.stdout = sys.stderr if args.verbose else open(os.devnull, "w")
+        report = run_scenario(args.child, args.jobs, args.concurrency)
+        report_stream.write(json.dumps(report) + "\n")
+        report_stream.flush()
+        return
+
+    for name in args.scenario or SCENARIOS:
+        report = run_in_subprocess(name, args.jobs, args.concurrency, args.verbose)
+        if args.json:
+            print(json.dumps(report), flush=True)
+        elif "error" in report:
+            print(f"{name}: failed with {report['error']}", flush=True)
+        else:
+            latency = report["latency_s"]
+            print(
+                f"{name:<16} {report['jobs']:>4} jobs  "
+                f"p50 {latency['p50'] * 1000:8.1f} ms  p90 {latency['p90'] * 1000:8.1f} ms  "
+                f"p99 {latency['p99'] * 1000:8.1f} ms  {report['throughput_jobs_per_s']:7.2f} jobs/s  "
+                f"in {report['bytes_in'] / 1e6:8.1f} MB  out {report['bytes_out'] / 1e6:8.1f} MB  "
+                f"peak RSS {report['peak_rss_mb']:7.1f} MB  failed {report['failed']}",
+                flush=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+An in-memory stand-in for the parts of azure.storage.blob.BlobServiceClient the worker uses.
+
+Like Azurite, it keeps containers and blobs, and it splits uploads that are larger than
+`max_single_put_size` into blocks of `max_block_size`, so tests can check how files are uploaded.
+"""
+
+import hashlib
+import threading
+
+
+class FakeBlobProperties:
+    def __init__(self, name, size, etag=None):
+        self.name = name
+        self.size = size
+        self.etag = etag
+
+
+class FakeDownloader:
+    def __init__(self, content):
+        self._content = content
+
+    def readall(self):
+        return self._content
+
+    def readinto(self, stream):
+        stream.write(self._content)
+        return len(self._content)
+
+    def chunks(self, chunk_size=4 * 1024 * 1024):
+        for start in range(0, len(self._content), chunk_size):
+            yield self._content[start:start + chunk_size]
+
+
+class FakeContainerClient:
+    def __init__(self, service, name):
+        self._service = service
+        self.name = name
+
+    def _blobs(self):
+        if self.name not in self._service.containers:
+            raise RuntimeError("ContainerNotFound")
+        return self._service.containers[self.name]
+
+    def list_blobs(self, name_starts_with=None):
+        return [
+            FakeBlobProperties(name, len(content))
+            for name, content in sorted(self._blobs().items())
+            if name_starts_with is None or name.startswith(name_starts_with)
+        ]
+
+    def download_blob(self, blob):
+        blobs = self._blobs()
+        if blob not in blobs:
+            raise RuntimeError("BlobNotFound")
+        return FakeDownloader(blobs[blob])
+
+    def upload_blob(self, name, data, overwrite=False, **kwargs):
+        FakeBlobClient(self._service, self.name, name).upload_blob(data, overwrite=overwrite, **kwargs)
+
+    def exists(self):
+        self._service.calls.append(("exists", self.name))
+        return self.name in self._service.containers
+
+    def create_container(self):
+        self._service.calls.append(("create_container", self.name))
+        if self.name in self._service.containers:
+            raise RuntimeError("ContainerAlreadyExists")
+        self._service.containers[self.name] = {}
+
+
+class FakeBlobClient:
+    def __init__(self, service, container, blob):
+        self._service = service
+        self.container = container
+        self.blob = blob
+        self.url = f"{service.url}/{container}/{blob}"
+
+    def _content(self):
+        blobs = self._service.containers.get(self.container, {})
+        if self.blob not in blobs:
+            raise RuntimeError("BlobNotFound")
+        return blobs[self.blob]
+
+    def get_blob_properties(self):
+        self._service.calls.append(("get_blob_properties", self.blob))
+        content = self._content()
+        return FakeBlobProperties(self.blob, len(content), f'"{hashlib.md5(content).hexdigest()}"')
+
+    def download_blob(self):
+        self._service.calls.append(("download_blob", self.blob))
+        return FakeDownloader(self._content())
+
+    def upload_blob(self, data, overwrite=False, length=None, max_concurrency=1):
+        if self.container not in self._service.containers:
+            raise RuntimeError("ContainerNotFound")
+        blobs = self._service.containers[self.container]
+        if self.blob in blobs and not overwrite:
+            raise RuntimeError("BlobAlreadyExists")
+
+        content = data.read()
+        if len(content) > self._service.max_single_put_size:
+            block_size = self._service.max_block_size
+            blocks = [content[i:i + block_size] for i in range(0, len(content), block_size)]
+        else:
+            blocks = [content]
+
+        with self._service.lock:
+            blobs[self.blob] = b"".join(blocks)
+            self._service.uploads.append(
+                {"blob": self.blob, "blocks": len(blocks), "max_concurrency": max_concurrency}
+            )
+
+
+class FakeBlobServiceClient:
+    instances = []
+
+    def __init__(self, connection_string, max_block_size=4 * 1024 * 1024, max_single_put_size=64 * 1024 * 1024):
+        self.connection_string = connection_string
+        self.max_block_size = max_block_size
+        self.max_single_put_size = max_single_put_size
+        self.url = "http://127.0.0.1:10000/devstoreaccount1"
+        self.containers = {}
+        self.uploads = []
+        self.calls = []
+        self.lock = threading.Lock()
+        FakeBlobServiceClient.instances.append(self)
+
+    @classmethod
+    def from_connection_string(cls, connection_string, **kwargs):
+        return cls(connection_string, **kwargs)
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self, container)
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self, container, blob)
@@ -0,0 +1,528 @@
+"""
+A small in-process stand-in for the ComfyUI API, used by the tests.
+
+It implements just enough of ComfyUI to exercise the worker without a GPU:
+
+- POST /upload/image stores an input image
+- POST /prompt queues a prompt and "executes" it on a background thread, optionally
+  writing real image files into an output directory
+- GET /history/{prompt_id} returns the history once the prompt finished
+- GET /queue lists the running and pending prompts, POST /queue deletes pending ones
+- POST /interrupt stops the running prompt, or only the given "prompt_id"
+- POST /free records the request to unload the models or free the memory
+- GET /ws?clientId=... streams the same JSON events ComfyUI sends over its WebSocket
+- GET /system_stats and GET /object_info describe the server and its node classes
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from PIL import Image
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def websocket_frame(payload, opcode=0x1):
+    """
+    Build a single unmasked WebSocket frame as a server would send it.
+
+    Args:
+        payload (bytes): The frame payload
+        opcode (int): The frame opcode, 0x1 for text and 0x8 for close
+
+    Returns:
+        bytes: The encoded frame
+    """
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 65536:
+        header += bytes([126]) + length.to_bytes(2, "big")
+    else:
+        header += bytes([127]) + length.to_bytes(8, "big")
+    return header + payload
+
+
+def read_websocket_frame(stream):
+    """
+    Read a single (masked) client frame and return its opcode, or None when the stream ended.
+
+    Args:
+        stream: The file-like object of the connection
+
+    Returns:
+        int: The opcode of the frame
+    """
+    header = stream.read(2)
+    if len(header) < 2:
+        return None
+    length = header[1] & 0x7F
+    if length == 126:
+        length = int.from_bytes(stream.read(2), "big")
+    elif length == 127:
+        length = int.from_bytes(stream.read(8), "big")
+    mask_length = 4 if header[1] & 0x80 else 0
+    stream.read(mask_length + length)
+    return header[0] & 0x0F
+
+
+def parse_multipart(content_type, body):
+    """
+    Parse a multipart/form-data body.
+
+    Returns:
+        dict: Tuples (filename, content) keyed by field name, filename is None for plain fields
+    """
+    message = BytesParser(policy=policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body
+    )
+    return {
+        part.get_param("name", header="content-disposition"): (part.get_filename(), part.get_payload(decode=True))
+        for part in message.iter_parts()
+    }
+
+
+def noise_png(size):
+    """
+    Encode an image of random noise as PNG, which does not compress, like a real photo.
+
+    Args:
+        size (tuple): The width and height of the image
+
+    Returns:
+        bytes: The PNG file
+    """
+    image = Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+class FakeComfyUI:
+    """
+    Fake ComfyUI server running on a random local port.
+
+    Args:
+        execution_time (float): Seconds each prompt "runs" before it completes
+        outputs (dict): The outputs stored in the history of every finished prompt
+        drop_websocket (bool): Close every WebSocket right after the initial status message
+        send_websocket_events (bool): Whether execution events are pushed over the WebSocket at all
+        progress_steps (int): Number of "progress" events sent while each node executes
+        object_info (dict): The node schema served at /object_info, which responds 404 if it is None
+        output_dir (str): Write real PNG files for every prompt into this directory. The history
+                          then lists these files instead of `outputs`
+        output_images (int): Number of images each prompt writes into `output_dir`
+        output_size (tuple): Width and height of these images
+        input_dir (str): Write uploaded images into this directory
+        request_latency (float): Seconds added to every HTTP request
+        fail_requests (dict): Number of requests to a path (e.g. "/prompt") that fail with 503
+                              before the path works again
+        execution_error (str): Let every prompt fail with this exception message
+        sequential (bool): Execute one prompt at a time in the order they were queued, like
+                           ComfyUI does, instead of all of them at the same time
+        memory_usage (float): Fraction of the VRAM reported as used by /system_stats, which
+                              reports no devices if it is None
+    """
+
+    def __init__(
+        self,
+        execution_time=0.05,
+        outputs=None,
+        drop_websocket=False,
+        send_websocket_events=True,
+        progress_steps=0,
+        object_info=None,
+        output_dir=None,
+        output_images=1,
+        output_size=(64, 64),
+        input_dir=None,
+        request_latency=0.0,
+        fail_requests=None,
+        execution_error=None,
+        sequential=False,
+        memory_usage=None,
+    ):
+        self.execution_time = execution_time
+        self.outputs = outputs if outputs is not None else {
+            "9": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}]}
+        }
+        self.drop_websocket = drop_websocket
+        self.send_websocket_events = send_websocket_events
+        self.progress_steps = progress_steps
+        self.object_info = object_info
+        self.output_dir = output_dir
+        self.output_images = output_images
+        self.output_size = output_size
+        self.input_dir = input_dir
+        self.request_latency = request_latency
+        self.fail_requests = dict(fail_requests or {})
+        self.execution_error = execution_error
+        self.sequential = sequential
+        self.memory_usage = memory_usage
+
+        self.uploads = {}
+        self.history = {}
+        self.prompts = {}
+        self.request_log = []
+        self.queue_running = []
+        self.queue_pending = []
+        self.interrupted = []
+        self.deleted = []
+        self.freed = []
+        self._interrupts = {}
+        self._clients = {}
+        self._image_counter = 0
+        self._image_content = None
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def host(self):
+        """The "host:port" of the server, in the same form as COMFY_HOST."""
+        return f"127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self._thread.start()
+        if self.sequential:
+            threading.Thread(target=self._run_queue, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._pending.put(None)
+        with self._lock:
+            for client in self._clients.values():
+                client.put(None)
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def send_event(self, client_id, event_type, data):
+        """Push a JSON event to the WebSocket of `client_id`, if it is connected."""
+        with self._lock:
+            client = self._clients.get(client_id)
+        if client is not None:
+            client.put(json.dumps({"type": event_type, "data": data}))
+
+    def _write_outputs(self):
+        """Write the output images of one prompt and return its "outputs"."""
+        with self._lock:
+            if self._image_content is None:
+                self._image_content = noise_png(self.output_size)
+            first = self._image_counter + 1
+            self._image_counter += self.output_images
+
+        images = []
+        for number in range(first, first + self.output_images):
+            filename = f"ComfyUI_{number:05d}_.png"
+            with open(os.path.join(self.output_dir, filename), "wb") as image_file:
+                image_file.write(self._image_content)
+            images.append({"filename": filename, "subfolder": "", "type": "output"})
+        return {"9": {"images": images}}
+
+    def _fail_request(self, path):
+        """Whether the next request to `path` should fail, counting down the injected failures."""
+        with self._lock:
+            remaining = self.fail_requests.get(path, 0)
+            if remaining:
+                self.fail_requests[path] = remaining - 1
+            return remaining > 0
+
+    def _run_queue(self):
+        while (prompt := self._pending.get()) is not None:
+            with self._lock:
+                deleted = prompt[0] not in self.queue_pending
+            if not deleted:
+                self._execute(*prompt)
+
+    def _interrupt(self, prompt_id=None):
+        """Stop `prompt_id` if it is running, or all running prompts."""
+        with self._lock:
+            for running_id in self.queue_running:
+                if prompt_id is None or running_id == prompt_id:
+                    self.interrupted.append(running_id)
+                    self._interrupts[running_id].set()
+
+    def _execute(self, prompt_id, client_id, workflow):
+        with self._lock:
+            if prompt_id in self.queue_pending:
+                self.queue_pending.remove(prompt_id)
+            self.queue_running.append(prompt_id)
+            interrupt = self._interrupts[prompt_id] = threading.Event()
+        try:
+            self._run_prompt(prompt_id, client_id, workflow, interrupt)
+        finally:
+            with self._lock:
+                self.queue_running.remove(prompt_id)
+                del self._interrupts[prompt_id]
+
+    def _run_prompt(self, prompt_id, client_id, workflow, interrupt):
+        events = self.send_websocket_events and client_id is not None
+        outputs = self._write_outputs() if self.output_dir else self.outputs
+        # ComfyUI records the timestamps of the status messages in milliseconds
+        started = int(time.time() * 1000)
+
+        if events:
+            self.send_event(client_id, "execution_start", {"prompt_id": prompt_id})
+
+        node_ids = list(workflow.keys()) if isinstance(workflow, dict) else []
+        step_time = self.execution_time / max(len(node_ids), 1)
+        for node_id in node_ids:
+            if events:
+                self.send_event(client_id, "executing", {"node": node_id, "prompt_id": prompt_id})
+            if interrupt.wait(step_time):
+                break
+            if events:
+                for step in range(1, self.progress_steps + 1):
+                    self.send_event(
+                        client_id,
+                        "progress",
+                        {"value": step, "max": self.progress_steps, "node": node_id, "prompt_id": prompt_id},
+                    )
+            if self.execution_error:
+                break
+            if events and node_id in outputs:
+                self.send_event(
+                    client_id,
+                    "executed",
+                    {"node": node_id, "output": outputs[node_id], "prompt_id": prompt_id},
+                )
+        if not node_ids:
+            interrupt.wait(self.execution_time)
+
+        if interrupt.is_set():
+            message = {"prompt_id": prompt_id, "node_id": node_id if node_ids else None, "executed": []}
+            with self._lock:
+                self.history[prompt_id] = {
+                    "prompt": [0, prompt_id, workflow, {"client_id": client_id}, []],
+                    "outputs": {},
+                    "status": {
+                        "status_str": "error",
+                        "completed": False,
+                        "messages": [["execution_interrupted", message]],
+                    },
+                }
+            if events:
+                self.send_event(client_id, "execution_interrupted", message)
+            return
+
+        if self.execution_error:
+            failed_node = node_ids[0] if node_ids else None
+            message = {
+                "prompt_id": prompt_id,
+                "node_id": failed_node,
+                "node_type": (workflow.get(failed_node) or {}).get("class_type") if failed_node else None,
+                "exception_message": self.execution_error,
+            }
+            with self._lock:
+                self.history[prompt_id] = {
+                    "prompt": [0, prompt_id, workflow, {"client_id": client_id}, []],
+                    "outputs": {},
+                    "status": {"status_str": "error", "completed": False, "messages": [["execution_error", message]]},
+                }
+            if events:
+                self.send_event(client_id, "execution_error", message)
+            return
+
+        with self._lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, workflow, {"client_id": client_id}, list(outputs)],
+                "outputs": outputs,
+                "status": {
+                    "status_str": "success",
+                    "completed": True,
+                    "messages": [
+                        ["execution_start", {"prompt_id": prompt_id, "timestamp": started}],
+                        ["execution_success", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)}],
+                    ],
+                },
+            }
+
+        if events:
+            self.send_event(client_id, "execution_success", {"prompt_id": prompt_id})
+            self.send_event(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, without this the client waits for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, payload, status=200):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return self.rfile.read(length) if length else b""
+
+            def _inject(self, path):
+                """Apply the latency and failures that were configured, True if the request failed."""
+                if fake.request_latency:
+                    time.sleep(fake.request_latency)
+                if fake._fail_request(path):
+                    self._send_json({"error": "injected failure"}, status=503)
+                    return True
+                return False
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                fake.request_log.append(("GET", url.path))
+                if url.path != "/ws" and self._inject(url.path):
+                    return
+
+                if url.path == "/":
+                    self._send_json({})
+                elif url.path == "/system_stats":
+                    devices = []
+                    if fake.memory_usage is not None:
+                        vram_total = 24 * 1024 ** 3
+                        vram_free = int(vram_total * (1 - fake.memory_usage))
+                        devices.append({"name": "cuda:0", "type": "cuda", "vram_total": vram_total, "vram_free": vram_free})
+                    self._send_json({"system": {"comfyui_version": "0.0.0-fake", "python_version": "3"}, "devices": devices})
+                elif url.path == "/object_info" and fake.object_info is not None:
+                    self._send_json(fake.object_info)
+                elif url.path == "/ws":
+                    client_id = parse_qs(url.query).get("clientId", [uuid.uuid4().hex])[0]
+                    self._serve_websocket(client_id)
+                elif url.path == "/queue":
+                    with fake._lock:
+                        self._send_json({
+                            "queue_running": [[0, prompt_id, {}, {}, []] for prompt_id in fake.queue_running],
+                            "queue_pending": [[0, prompt_id, {}, {}, []] for prompt_id in fake.queue_pending],
+                        })
+                elif url.path.startswith("/history/"):
+                    prompt_id = url.path[len("/history/"):]
+                    with fake._lock:
+                        entry = fake.history.get(prompt_id)
+                    self._send_json({prompt_id: entry} if entry else {})
+                else:
+                    self._send_json({"error": "not found"}, status=404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                fake.request_log.append(("POST", url.path))
+                body = self._read_body()
+                if self._inject(url.path):
+                    return
+
+                if url.path == "/upload/image":
+                    name, content = parse_multipart(self.headers.get("Content-Type", ""), body)["image"]
+                    with fake._lock:
+                        fake.uploads[name] = content
+                    if fake.input_dir:
+                        with open(os.path.join(fake.input_dir, name), "wb") as image_file:
+                            image_file.write(content)
+                    self._send_json({"name": name, "subfolder": "", "type": "input"})
+                elif url.path == "/prompt":
+                    payload = json.loads(body)
+                    prompt_id = str(uuid.uuid4())
+                    client_id = payload.get("client_id")
+                    with fake._lock:
+                        fake.prompts[prompt_id] = payload
+                        if fake.sequential:
+                            fake.queue_pending.append(prompt_id)
+                    prompt = (prompt_id, client_id, payload.get("prompt"))
+                    if fake.sequential:
+                        fake._pending.put(prompt)
+                    else:
+                        threading.Thread(target=fake._execute, args=prompt, daemon=True).start()
+                    self._send_json({"prompt_id": prompt_id, "number": len(fake.prompts), "node_errors": {}})
+                elif url.path == "/queue":
+                    payload = json.loads(body or b"{}")
+                    with fake._lock:
+                        for prompt_id in payload.get("delete", []):
+                            if prompt_id in fake.queue_pending:
+                                fake.queue_pending.remove(prompt_id)
+                                fake.deleted.append(prompt_id)
+                    self._send_json({})
+                elif url.path == "/free":
+                    with fake._lock:
+                        fake.freed.append(json.loads(body or b"{}"))
+                    self._send_json({})
+                elif url.path == "/interrupt":
+                    fake._interrupt(json.loads(body or b"{}").get("prompt_id"))
+                    self._send_json({})
+                else:
+                    self._send_json({"error": "not found"}, status=404)
+
+            def _serve_websocket(self, client_id):
+                key = self.headers.get("Sec-WebSocket-Key", "")
+                accept = base64.b64encode(
+                    hashlib.sha1((key + WEBSOCKET_GUID).encode("utf-8")).digest()
+                ).decode("utf-8")
+                self.send_response(101, "Switching Protocols")
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.close_connection = True
+
+                messages = queue.Queue()
+                with fake._lock:
+                    fake._clients[client_id] = messages
+
+                def read_until_close():
+                    try:
+                        while read_websocket_frame(self.rfile) not in (None, 0x8):
+                            pass
+                    except (OSError, ValueError):
+                        pass
+                    messages.put(None)
+
+                threading.Thread(target=read_until_close, daemon=True).start()
+
+                status = {"status": {"exec_info": {"queue_remaining": 0}}, "sid": client_id}
+                try:
+                    self.wfile.write(websocket_frame(json.dumps({"type": "status", "data": status}).encode("utf-8")))
+                    self.wfile.flush()
+                    if fake.drop_websocket:
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                        return
+                    while True:
+                        message = messages.get()
+                        if message is None:
+                            self.wfile.write(websocket_frame(b"", opcode=0x8))
+                            return
+                        self.wfile.write(websocket_frame(message.encode("utf-8")))
+                        self.wfile.flush()
+                except OSError:
+                    pass
+                finally:
+                    with fake._lock:
+                        if fake._clients.get(client_id) is messages:
+                            del fake._clients[client_id]
+
+        return Handler
@@ -0,0 +1,89 @@
+"""
+A small in-process HTTP server that serves files from memory, used by the tests.
+
+Like most object stores and CDNs, it sends an ETag with every file and answers a
+request with a matching If-None-Match with 304 Not Modified.
+"""
+
+import hashlib
+import threading
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeFileServer:
+    """
+    Fake file server running on a random local port.
+
+    Args:
+        files (dict): The content of the files, keyed by path (e.g. "/images/cat.png")
+        send_etag (bool): Whether responses carry an ETag
+    """
+
+    def __init__(self, files=None, send_etag=True):
+        self.files = dict(files or {})
+        self.send_etag = send_etag
+        self.request_log = []
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def url(self, path):
+        """The URL of a file on this server."""
+        return f"http://127.0.0.1:{self._server.server_address[1]}{path}"
+
+    def requests_to(self, path):
+        """The status codes of the requests to `path`, in order."""
+        return [status for request_path, status in self.request_log if request_path == path]
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, status, body=b"", headers=None):
+                # Query strings, e.g. the signature of a presigned URL, are ignored like the key does
+                server.request_log.append((urlparse(self.path).path, status))
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                content = server.files.get(urlparse(self.path).path)
+                if content is None:
+                    self._respond(404)
+                    return
+
+                etag = f'"{hashlib.md5(content).hexdigest()}"'
+                headers = {"ETag": etag} if server.send_etag else {}
+                if server.send_etag and self.headers.get("If-None-Match") == etag:
+                    self._respond(304, headers=headers)
+                else:
+                    self._respond(200, content, {"Content-Type": "image/png", **headers})
+
+        return Handler
@@ -0,0 +1,58 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+import os
+
+import requests
+
+# Make sure that "src" is known and can be used to import comfy_client.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from comfy_client import ComfyClient
+from tests.fake_comfyui import FakeComfyUI
+
+
+class TestComfyClient(unittest.TestCase):
+    def test_requests_reuse_one_connection(self):
+        with FakeComfyUI(execution_time=0) as fake:
+            client = ComfyClient(fake.host)
+            self.assertTrue(client.is_reachable())
+            prompt_id = client.queue_prompt({"9": {"class_type": "SaveImage", "inputs": {}}})["prompt_id"]
+            for _ in range(5):
+                client.get_history(prompt_id)
+            metrics = client.get_metrics()
+            client.close()
+
+        self.assertEqual(metrics["requests"], 7)
+        self.assertEqual(metrics["failures"], 0)
+        self.assertEqual(metrics["connections_opened"], 1)
+
+    def test_get_is_retried_on_unavailable_server(self):
+        client = ComfyClient("127.0.0.1:8188", retries=2, backoff=0)
+        unavailable = MagicMock(status_code=503)
+        ok = MagicMock(status_code=200)
+        ok.json.return_value = {"123": {"outputs": {}}}
+
+        with patch.object(client.session, "request", side_effect=[unavailable, requests.ConnectionError(), ok]) as mock_request:
+            history = client.get_history("123")
+
+        self.assertEqual(history, {"123": {"outputs": {}}})
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(client.get_metrics()["retries"], 2)
+
+    def test_queue_prompt_is_not_retried(self):
+        client = ComfyClient("127.0.0.1:8188", retries=2, backoff=0)
+
+        with patch.object(client.session, "request", side_effect=requests.ConnectionError()) as mock_request:
+            with self.assertRaises(requests.ConnectionError):
+                client.queue_prompt({})
+
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_queue_prompt_raises_on_rejected_workflow(self):
+        client = ComfyClient("127.0.0.1:8188")
+        rejected = MagicMock(status_code=400, text='{"error": "invalid prompt"}')
+
+        with patch.object(client.session, "request", return_value=rejected):
+            with self.assertRaises(requests.HTTPError):
+                client.queue_prompt({})
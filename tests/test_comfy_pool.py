@@ -0,0 +1,73 @@
+import unittest
+import sys
+import os
+
+# Make sure that "src" is known and can be used to import comfy_pool.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from comfy_client import ComfyClient
+from comfy_pool import ComfyBackend, ComfyPool
+from model_memory import ModelMemoryPolicy
+from tests.fake_comfyui import FakeComfyUI
+
+SDXL = frozenset({("checkpoints", "sd_xl_base_1.0.safetensors")})
+FLUX = frozenset({("diffusion_models", "flux1-dev.safetensors")})
+
+
+class TestComfyPool(unittest.TestCase):
+    def setUp(self):
+        self.fakes = [FakeComfyUI().start() for _ in range(3)]
+        self.backends = [
+            ComfyBackend(ComfyClient(fake.host, retries=0), str(index), ModelMemoryPolicy())
+            for index, fake in enumerate(self.fakes)
+        ]
+
+    def tearDown(self):
+        for fake in self.fakes:
+            fake.stop()
+
+    def test_jobs_go_to_the_shortest_queue(self):
+        pool = ComfyPool(self.backends)
+
+        acquired = [pool.acquire() for _ in range(4)]
+        self.assertEqual([backend.output_subdirectory for backend in acquired], ["0", "1", "2", "0"])
+
+        pool.release(acquired[1])
+        self.assertIs(pool.acquire(), self.backends[1])
+        self.assertEqual([stats["active_jobs"] for stats in pool.get_stats()], [2, 1, 1])
+
+    def test_backend_with_the_models_loaded_is_preferred(self):
+        pool = ComfyPool(self.backends)
+        self.backends[1].model_memory.record(FLUX)
+        self.backends[2].model_memory.record(SDXL)
+
+        self.assertIs(pool.acquire(SDXL), self.backends[2])
+        # A busy backend is not waited for, even if it has the models loaded
+        self.assertIs(pool.acquire(SDXL), self.backends[0])
+        self.assertIs(pool.acquire(FLUX), self.backends[1])
+
+    def test_unhealthy_backends_get_no_jobs(self):
+        pool = ComfyPool(self.backends, health_check_interval=0)
+        self.fakes[0].stop()
+
+        self.assertIs(pool.acquire(), self.backends[1])
+        self.assertIs(pool.acquire(), self.backends[2])
+        self.assertFalse(self.backends[0].healthy)
+        self.assertFalse(pool.get_stats()[0]["healthy"])
+
+    def test_health_is_checked_once_per_interval(self):
+        pool = ComfyPool(self.backends, health_check_interval=60)
+        for _ in range(3):
+            pool.release(pool.acquire())
+
+        self.assertEqual([fake.request_log.count(("GET", "/")) for fake in self.fakes], [1, 1, 1])
+
+    def test_least_busy_backend_is_used_when_none_is_healthy(self):
+        pool = ComfyPool(self.backends[:1], health_check_interval=0)
+        self.fakes[0].stop()
+
+        self.assertIs(pool.acquire(), self.backends[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
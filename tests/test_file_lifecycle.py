@@ -0,0 +1,68 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+# Make sure that "src" is known and can be used to import file_lifecycle.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from file_lifecycle import FileLifecycle
+
+
+class TestFileLifecycle(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, size, age=0):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as image_file:
+            image_file.write(b"x" * size)
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+        return path
+
+    def test_remove_counts_reclaimed_bytes(self):
+        lifecycle = FileLifecycle(0)
+        first = self.write("a.png", 100)
+        second = self.write("b.png", 50)
+
+        self.assertEqual(lifecycle.remove([first, second, os.path.join(self.directory, "missing.png")]), 150)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(lifecycle.take_reclaimed(), {"output": (2, 150)})
+        self.assertEqual(lifecycle.take_reclaimed(), {})
+
+    def test_least_recently_used_inputs_are_removed(self):
+        lifecycle = FileLifecycle(250, min_age=0)
+        self.write("old.png", 100, age=30)
+        self.write("older.png", 100, age=60)
+        self.write("new.png", 100)
+        removed = []
+
+        reclaimed = lifecycle.enforce_input_quota(self.directory, ["old.png", "older.png", "new.png"], removed.append)
+
+        self.assertEqual(reclaimed, 100)
+        self.assertEqual(removed, ["older.png"])
+        self.assertEqual(sorted(os.listdir(self.directory)), ["new.png", "old.png"])
+        self.assertEqual(lifecycle.take_reclaimed(), {"input": (1, 100)})
+
+    def test_only_known_and_unused_inputs_are_removed(self):
+        lifecycle = FileLifecycle(50, min_age=45)
+        self.write("unknown.png", 100, age=600)
+        self.write("recent.png", 100, age=30)
+        self.write("stale.png", 100, age=60)
+
+        self.assertEqual(lifecycle.enforce_input_quota(self.directory, ["recent.png", "stale.png", "gone.png"]), 100)
+        # The quota is still exceeded, but the remaining image may be in use
+        self.assertEqual(sorted(os.listdir(self.directory)), ["recent.png", "unknown.png"])
+
+    def test_no_quota(self):
+        lifecycle = FileLifecycle(0, min_age=0)
+        self.write("a.png", 100, age=60)
+
+        self.assertEqual(lifecycle.enforce_input_quota(self.directory, ["a.png"]), 0)
+        self.assertEqual(os.listdir(self.directory), ["a.png"])
@@ -0,0 +1,39 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+
+# Make sure that "src" is known and can be used to import image_transcoder.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from image_transcoder import transcode_image
+
+
+class TestImageTranscoder(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src_path = os.path.join(self.directory, "ComfyUI_00001_.png")
+        Image.new("RGBA", (16, 16), (255, 0, 0, 128)).save(self.src_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_image_is_reencoded(self):
+        dst_path = os.path.join(self.directory, "ComfyUI_00001_.webp")
+
+        self.assertEqual(transcode_image(self.src_path, dst_path, "webp", 80), dst_path)
+        with Image.open(dst_path) as image:
+            self.assertEqual(image.format, "WEBP")
+            self.assertEqual(image.size, (16, 16))
+
+    def test_alpha_channel_is_dropped_for_jpeg(self):
+        dst_path = os.path.join(self.directory, "ComfyUI_00001_.jpg")
+
+        transcode_image(self.src_path, dst_path, "jpeg", 80)
+        with Image.open(dst_path) as image:
+            self.assertEqual(image.format, "JPEG")
+            self.assertEqual(image.mode, "RGB")
+
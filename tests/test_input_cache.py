@@ -0,0 +1,154 @@
+import unittest
+import sys
+import os
+import hashlib
+import shutil
+import tempfile
+import time
+from functools import partial
+from unittest.mock import MagicMock
+
+import requests
+
+# Make sure that "src" is known and can be used to import input_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from input_cache import DownloadError, InputCache, azure_fetch, cache_url, http_fetch, s3_fetch, split_bucket_url
+from tests.fake_azure_blob import FakeBlobServiceClient
+from tests.fake_file_server import FakeFileServer
+
+CONTENT = b"reference image" * 100
+
+
+class TestInputCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session = requests.Session()
+        self.fetch = partial(http_fetch, self.session, timeout=5)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.directory)
+
+    def test_download_is_cached(self):
+        cache = InputCache(self.directory, 1024 * 1024)
+        with FakeFileServer({"/cat.png": CONTENT}) as server:
+            path, digest = cache.get(server.url("/cat.png"), self.fetch, 1024 * 1024)
+            self.assertEqual(cache.get(server.url("/cat.png"), self.fetch, 1024 * 1024), (path, digest))
+
+            # Within the TTL the second lookup does not send a request
+            self.assertEqual(server.requests_to("/cat.png"), [200])
+
+        with open(path, "rb") as image_file:
+            self.assertEqual(image_file.read(), CONTENT)
+        self.assertEqual(digest, hashlib.sha256(CONTENT).hexdigest())
+        self.assertEqual(cache.stats(), {"hits": 1, "revalidated": 0, "misses": 1})
+
+    def test_signed_urls_share_the_cached_copy(self):
+        cache = InputCache(self.directory, 1024 * 1024, ttl=0)
+        with FakeFileServer({"/cat.png": CONTENT}) as server:
+            for signature in ("abc", "def"):
+                url = server.url(
+                    f"/cat.png?X-Amz-Algorithm=AWS4-HMAC-SHA256&X-Amz-Date=2026101{signature[0]}"
+                    f"&X-Amz-Expires=3600&X-Amz-Signature={signature}"
+                )
+                path, _ = cache.get(url, self.fetch, 1024 * 1024)
+
+            # The second URL is revalidated with the ETag of the first download
+            self.assertEqual(server.requests_to("/cat.png"), [200, 304])
+        self.assertEqual(cache.stats(), {"hits": 0, "revalidated": 1, "misses": 1})
+        # No lock is kept for URLs that are no longer looked up
+        self.assertEqual(cache._url_locks, {})
+
+    def test_cache_url(self):
+        self.assertEqual(
+            cache_url("https://account.blob.core.windows.net/images/cat.png?sv=2022-11-02&se=2026&sr=b&sp=r&sig=abc"),
+            "https://account.blob.core.windows.net/images/cat.png",
+        )
+        self.assertEqual(
+            cache_url("https://bucket.s3.amazonaws.com/cat.png?versionId=3&X-Amz-Signature=abc&X-Amz-Date=1"),
+            "https://bucket.s3.amazonaws.com/cat.png?versionId=3",
+        )
+        # Parameters of unsigned URLs can select the content, they are kept
+        self.assertEqual(cache_url("https://example.com/image?sp=1&se=2"), "https://example.com/image?sp=1&se=2")
+
+    def test_revalidated_with_etag_after_ttl(self):
+        cache = InputCache(self.directory, 1024 * 1024, ttl=0)
+        with FakeFileServer({"/cat.png": CONTENT}) as server:
+            url = server.url("/cat.png")
+            cache.get(url, self.fetch, 1024 * 1024)
+            cache.get(url, self.fetch, 1024 * 1024)
+
+            server.files["/cat.png"] = b"changed"
+            path, digest = cache.get(url, self.fetch, 1024 * 1024)
+
+            self.assertEqual(server.requests_to("/cat.png"), [200, 304, 200])
+        self.assertEqual(digest, hashlib.sha256(b"changed").hexdigest())
+        self.assertEqual(cache.stats(), {"hits": 0, "revalidated": 1, "misses": 2})
+
+    def test_size_limit(self):
+        cache = InputCache(self.directory, 1024 * 1024)
+        with FakeFileServer({"/cat.png": CONTENT}) as server:
+            with self.assertRaises(DownloadError):
+                cache.get(server.url("/cat.png"), self.fetch, 100)
+
+        # Nothing is left behind
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_size_limit_without_content_length(self):
+        def fetch(url, etag):
+            return None, None, iter([CONTENT, CONTENT])
+
+        cache = InputCache(self.directory, 1024 * 1024)
+        with self.assertRaises(DownloadError):
+            cache.get("http://example.com/cat.png", fetch, len(CONTENT) + 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_not_found(self):
+        cache = InputCache(self.directory, 1024 * 1024)
+        with FakeFileServer() as server:
+            with self.assertRaises(DownloadError):
+                cache.get(server.url("/missing.png"), self.fetch, 1024 * 1024)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = InputCache(self.directory, 2 * len(CONTENT))
+        with FakeFileServer({"/1.png": CONTENT, "/2.png": CONTENT, "/3.png": CONTENT}) as server:
+            first, _ = cache.get(server.url("/1.png"), self.fetch, 1024 * 1024)
+            time.sleep(0.01)
+            second, _ = cache.get(server.url("/2.png"), self.fetch, 1024 * 1024)
+            time.sleep(0.01)
+            cache.get(server.url("/1.png"), self.fetch, 1024 * 1024)
+            time.sleep(0.01)
+            cache.get(server.url("/3.png"), self.fetch, 1024 * 1024)
+
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertFalse(os.path.exists(second + ".json"))
+
+
+class TestStorageFetch(unittest.TestCase):
+    def test_split_bucket_url(self):
+        self.assertEqual(split_bucket_url("s3://images/refs/cat%20one.png"), ("images", "refs/cat one.png"))
+        with self.assertRaises(DownloadError):
+            split_bucket_url("s3://images/")
+
+    def test_s3_fetch(self):
+        client = MagicMock()
+        client.head_object.return_value = {"ETag": '"abc"', "ContentLength": len(CONTENT)}
+        client.get_object.return_value = {"Body": MagicMock(iter_chunks=MagicMock(return_value=iter([CONTENT])))}
+
+        etag, size, chunks = s3_fetch(client, "s3://images/cat.png", None)
+        self.assertEqual((etag, size, b"".join(chunks)), ('"abc"', len(CONTENT), CONTENT))
+        client.get_object.assert_called_once_with(Bucket="images", Key="cat.png", IfMatch='"abc"')
+
+        self.assertIsNone(s3_fetch(client, "s3://images/cat.png", '"abc"'))
+
+    def test_azure_fetch(self):
+        service = FakeBlobServiceClient("UseDevelopmentStorage=true")
+        service.containers["images"] = {"refs/cat.png": CONTENT}
+
+        etag, size, chunks = azure_fetch(service, "azure://images/refs/cat.png", None)
+        self.assertEqual((size, b"".join(chunks)), (len(CONTENT), CONTENT))
+
+        self.assertIsNone(azure_fetch(service, "azure://images/refs/cat.png", etag))
+        self.assertEqual([call for call in service.calls if call[0] == "download_blob"], [("download_blob", "refs/cat.png")])
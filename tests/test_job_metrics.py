@@ -0,0 +1,105 @@
+import unittest
+import sys
+import os
+import tempfile
+import time
+import urllib.request
+
+# Make sure that "src" is known and can be used to import job_metrics.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from comfy_client import ComfyClient
+from job_metrics import JobMetrics, JobTimings, serve_metrics
+from tests.fake_comfyui import FakeComfyUI
+
+
+class TestJobTimings(unittest.TestCase):
+    def test_phases_add_up(self):
+        timings = JobTimings()
+        for _ in range(2):
+            with timings.measure("upload_images"):
+                time.sleep(0.01)
+
+        result = timings.as_dict()
+        self.assertGreaterEqual(result["phases"]["upload_images"], 0.02)
+        self.assertGreaterEqual(result["total"], result["phases"]["upload_images"])
+
+    def test_marks_become_queue_wait_and_execution(self):
+        timings = JobTimings()
+        timings.mark("queued")
+        time.sleep(0.01)
+        timings.mark("execution_start")
+        time.sleep(0.02)
+        timings.mark("execution_end")
+
+        phases = timings.as_dict()["phases"]
+        self.assertGreaterEqual(phases["queue_wait"], 0.01)
+        self.assertGreaterEqual(phases["execution"], 0.02)
+
+    def test_images(self):
+        timings = JobTimings()
+        timings.add_image("9", "ComfyUI_00001_.png", "base64", 0.5)
+        self.assertEqual(
+            timings.as_dict()["images"],
+            [{"node_id": "9", "filename": "ComfyUI_00001_.png", "imageType": "base64", "seconds": 0.5}],
+        )
+
+
+class TestJobMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = JobMetrics(buckets=(0.1, 1, float("inf")))
+        timings = JobTimings()
+        timings.add("upload_images", 0.5)
+        timings.add_image("9", "a.png", "url", 0.05)
+        self.metrics.observe_job(timings, "success")
+        self.metrics.observe_job(JobTimings(), "error")
+
+    def test_render_prometheus_text(self):
+        text = self.metrics.render()
+
+        self.assertIn('runpod_worker_comfy_jobs_total{status="success"} 1', text)
+        self.assertIn('runpod_worker_comfy_jobs_total{status="error"} 1', text)
+        self.assertIn('runpod_worker_comfy_job_phase_seconds_bucket{phase="upload_images",le="0.1"} 0', text)
+        self.assertIn('runpod_worker_comfy_job_phase_seconds_bucket{phase="upload_images",le="1.0"} 1', text)
+        self.assertIn('runpod_worker_comfy_job_phase_seconds_bucket{phase="upload_images",le="+Inf"} 1', text)
+        self.assertIn('runpod_worker_comfy_job_phase_seconds_count{phase="total"} 2', text)
+        self.assertIn('runpod_worker_comfy_image_delivery_seconds_sum{image_type="url"} 0.05', text)
+
+    def test_render_reclaimed(self):
+        self.metrics.observe_reclaimed("output", 2, 1000)
+        self.metrics.observe_reclaimed("output", 1, 500)
+        text = self.metrics.render()
+
+        self.assertIn('runpod_worker_comfy_reclaimed_files_total{directory="output"} 3', text)
+        self.assertIn('runpod_worker_comfy_reclaimed_bytes_total{directory="output"} 1500', text)
+
+    def test_render_comfy_client_requests(self):
+        with FakeComfyUI(fail_requests={"/history/p1": 1}) as fake:
+            client = ComfyClient(fake.host, backoff=0.01)
+            self.metrics.add_client(client)
+            client.get_history("p1")
+            text = self.metrics.render()
+
+        self.assertIn(f'runpod_worker_comfy_comfy_requests_total{{host="{fake.host}"}} 2', text)
+        self.assertIn(f'runpod_worker_comfy_comfy_request_retries_total{{host="{fake.host}"}} 1', text)
+        self.assertIn(f'runpod_worker_comfy_comfy_connections_opened_total{{host="{fake.host}"}} 1', text)
+
+    def test_write_and_serve(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.prom")
+            self.metrics.write(path)
+            with open(path) as metrics_file:
+                self.assertEqual(metrics_file.read(), self.metrics.render())
+
+        server = serve_metrics(self.metrics, 0, host="127.0.0.1")
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(response.read().decode("utf-8"), self.metrics.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
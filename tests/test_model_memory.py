@@ -0,0 +1,96 @@
+import unittest
+import sys
+import os
+
+# Make sure that "src" is known and can be used to import model_memory.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from model_memory import ModelMemoryPolicy, memory_usage, workflow_models
+
+SDXL = frozenset({("checkpoints", "sd_xl_base_1.0.safetensors"), ("vae", "sdxl_vae.safetensors")})
+FLUX = frozenset({("diffusion_models", "flux1-dev.safetensors"), ("text_encoders", "t5xxl_fp16.safetensors")})
+
+
+class TestWorkflowModels(unittest.TestCase):
+    def test_loader_inputs(self):
+        workflow = {
+            "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd_xl_base_1.0.safetensors"}},
+            "5": {"class_type": "VAELoader", "inputs": {"vae_name": "sdxl_vae.safetensors"}},
+            "6": {
+                "class_type": "LoraLoader",
+                "inputs": {"lora_name": "detail.safetensors", "model": ["4", 0], "clip": ["4", 1]},
+            },
+            "7": {"class_type": "DualCLIPLoader", "inputs": {"clip_name1": "clip_l.safetensors", "clip_name2": "t5.safetensors"}},
+            "8": {"class_type": "KSampler", "inputs": {"sampler_name": "euler", "model": ["6", 0]}},
+        }
+
+        self.assertEqual(
+            workflow_models(workflow),
+            {
+                ("checkpoints", "sd_xl_base_1.0.safetensors"),
+                ("vae", "sdxl_vae.safetensors"),
+                ("loras", "detail.safetensors"),
+                ("text_encoders", "clip_l.safetensors"),
+                ("text_encoders", "t5.safetensors"),
+            },
+        )
+
+    def test_other_loaders_by_file_extension(self):
+        workflow = {
+            "1": {"class_type": "UpscaleModelLoader", "inputs": {"model_name": "4x-UltraSharp.pth"}},
+            "2": {"class_type": "SaveImage", "inputs": {"filename_prefix": "ComfyUI"}},
+        }
+        self.assertEqual(workflow_models(workflow), {("other", "4x-UltraSharp.pth")})
+
+
+class TestMemoryUsage(unittest.TestCase):
+    def test_highest_usage_of_vram_and_ram(self):
+        system_stats = {
+            "system": {"ram_total": 100, "ram_free": 60},
+            "devices": [
+                {"type": "cuda", "vram_total": 100, "vram_free": 25},
+                {"type": "cpu", "vram_total": 100, "vram_free": 0},
+            ],
+        }
+        self.assertEqual(memory_usage(system_stats), 0.75)
+        self.assertIsNone(memory_usage({"system": {}, "devices": []}))
+
+
+class TestModelMemoryPolicy(unittest.TestCase):
+    def test_same_models_stay_loaded(self):
+        policy = ModelMemoryPolicy()
+        self.assertIsNone(policy.decide(SDXL))
+        policy.record(SDXL)
+
+        self.assertIsNone(policy.decide(SDXL | {("loras", "detail.safetensors")}))
+        self.assertIsNone(policy.decide(frozenset({("checkpoints", "sd_xl_base_1.0.safetensors")})))
+
+    def test_other_models_are_unloaded_for(self):
+        policy = ModelMemoryPolicy()
+        policy.record(SDXL)
+
+        unload_models, free_memory, reason = policy.decide(FLUX)
+        self.assertEqual((unload_models, free_memory), (True, False))
+        self.assertIn("flux1-dev.safetensors", reason)
+
+        # After the memory was freed, only the models of the last job count as loaded
+        policy.record(FLUX, freed=True)
+        self.assertEqual(policy.loaded, FLUX)
+        self.assertIsNotNone(policy.decide(SDXL))
+
+    def test_has_loaded(self):
+        policy = ModelMemoryPolicy()
+        policy.record(SDXL)
+
+        self.assertTrue(policy.has_loaded(SDXL | {("loras", "detail.safetensors")}))
+        self.assertFalse(policy.has_loaded(FLUX))
+        # A job without resident models does not care where it runs
+        self.assertFalse(policy.has_loaded(frozenset({("loras", "detail.safetensors")})))
+
+    def test_memory_threshold(self):
+        policy = ModelMemoryPolicy(unload_on_change=False, threshold=0.9)
+        policy.record(SDXL)
+
+        self.assertIsNone(policy.decide(FLUX, usage=0.5))
+        self.assertEqual(policy.decide(SDXL, usage=0.95)[:2], (True, True))
+        self.assertIsNone(ModelMemoryPolicy(threshold=0).decide(SDXL, usage=1.0))
@@ -0,0 +1,149 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import model_prefetch.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+import model_prefetch
+from model_prefetch import MODEL_FOLDERS, PARTIAL_PREFIX, ModelPrefetcher
+
+
+class TestModelPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.volume = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.volume)
+        shutil.rmtree(self.cache)
+
+    def write(self, directory, relative_path, size, age=0):
+        path = os.path.join(directory, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as model_file:
+            model_file.write(b"m" * size)
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+        return path
+
+    def test_copies_models_from_the_volume(self):
+        self.write(self.volume, "checkpoints/sdxl.safetensors", 100)
+        self.write(self.volume, "unet/flux.safetensors", 200)
+        prefetcher = ModelPrefetcher(self.volume, self.cache, 1000)
+
+        scheduled = prefetcher.prefetch(
+            {
+                ("diffusion_models", "flux.safetensors"),
+                ("checkpoints", "sdxl.safetensors"),
+                ("vae", "missing.safetensors"),
+            }
+        )
+        prefetcher.wait(timeout=10)
+
+        self.assertEqual(scheduled, ["checkpoints/sdxl.safetensors", "unet/flux.safetensors"])
+        self.assertEqual(os.path.getsize(os.path.join(self.cache, "unet", "flux.safetensors")), 200)
+        self.assertEqual(prefetcher.get_stats()["copies"], 2)
+        self.assertEqual(prefetcher.get_stats()["copied_bytes"], 300)
+
+        # The copies are used from now on
+        self.assertEqual(prefetcher.prefetch({("checkpoints", "sdxl.safetensors")}), [])
+        self.assertEqual(prefetcher.get_stats()["hits"], 1)
+
+    def test_least_recently_used_copies_are_removed(self):
+        self.write(self.cache, "loras/old.safetensors", 100, age=60)
+        self.write(self.cache, "loras/recent.safetensors", 100, age=30)
+        self.write(self.volume, "loras/recent.safetensors", 100)
+        self.write(self.volume, "checkpoints/new.safetensors", 150)
+        prefetcher = ModelPrefetcher(self.volume, self.cache, 300)
+
+        # Using a copy makes it the most recently used
+        prefetcher.prefetch({("loras", "recent.safetensors")})
+        prefetcher.prefetch({("checkpoints", "new.safetensors")})
+        prefetcher.wait(timeout=10)
+
+        self.assertFalse(os.path.exists(os.path.join(self.cache, "loras", "old.safetensors")))
+        self.assertTrue(os.path.exists(os.path.join(self.cache, "loras", "recent.safetensors")))
+        self.assertTrue(os.path.exists(os.path.join(self.cache, "checkpoints", "new.safetensors")))
+        self.assertEqual(prefetcher.get_stats()["evictions"], 1)
+
+    def test_models_larger_than_the_budget_are_not_copied(self):
+        self.write(self.volume, "checkpoints/huge.safetensors", 500)
+        prefetcher = ModelPrefetcher(self.volume, self.cache, 100)
+
+        prefetcher.prefetch({("checkpoints", "huge.safetensors")})
+        prefetcher.wait(timeout=10)
+
+        self.assertFalse(os.path.exists(os.path.join(self.cache, "checkpoints", "huge.safetensors")))
+
+    def test_changed_models_are_copied_again(self):
+        self.write(self.cache, "vae/sdxl_vae.safetensors", 50)
+        self.write(self.volume, "vae/sdxl_vae.safetensors", 80)
+        prefetcher = ModelPrefetcher(self.volume, self.cache, 1000)
+
+        self.assertEqual(prefetcher.prefetch({("vae", "sdxl_vae.safetensors")}), ["vae/sdxl_vae.safetensors"])
+        prefetcher.wait(timeout=10)
+        self.assertEqual(os.path.getsize(os.path.join(self.cache, "vae", "sdxl_vae.safetensors")), 80)
+
+    def test_order_and_readahead_without_copies(self):
+        self.write(self.volume, "checkpoints/sdxl.safetensors", 100)
+        self.write(self.volume, "loras/detail.safetensors", 10)
+        models = {("checkpoints", "sdxl.safetensors"), ("loras", "detail.safetensors")}
+
+        with patch.object(model_prefetch, "readahead") as readahead:
+            # Kinds that are not in the order are only read into the page cache
+            prefetcher = ModelPrefetcher(self.volume, self.cache, 1000, order=("loras",))
+            self.assertEqual(prefetcher.prefetch(models), ["loras/detail.safetensors"])
+            prefetcher.wait(timeout=10)
+
+            without_copies = ModelPrefetcher(self.volume, self.cache, 0)
+            self.assertEqual(without_copies.prefetch(models), [])
+            without_copies.wait(timeout=10)
+
+        self.assertIn(os.path.join(self.volume, "checkpoints", "sdxl.safetensors"), [c.args[0] for c in readahead.call_args_list])
+
+    def test_readahead_does_not_block_the_job(self):
+        self.write(self.volume, "checkpoints/sdxl.safetensors", 100)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_readahead(path):
+            started.set()
+            release.wait(10)
+
+        with patch.object(model_prefetch, "readahead", side_effect=slow_readahead):
+            prefetcher = ModelPrefetcher(self.volume, self.cache, 0)
+            start = time.monotonic()
+            prefetcher.prefetch({("checkpoints", "sdxl.safetensors")})
+            # The job goes on while the model is read from the volume
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertTrue(started.wait(10))
+            release.set()
+            prefetcher.wait(timeout=10)
+
+    def test_local_copies_are_searched_by_comfyui(self):
+        # start.sh lets ComfyUI search every folder below the cache directory that models are copied to
+        start_sh = os.path.join(os.path.dirname(__file__), "..", "src", "start.sh")
+        with open(start_sh) as script:
+            config = script.read().split("runpod_worker_comfy_local_copies:", 1)[1].split("EOF", 1)[0]
+        folders = {line.split(":")[0].strip() for line in config.splitlines() if line.strip()}
+
+        for kind_folders in MODEL_FOLDERS.values():
+            self.assertLessEqual(set(kind_folders), folders)
+
+    def test_paths_outside_the_volume_and_partial_copies(self):
+        self.write(self.cache, f"checkpoints/{PARTIAL_PREFIX}abc-sdxl.safetensors", 10)
+        prefetcher = ModelPrefetcher(self.volume, self.cache, 1000)
+
+        self.assertEqual(os.listdir(os.path.join(self.cache, "checkpoints")), [])
+        self.assertIsNone(prefetcher.locate("checkpoints", "../../etc/passwd"))
+        self.assertIsNone(prefetcher.locate("checkpoints", "/etc/passwd"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+# Make sure that "src" is known and can be used to import result_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from result_cache import AzureResultCache, ResultCache, compute_cache_key, find_nondeterminism
+from tests.fake_azure_blob import FakeBlobServiceClient
+
+WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"seed": 42, "steps": 1, "model": ["4", 0]}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}},
+}
+OUTPUTS = {"9": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}]}}
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output_path = tempfile.mkdtemp()
+        shutil.copy("./test_resources/images/ComfyUI_00001_.png", self.output_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.output_path)
+
+    def test_cache_key_is_canonical(self):
+        reordered = {"9": WORKFLOW["9"], "3": {"inputs": {"model": ["4", 0], "steps": 1, "seed": 42}, "class_type": "KSampler"}}
+        images = [{"name": "a.png", "image": "YQ=="}, {"name": "b.png", "image": "Yg=="}]
+
+        self.assertEqual(compute_cache_key(WORKFLOW, images), compute_cache_key(reordered, list(reversed(images))))
+        self.assertNotEqual(compute_cache_key(WORKFLOW), compute_cache_key(WORKFLOW, images))
+        self.assertNotEqual(
+            compute_cache_key(WORKFLOW, images),
+            compute_cache_key(WORKFLOW, [{"name": "a.png", "image": "Yg=="}, {"name": "b.png", "image": "YQ=="}]),
+        )
+
+    def test_find_nondeterminism(self):
+        self.assertIsNone(find_nondeterminism(WORKFLOW))
+        self.assertIn("random seed", find_nondeterminism({"3": {"class_type": "KSampler", "inputs": {"seed": -1}}}))
+        self.assertIn("nondeterministic", find_nondeterminism(WORKFLOW, ["SaveImage"]))
+
+    def test_seeds_from_other_nodes_are_nondeterministic(self):
+        workflow = {
+            **WORKFLOW,
+            "3": {"class_type": "KSampler", "inputs": {"seed": ["5", 0], "steps": 1, "model": ["4", 0]}},
+            "5": {"class_type": "CustomSeed", "inputs": {"value": 42}},
+        }
+        self.assertIn("takes its seed from another node", find_nondeterminism(workflow))
+
+    def test_known_random_nodes_are_nondeterministic(self):
+        workflow = {**WORKFLOW, "5": {"class_type": "Random Number", "inputs": {"minimum": 0, "maximum": 10}}}
+        self.assertIn("Random Number", find_nondeterminism(workflow))
+
+    def test_put_and_get(self):
+        cache = ResultCache(self.directory, 10 * 1024 * 1024)
+        key = compute_cache_key(WORKFLOW)
+
+        self.assertIsNone(cache.get(key))
+        cache.put(key, OUTPUTS, self.output_path)
+        outputs, path = cache.get(key)
+
+        self.assertEqual(outputs, OUTPUTS)
+        self.assertTrue(os.path.exists(os.path.join(path, "ComfyUI_00001_.png")))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_least_recently_used_entries_are_evicted(self):
+        entry_size = os.path.getsize(os.path.join(self.output_path, "ComfyUI_00001_.png"))
+        cache = ResultCache(self.directory, int(entry_size * 2.5))
+
+        for key in ("first", "second"):
+            cache.put(key, OUTPUTS, self.output_path)
+            time.sleep(0.01)
+        # Using "first" makes "second" the least recently used entry
+        self.assertIsNotNone(cache.get("first"))
+        time.sleep(0.01)
+        cache.put("third", OUTPUTS, self.output_path)
+
+        self.assertIsNotNone(cache.get("first"))
+        self.assertIsNone(cache.get("second"))
+        self.assertIsNotNone(cache.get("third"))
+
+    def test_remote_tier(self):
+        service = FakeBlobServiceClient("UseDevelopmentStorage=true")
+        service.containers["cache"] = {}
+        remote = AzureResultCache(service, "cache")
+        key = compute_cache_key(WORKFLOW)
+
+        # Store through one worker ...
+        ResultCache(self.directory, 10 * 1024 * 1024).put(key, OUTPUTS, self.output_path)
+        remote.put(key, os.path.join(self.directory, key))
+
+        # ... and find it on another one
+        other_directory = tempfile.mkdtemp()
+        try:
+            outputs, path = ResultCache(other_directory, 10 * 1024 * 1024, remote=remote).get(key)
+            self.assertEqual(outputs, OUTPUTS)
+            self.assertTrue(os.path.exists(os.path.join(path, "ComfyUI_00001_.png")))
+        finally:
+            shutil.rmtree(other_directory)
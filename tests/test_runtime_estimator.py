@@ -0,0 +1,89 @@
+import unittest
+import sys
+import os
+
+# Make sure that "src" is known and can be used to import runtime_estimator.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from runtime_estimator import RuntimeEstimator, execution_seconds, next_poll_delay, workflow_fingerprint
+
+WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"seed": 42, "steps": 20, "model": ["4", 0], "positive": ["6", 0]}},
+    "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat", "clip": ["4", 1]}},
+}
+
+
+def with_inputs(node_id, **inputs):
+    workflow = {key: {**node, "inputs": dict(node["inputs"])} for key, node in WORKFLOW.items()}
+    workflow[node_id]["inputs"].update(inputs)
+    return workflow
+
+
+class TestWorkflowFingerprint(unittest.TestCase):
+    def test_seeds_and_prompts_are_ignored(self):
+        fingerprint = workflow_fingerprint(WORKFLOW)
+        self.assertEqual(workflow_fingerprint(with_inputs("3", seed=7)), fingerprint)
+        self.assertEqual(workflow_fingerprint(with_inputs("6", text="a dog")), fingerprint)
+
+    def test_steps_resolution_and_structure_count(self):
+        fingerprint = workflow_fingerprint(WORKFLOW)
+        self.assertNotEqual(workflow_fingerprint(with_inputs("3", steps=4)), fingerprint)
+        self.assertNotEqual(workflow_fingerprint(with_inputs("5", width=1024)), fingerprint)
+        self.assertNotEqual(workflow_fingerprint(with_inputs("3", positive=["7", 0])), fingerprint)
+        self.assertNotEqual(
+            workflow_fingerprint({**WORKFLOW, "3": {**WORKFLOW["3"], "class_type": "KSamplerAdvanced"}}), fingerprint
+        )
+
+
+class TestRuntimeEstimator(unittest.TestCase):
+    def test_moving_average(self):
+        estimator = RuntimeEstimator(alpha=0.5)
+        self.assertIsNone(estimator.estimate("a"))
+
+        self.assertEqual(estimator.observe("a", 10), 10)
+        self.assertEqual(estimator.observe("a", 20), 15)
+        self.assertEqual(estimator.estimate("a"), 15)
+
+    def test_least_recently_used_are_forgotten(self):
+        estimator = RuntimeEstimator(max_entries=2)
+        estimator.observe("a", 1)
+        estimator.observe("b", 2)
+        estimator.estimate("a")
+        estimator.observe("c", 3)
+
+        self.assertEqual(len(estimator), 2)
+        self.assertIsNone(estimator.estimate("b"))
+        self.assertEqual(estimator.estimate("a"), 1)
+
+
+class TestPolling(unittest.TestCase):
+    def test_sleeps_until_shortly_before_the_expected_finish(self):
+        self.assertAlmostEqual(next_poll_delay(0, 100, 0.025, 0.25), 89.975)
+        self.assertAlmostEqual(next_poll_delay(50, 100, 0.025, 0.25), 39.975)
+
+    def test_polls_tightly_around_the_expected_finish(self):
+        self.assertEqual(next_poll_delay(95, 100, 0.025, 0.25), 0.025)
+        self.assertEqual(next_poll_delay(100, 100, 0.025, 0.25), 0.025)
+
+    def test_backs_off_when_running_over(self):
+        self.assertAlmostEqual(next_poll_delay(100.4, 100, 0.025, 0.25), 0.1)
+        self.assertEqual(next_poll_delay(130, 100, 0.025, 0.25), 0.25)
+
+    def test_without_estimate(self):
+        self.assertEqual(next_poll_delay(0, None, 0.025, 0.25), 0.025)
+        self.assertEqual(next_poll_delay(10, None, 0.025, 0.25), 0.25)
+
+    def test_execution_seconds_from_history(self):
+        history = {
+            "status": {
+                "messages": [
+                    ["execution_start", {"prompt_id": "1", "timestamp": 1000}],
+                    ["execution_cached", {"prompt_id": "1", "nodes": []}],
+                    ["execution_success", {"prompt_id": "1", "timestamp": 3500}],
+                ]
+            }
+        }
+        self.assertEqual(execution_seconds(history), 2.5)
+        self.assertIsNone(execution_seconds({"status": {"messages": []}}))
+        self.assertIsNone(execution_seconds({}))
@@ -0,0 +1,73 @@
+import unittest
+import sys
+import os
+import tempfile
+
+# Make sure that "src" is known and can be used to import startup_timeline.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from startup_timeline import StartupTimeline, parse_import_times
+
+COMFY_LOG = """Total VRAM 24217 MB, total RAM 64215 MB
+Prestartup times for custom nodes:
+   0.4 seconds: /comfyui/custom_nodes/ComfyUI-Manager
+
+Import times for custom nodes:
+   0.0 seconds: /comfyui/custom_nodes/websocket_image_save.py
+   2.5 seconds: /comfyui/custom_nodes/ComfyUI-Impact-Pack
+   0.1 seconds (IMPORT FAILED): /comfyui/custom_nodes/broken-node
+
+Starting server
+"""
+
+
+class TestStartupTimeline(unittest.TestCase):
+    def test_parse_import_times(self):
+        reports = parse_import_times(COMFY_LOG)
+
+        self.assertEqual(reports["prestartup"], [{"path": "/comfyui/custom_nodes/ComfyUI-Manager", "seconds": 0.4, "failed": False}])
+        self.assertEqual(len(reports["import"]), 3)
+        self.assertEqual(reports["import"][2], {"path": "/comfyui/custom_nodes/broken-node", "seconds": 0.1, "failed": True})
+
+    def test_phases_from_environment_and_handler(self):
+        environ = {"STARTUP_CONTAINER_START": "100.0", "STARTUP_COMFYUI_LAUNCH": "100.5", "STARTUP_HANDLER_LAUNCH": "101.0"}
+        timeline = StartupTimeline(environ)
+        timeline.mark("handler_imported", at=102.0)
+        timeline.mark("comfyui_ready", at=110.0)
+        self.assertFalse(timeline.mark("comfyui_ready", at=120.0))
+
+        record = timeline.record()
+
+        self.assertEqual(
+            [(phase["name"], phase["at_s"], phase["duration_s"]) for phase in record["phases"]],
+            [
+                ("container_start", 0.0, 0.0),
+                ("comfyui_launch", 0.5, 0.5),
+                ("handler_launch", 1.0, 0.5),
+                ("handler_imported", 2.0, 1.0),
+                ("comfyui_ready", 10.0, 8.0),
+            ],
+        )
+        self.assertEqual(record["total_s"], 10.0)
+        self.assertNotIn("custom_nodes", record)
+
+    def test_record_includes_custom_nodes(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".log", delete=False) as log_file:
+            log_file.write(COMFY_LOG)
+        try:
+            record = StartupTimeline({}).record(log_file.name)
+        finally:
+            os.remove(log_file.name)
+
+        custom_nodes = record["custom_nodes"]["import"]
+        self.assertEqual(custom_nodes["count"], 3)
+        self.assertEqual(custom_nodes["seconds"], 2.6)
+        self.assertEqual(custom_nodes["slowest"][0]["path"], "/comfyui/custom_nodes/ComfyUI-Impact-Pack")
+        self.assertEqual(custom_nodes["failed"], ["/comfyui/custom_nodes/broken-node"])
+
+    def test_missing_log_is_ignored(self):
+        self.assertNotIn("custom_nodes", StartupTimeline({}).record("/does/not/exist.log"))
+
+
+if __name__ == "__main__":
+    unittest.main()
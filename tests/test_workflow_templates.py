@@ -0,0 +1,110 @@
+import unittest
+import sys
+import os
+import json
+import shutil
+import tempfile
+
+# Make sure that "src" is known and can be used to import workflow_templates.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from workflow_templates import WorkflowTemplate, load_templates
+from workflow_validator import WorkflowValidator
+
+OBJECT_INFO = {
+    "CheckpointLoaderSimple": {
+        "input": {"required": {"ckpt_name": [["sd_xl_turbo.safetensors"], {}]}},
+        "output": ["MODEL", "CLIP", "VAE"],
+    },
+    "KSampler": {
+        "input": {
+            "required": {
+                "model": ["MODEL"],
+                "seed": ["INT", {"min": 0}],
+                "steps": ["INT", {"min": 1, "max": 50}],
+            }
+        },
+        "output": ["LATENT"],
+    },
+    "CLIPTextEncode": {"input": {"required": {"text": ["STRING", {}]}}, "output": ["CONDITIONING"]},
+}
+
+WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"model": ["4", 0], "seed": 0, "steps": 4}},
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd_xl_turbo.safetensors"}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a photo"}},
+}
+PARAMS = {"prompt": "6.text", "seed": ["3.seed"], "steps": "3.steps"}
+
+
+class TestWorkflowTemplate(unittest.TestCase):
+    def setUp(self):
+        self.template = WorkflowTemplate("sdxl_turbo", WORKFLOW, PARAMS)
+
+    def test_bind_copies_only_the_changed_nodes(self):
+        workflow, error = self.template.bind({"prompt": "a cat", "seed": 7})
+
+        self.assertIsNone(error)
+        self.assertEqual(workflow["6"]["inputs"]["text"], "a cat")
+        self.assertEqual(workflow["3"]["inputs"], {"model": ["4", 0], "seed": 7, "steps": 4})
+        self.assertIs(workflow["4"], WORKFLOW["4"])
+        # The template keeps its defaults
+        self.assertEqual(WORKFLOW["6"]["inputs"]["text"], "a photo")
+        self.assertEqual(WORKFLOW["3"]["inputs"]["seed"], 0)
+
+    def test_invalid_params(self):
+        self.assertIn("Unknown parameter 'cfg'", self.template.bind({"cfg": 7})[1])
+        self.assertEqual(self.template.bind({"seed": "7"})[1], "Parameter 'seed' must be of type int")
+        self.assertEqual(self.template.bind({"prompt": True})[1], "Parameter 'prompt' must be of type str")
+        self.assertEqual(self.template.bind(["a cat"])[1], "'params' must be an object")
+
+    def test_values_include_the_defaults(self):
+        self.assertEqual(self.template.values({"seed": 7}), {"prompt": "a photo", "seed": 7, "steps": 4})
+
+    def test_invalid_targets(self):
+        with self.assertRaisesRegex(ValueError, "not an input"):
+            WorkflowTemplate("broken", WORKFLOW, {"cfg": "3.cfg"})
+        with self.assertRaisesRegex(ValueError, "is a link"):
+            WorkflowTemplate("broken", WORKFLOW, {"model": "3.model"})
+
+    def test_template_is_validated_once_and_params_for_each_job(self):
+        validator = WorkflowValidator(OBJECT_INFO)
+        calls = []
+        validate = validator.validate
+        validator.validate = lambda *args, **kwargs: calls.append(args) or validate(*args, **kwargs)
+
+        for steps in (8, 100):
+            workflow, _ = self.template.bind({"steps": steps})
+            errors = self.template.validate(validator, workflow)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(errors, ["node 3 (KSampler): input 'steps' is 100, above the maximum of 50"])
+
+    def test_errors_of_the_template_are_reported_for_each_job(self):
+        template = WorkflowTemplate("broken", {**WORKFLOW, "9": {"class_type": "Unknown", "inputs": {}}}, PARAMS)
+        validator = WorkflowValidator(OBJECT_INFO)
+
+        self.assertEqual(template.validate(validator, template.bind({})[0]), ["template 'broken': node 9: unknown class_type 'Unknown'"])
+
+
+class TestLoadTemplates(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_directory(self):
+        with open(os.path.join(self.directory, "sdxl_turbo.json"), "w") as template_file:
+            json.dump({"workflow": WORKFLOW, "params": PARAMS}, template_file)
+        with open(os.path.join(self.directory, "broken.json"), "w") as template_file:
+            template_file.write("{")
+
+        templates = load_templates(self.directory)
+
+        self.assertEqual(list(templates), ["sdxl_turbo"])
+        self.assertEqual(templates["sdxl_turbo"].params["seed"], [("3", "seed")])
+        self.assertEqual(load_templates(os.path.join(self.directory, "missing")), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+
+# Make sure that "src" is known and can be used to import workflow_validator.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from workflow_validator import WorkflowValidator, load_object_info, schema_fingerprint, store_object_info
+
+OBJECT_INFO = {
+    "CheckpointLoaderSimple": {
+        "input": {"required": {"ckpt_name": [["sd_xl_base_1.0.safetensors"], {}]}},
+        "output": ["MODEL", "CLIP", "VAE"],
+    },
+    "KSampler": {
+        "input": {
+            "required": {
+                "model": ["MODEL"],
+                "seed": ["INT", {"default": 0, "min": 0, "max": 2**64 - 1}],
+                "steps": ["INT", {"default": 20, "min": 1, "max": 10000}],
+                "sampler_name": ["COMBO", {"options": ["euler", "dpmpp_2m"]}],
+            }
+        },
+        "output": ["LATENT"],
+    },
+    "LoadImage": {
+        "input": {"required": {"image": [["existing.png"], {"image_upload": True}]}},
+        "output": ["IMAGE", "MASK"],
+    },
+    "SaveImage": {
+        "input": {"required": {"images": ["IMAGE"]}, "optional": {"filename_prefix": ["STRING", {}]}},
+        "output": [],
+    },
+}
+
+WORKFLOW = {
+    "3": {
+        "class_type": "KSampler",
+        "inputs": {"model": ["4", 0], "seed": 42, "steps": 20, "sampler_name": "euler"},
+    },
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd_xl_base_1.0.safetensors"}},
+}
+
+
+def with_inputs(node_id, **inputs):
+    workflow = {key: {**node, "inputs": dict(node["inputs"])} for key, node in WORKFLOW.items()}
+    workflow[node_id]["inputs"].update(inputs)
+    return workflow
+
+
+class TestWorkflowValidator(unittest.TestCase):
+    def setUp(self):
+        self.validator = WorkflowValidator(OBJECT_INFO)
+
+    def test_valid_workflow(self):
+        self.assertEqual(self.validator.validate(WORKFLOW), [])
+
+    def test_unknown_class_type(self):
+        workflow = {**WORKFLOW, "9": {"class_type": "SaveImg", "inputs": {}}}
+        self.assertEqual(self.validator.validate(workflow), ["node 9: unknown class_type 'SaveImg'"])
+
+    def test_missing_input_names_the_unknown_one(self):
+        workflow = with_inputs("3")
+        workflow["3"]["inputs"]["sed"] = workflow["3"]["inputs"].pop("seed")
+        self.assertEqual(
+            self.validator.validate(workflow),
+            ["node 3 (KSampler): missing required input 'seed', got unknown input(s) sed"],
+        )
+
+    def test_dangling_link(self):
+        errors = self.validator.validate(with_inputs("3", model=["5", 0]))
+        self.assertEqual(errors, ["node 3 (KSampler): input 'model' links to node 5, which does not exist"])
+
+    def test_link_to_missing_output(self):
+        errors = self.validator.validate(with_inputs("3", model=["4", 3]))
+        self.assertIn("which has 3 output(s)", errors[0])
+
+    def test_link_with_wrong_type(self):
+        errors = self.validator.validate(with_inputs("3", model=["4", 1]))
+        self.assertEqual(errors, ["node 3 (KSampler): input 'model' expects MODEL, but output 1 of node 4 is CLIP"])
+
+    def test_unknown_model_file(self):
+        errors = self.validator.validate(with_inputs("4", ckpt_name="sd_xl_base.safetensors"))
+        self.assertEqual(
+            errors,
+            ["node 4 (CheckpointLoaderSimple): 'sd_xl_base.safetensors' is not a valid choice for input 'ckpt_name'"],
+        )
+
+    def test_combo_options(self):
+        errors = self.validator.validate(with_inputs("3", sampler_name="euler_b"))
+        self.assertIn("'euler_b' is not a valid choice for input 'sampler_name'", errors[0])
+
+    def test_numbers_are_checked(self):
+        self.assertIn("below the minimum of 1", self.validator.validate(with_inputs("3", steps=0))[0])
+        self.assertIn("must be of type INT", self.validator.validate(with_inputs("3", steps="many"))[0])
+        self.assertEqual(self.validator.validate(with_inputs("3", steps="30")), [])
+
+    def test_uploaded_images_are_valid_choices(self):
+        workflow = {"10": {"class_type": "LoadImage", "inputs": {"image": "input.png"}}}
+        self.assertEqual(len(self.validator.validate(workflow)), 1)
+        self.assertEqual(self.validator.validate(workflow, ["input.png"]), [])
+
+    def test_malformed_workflow(self):
+        self.assertEqual(len(self.validator.validate({})), 1)
+        self.assertEqual(len(self.validator.validate({"3": "KSampler"})), 1)
+
+    def test_skipped_values_are_validated_separately(self):
+        workflow = with_inputs("3", steps=0)
+
+        self.assertEqual(self.validator.validate(workflow, skip=[("3", "steps")]), [])
+        errors = self.validator.validate_values(workflow, [("3", "steps"), ("3", "model")])
+        self.assertEqual(len(errors), 1)
+        self.assertIn("node 3 (KSampler): input 'steps' is 0", errors[0])
+
+
+class TestObjectInfoCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store_and_load(self):
+        self.assertIsNone(load_object_info(self.directory, "abc"))
+        store_object_info(self.directory, "abc", OBJECT_INFO)
+        self.assertEqual(load_object_info(self.directory, "abc"), OBJECT_INFO)
+        self.assertIsNone(load_object_info(self.directory, "def"))
+
+    def test_fingerprint_depends_on_version_and_custom_nodes(self):
+        custom_nodes = os.path.join(self.directory, "custom_nodes")
+        os.makedirs(custom_nodes)
+        before = schema_fingerprint("0.3.0", custom_nodes_dir=custom_nodes)
+
+        self.assertEqual(before, schema_fingerprint("0.3.0", custom_nodes_dir=custom_nodes))
+        self.assertNotEqual(before, schema_fingerprint("0.3.1", custom_nodes_dir=custom_nodes))
+        os.makedirs(os.path.join(custom_nodes, "ComfyUI-Impact-Pack"))
+        self.assertNotEqual(before, schema_fingerprint("0.3.0", custom_nodes_dir=custom_nodes))
+
+
+if __name__ == "__main__":
+    unittest.main()